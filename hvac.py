@@ -26,21 +26,120 @@
 
 import logging
 
-from lib import nest
-from lib import gpio
-from lib import ifttt
-from lib import livingroom
-from lib import catroom
-from lib import diningroom
-from lib import marksroom
-from lib import amysroom
+from lib import status
+from lib import scheduler
+from lib import metrics
+from lib import profiler
+from lib import isolate
+from lib import sites
 
 import settings
 
+import os
 import threading
+import multiprocessing
+import signal
 
 from time import sleep
 
+# Keep each worker thread running, restarting any that have failed.
+# workers is a list of (name, target, args)
+RESTARTS = metrics.counter('hvac_thread_restarts_total', 'Worker threads restarted after failing', [ 'thread' ])
+
+def supervise(logger, workers):
+    threads = {}
+
+    while True:
+        for (name, target, args) in workers:
+            thread = threads.get(name)
+            if not thread or not thread.isAlive():
+                if thread:
+                    logger.error('%s Thread failed, restarting' % name)
+                    RESTARTS.label(name).inc()
+                else:
+                    logger.info('Starting %s Thread' % name)
+                thread = threading.Thread(target=target, args=args, name=name)
+                thread.daemon = True
+                thread.start()
+                threads[name] = thread
+
+        sleep(60)
+
+# Run the workers of sites, which share scheduler and a status server on port
+def run_sites(logger, site_list, scheduler_obj, port):
+    workers = [ ('Scheduler', scheduler_obj.run, ()) ]
+    for site in site_list:
+        workers += site.workers
+
+    if port:
+        status_server = status.StatusServer((settings.STATUS_ADDRESS, port),
+                                            dict([ (site.name, site.status) for site in site_list ]))
+        workers.append(('Status', status_server.run, ()))
+
+    supervise(logger, workers)
+
+# Run each group of sites in a process of its own, on a core of its own,
+# restarting any that have stopped.  The sites (and the scheduler they
+# share) were built before any thread started, so each process starts from a
+# clean copy of them.
+def supervise_processes(logger, groups, scheduler_obj):
+    processes = {}
+
+    # The sites are in the processes, pass SIGHUP and SIGUSR1 on to them
+    def forward(signum, frame):
+        for process in processes.values():
+            try:
+                os.kill(process.pid, signum)
+            except OSError:
+                pass
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGUSR1, forward)
+
+    while True:
+        for (index, group) in enumerate(groups):
+            process = processes.get(index)
+            if not process or not process.is_alive():
+                names = ', '.join([ site.name for site in group ])
+                if process:
+                    logger.error('Sites %s process failed (exit code %s), restarting' % (names, process.exitcode))
+                    RESTARTS.label('Sites %d' % (index)).inc()
+                else:
+                    logger.info('Starting sites %s process' % (names))
+                process = multiprocessing.Process(target=run_site_process, args=(logger, group, scheduler_obj, index),
+                                                  name='Sites %d' % (index))
+                process.daemon = True
+                process.start()
+                processes[index] = process
+
+        sleep(60)
+
+def run_site_process(logger, group, scheduler_obj, index):
+    try:
+        isolate.set_affinity(index % multiprocessing.cpu_count())
+    except OSError as e:
+        logger.error('Unable to set the cpu of sites process %d: %s' % (index, e))
+
+    signal.signal(signal.SIGHUP, reload_sites(group))
+    signal.signal(signal.SIGUSR1, toggle_profiler('%s.%d' % (settings.PROFILE_OUTPUT, index)))
+
+    port = settings.STATUS_PORT and settings.STATUS_PORT + index
+    run_sites(logger, group, scheduler_obj, port)
+
+# SIGUSR1 starts the profiler, or stops it and saves what it collected to
+# output
+def toggle_profiler(output):
+    def toggle(signum, frame):
+        if not profiler.PROFILER.toggle():
+            profiler.PROFILER.save(output)
+    return toggle
+
+# SIGHUP reloads the zones.conf of each of site_list
+def reload_sites(site_list):
+    def reload(signum, frame):
+        for site in site_list:
+            site.reload_event.set()
+    return reload
+
 def main():
     logger = logging.getLogger('HVAC')
     logger.setLevel(logging.DEBUG)
@@ -61,100 +160,26 @@ def main():
     logger.info("Copyright (C) 2018-2020 Mark Hatle")
     logger.info("See the source code for licensing terms and conditions.")
 
-    gpio_obj = gpio.Gpio(settings.GPIO_SERIAL)
-    nest_obj = nest.Nest(settings.NEST_TOKEN)
-    ifttt_obj = ifttt.IFTTT(settings.IFTTT_TOKEN)
-
-    livingroom_obj = livingroom.LivingRoom(nest_obj, gpio_obj, ifttt_obj)
-    catroom_obj = catroom.CatRoom(nest_obj, gpio_obj, ifttt_obj)
-    diningroom_obj = diningroom.DiningRoom(nest_obj, gpio_obj, ifttt_obj)
-    amysroom_obj = amysroom.AmysRoom(nest_obj, gpio_obj, ifttt_obj)
-    marksroom_obj = marksroom.MarksRoom(nest_obj, gpio_obj, ifttt_obj)
-
-    gpio_thread = None
-    nest_thread = None
-    ifttt_thread = None
-
-    livingroom_thread = None
-    catroom_thread = None
-    diningroom_thread = None
-    amysroom_thread = None
-    marksroom_thread = None
-
-    while True:
-        if not gpio_thread or not gpio_thread.isAlive():
-            if gpio_thread:
-                logger.error('GPIO Thread failed, restarting')
-            else:
-                logger.info('Starting GPIO Thread')
-            gpio_thread = threading.Thread(target=gpio_obj.run)
-            gpio_thread.daemon = True
-            gpio_thread.start()
-
-        if not nest_thread or not nest_thread.isAlive():
-            if nest_thread:
-                logger.error('Works with Nest Thread failed, restarting')
-            else:
-                logger.info('Starting Works with Nest Thread')
-            nest_thread = threading.Thread(target=nest_obj.run, args=(True,))
-            nest_thread.daemon = True
-            nest_thread.start()
-
-        if not ifttt_thread or not ifttt_thread.isAlive():
-            if ifttt_thread:
-                logger.error('IFTTT Thread failed, restarting')
-            else:
-                logger.info('Starting IFTTT Thread')
-            ifttt_thread = threading.Thread(target=ifttt_obj.run)
-            ifttt_thread.daemon = True
-            ifttt_thread.start()
-
-        if not livingroom_thread or not livingroom_thread.isAlive():
-            if livingroom_thread:
-                logger.error('livingroom Thread failed, restarting')
-            else:
-                logger.info('Starting livingroom Thread')
-            livingroom_thread = threading.Thread(target=livingroom_obj.run)
-            livingroom_thread.daemon = True
-            livingroom_thread.start()
-
-        if not catroom_thread or not catroom_thread.isAlive():
-            if catroom_thread:
-                logger.error('catroom Thread failed, restarting')
-            else:
-                logger.info('Starting catroom Thread')
-            catroom_thread = threading.Thread(target=catroom_obj.run)
-            catroom_thread.daemon = True
-            catroom_thread.start()
-
-        if not diningroom_thread or not diningroom_thread.isAlive():
-            if diningroom_thread:
-                logger.error('diningroom Thread failed, restarting')
-            else:
-                logger.info('Starting diningroom Thread')
-            diningroom_thread = threading.Thread(target=diningroom_obj.run)
-            diningroom_thread.daemon = True
-            diningroom_thread.start()
-
-        if not amysroom_thread or not amysroom_thread.isAlive():
-            if amysroom_thread:
-                logger.error('amysroom Thread failed, restarting')
-            else:
-                logger.info('Starting amysroom Thread')
-            amysroom_thread = threading.Thread(target=amysroom_obj.run)
-            amysroom_thread.daemon = True
-            amysroom_thread.start()
-
-        if not marksroom_thread or not marksroom_thread.isAlive():
-            if marksroom_thread:
-                logger.error('marksroom Thread failed, restarting')
-            else:
-                logger.info('Starting marksroom Thread')
-            marksroom_thread = threading.Thread(target=marksroom_obj.run)
-            marksroom_thread.daemon = True
-            marksroom_thread.start()
-
-        sleep(60)
+    profiler.PROFILER.configure(settings.PROFILE_RATE, settings.PROFILE_SPANS)
+    signal.signal(signal.SIGUSR1, toggle_profiler(settings.PROFILE_OUTPUT))
+
+    if settings.SITES:
+        site_list = [ sites.Site(name, settings, settings.SITES[name]) for name in sorted(settings.SITES) ]
+    else:
+        site_list = [ sites.Site('', settings) ]
+
+    # Built here, so a configuration error stops us before anything starts
+    scheduler_obj = scheduler.Scheduler()
+    lan_actuators = {}
+    for site in site_list:
+        site.build(scheduler_obj, lan_actuators)
+    signal.signal(signal.SIGHUP, reload_sites(site_list))
+
+    processes = min(settings.SITE_PROCESSES, len(site_list))
+    if processes > 1:
+        supervise_processes(logger, [ site_list[index::processes] for index in range(processes) ], scheduler_obj)
+    else:
+        run_sites(logger, site_list, scheduler_obj, settings.STATUS_PORT)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,163 @@
+# Local actuators
+#
+# LanActuator sends actions straight to a device (or bridge) on the local
+# network, instead of going through maker.ifttt.com and the vendor's cloud.
+# The device is expected to answer GET <base_url>/<action> once the action
+# has been carried out, so the response is the acknowledgement, there is no
+# need to wait on the cgi-bin fifo.  Connections are kept alive in a small
+# pool, so a request doesn't pay for a new TCP connection.
+#
+# GpioActuator switches relays wired to the Numato GPIO board's output
+# lines, the actions are relay<line>_on and relay<line>_off.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import httplib
+import socket
+import urlparse
+import Queue
+from time import time
+import threading
+import logging
+
+import ifttt
+import config
+from profiler import span
+
+class LanActuator():
+    # base_url - i.e. http://192.168.1.20:8080
+    # pool_size - connections kept open to the device
+    # timeout - seconds to wait for the device to connect and answer
+    def __init__(self, base_url, pool_size=2, timeout=2):
+        self.logger = logging.getLogger('HVAC.LAN')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            parts = urlparse.urlparse(base_url)
+            self.host    = parts.netloc
+            self.path    = parts.path.rstrip('/')
+            self.timeout = timeout
+
+            self.pool = Queue.Queue()
+            for slot in range(pool_size):
+                self.pool.put(None)     # Connected on first use
+
+            self.sent     = 0
+            self.failed   = 0
+            self.latency  = 0.0     # Total seconds spent on successful requests
+        finally:
+            self.lock.release()
+
+    def _request(self, conn, action):
+        if conn is None:
+            conn = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        conn.request('GET', '%s/%s' % (self.path, action))
+        res = conn.getresponse()
+        body = res.read()
+        return (conn, res.status, res.reason, body)
+
+    # Same interface as IFTTT.send_action.  The device acknowledges the
+    # action by answering, so retry is not needed and priority is ignored.
+    # Returns True if the device accepted the action.
+    @span('LanActuator.send_action')
+    def send_action(self, action, retry=0, priority=ifttt.PRIORITY_CONTROL):
+        start = time()
+        conn = self.pool.get()
+
+        try:
+            # A kept alive connection may have been closed by the device,
+            # so try once more on a fresh connection
+            for attempt in range(2):
+                try:
+                    (conn, status, reason, body) = self._request(conn, action)
+                    break
+                except (socket.error, httplib.HTTPException) as e:
+                    if conn:
+                        conn.close()
+                    conn = None
+                    if attempt:
+                        self.logger.error('%s: %s %s' % (type(e).__name__, action, e))
+                        try:
+                            self.lock.acquire()
+                            self.failed += 1
+                        finally:
+                            self.lock.release()
+                        return False
+        finally:
+            self.pool.put(conn)
+
+        if status != 200:
+            self.logger.error("%s: %s %s" % (action, status, reason))
+            try:
+                self.lock.acquire()
+                self.failed += 1
+            finally:
+                self.lock.release()
+            return False
+
+        elapsed = time() - start
+        self.logger.info("Success: %s (%.3fs)" % (action, elapsed))
+
+        try:
+            self.lock.acquire()
+            self.sent += 1
+            self.latency += elapsed
+        finally:
+            self.lock.release()
+
+        return True
+
+    def getStats(self):
+        try:
+            self.lock.acquire()
+            return { 'sent'    : self.sent,
+                     'failed'  : self.failed,
+                     'latency' : self.sent and self.latency / self.sent or 0.0 }
+        finally:
+            self.lock.release()
+
+class GpioActuator():
+    # gpio - Gpio object with the relay lines configured as outputs
+    def __init__(self, gpio):
+        self.logger = logging.getLogger('HVAC.Relay')
+
+        self.gpio = gpio
+
+    # Same interface as IFTTT.send_action.  Returns once the relay has been
+    # switched, retry and priority are not needed.
+    @span('GpioActuator.send_action')
+    def send_action(self, action, retry=0, priority=ifttt.PRIORITY_CONTROL):
+        match = config.RELAY_ACTION.match(action)
+        if not match:
+            self.logger.error("Unknown relay action %s" % (action))
+            return False
+
+        line = 1 << int(match.group(1))
+        start = time()
+        if not self.gpio.write(match.group(2) == 'on' and line or 0x0, line):
+            self.logger.error("%s: GPIO board disconnected" % (action))
+            return False
+        self.logger.info("Success: %s (%.3fs)" % (action, time() - start))
+
+        return True
@@ -0,0 +1,122 @@
+# Circuit breaker
+#
+# Tracks the health of a remote endpoint.  After enough consecutive failures
+# the circuit opens and callers fail fast instead of waiting on timeouts.
+# Once reset_timeout has passed, a single trial request is let through
+# (half-open); it closes the circuit again if it succeeds.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from time import time
+import threading
+import logging
+
+CLOSED    = 'closed'
+OPEN      = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitBreaker():
+    # threshold - consecutive failures before the circuit opens
+    # reset_timeout - seconds to stay open before trying again
+    def __init__(self, name, threshold=3, reset_timeout=60):
+        self.logger = logging.getLogger('HVAC.Breaker')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.name          = name
+            self.threshold     = threshold
+            self.reset_timeout = reset_timeout
+
+            self.state    = CLOSED
+            self.failures = 0       # Consecutive failures
+            self.opened   = 0       # Time the circuit last opened
+            self.trial    = False   # Half-open trial request outstanding
+        finally:
+            self.lock.release()
+
+    # May a request be sent now?
+    def allow(self):
+        try:
+            self.lock.acquire()
+
+            if self.state == OPEN and time() - self.opened >= self.reset_timeout:
+                self.logger.info("%s: half-open, trying a request" % (self.name))
+                self.state = HALF_OPEN
+                self.trial = False
+
+            if self.state == CLOSED:
+                return True
+
+            if self.state == HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+
+            return False
+        finally:
+            self.lock.release()
+
+    # Would allow() let a request through?  (no side effects)
+    def ready(self):
+        try:
+            self.lock.acquire()
+            if self.state == OPEN:
+                return time() - self.opened >= self.reset_timeout
+            return self.state == CLOSED or not self.trial
+        finally:
+            self.lock.release()
+
+    # Returns True if this closed the circuit
+    def success(self):
+        try:
+            self.lock.acquire()
+
+            self.failures = 0
+            if self.state != CLOSED:
+                self.logger.info("%s: closed" % (self.name))
+                self.state = CLOSED
+                self.trial = False
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def failure(self):
+        try:
+            self.lock.acquire()
+
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+                self.logger.warning("%s: open after %d failures" % (self.name, self.failures))
+                self.state = OPEN
+                self.opened = time()
+                self.trial = False
+        finally:
+            self.lock.release()
+
+    def getState(self):
+        try:
+            self.lock.acquire()
+            return self.state
+        finally:
+            self.lock.release()
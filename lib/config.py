@@ -0,0 +1,401 @@
+# Zone configuration loader
+#
+# Zones are described in an INI style file, one [zone:<name>] section per
+# zone.  The file is validated when loaded and compiled into lookup tables
+# (actions, time of day fan speeds) that the generic Zone uses at runtime.
+# See zones.conf for the available keys.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import ConfigParser
+import re
+
+class ConfigError(Exception):
+    pass
+
+# IFTTT actions a zone may define, the value is the event name optionally
+# followed by ', <retry seconds>'.  *_temp actions take the temp via '%s'.
+ACTIONS = [ 'heat_on', 'heat_off', 'heating_on', 'heating_off', 'heating_temp',
+            'cool_on', 'cool_off', 'cooling_on', 'cooling_off', 'cooling_temp',
+            'fan_on', 'fan_off',
+            'cooling_fan_auto', 'cooling_fan_low', 'cooling_fan_med', 'cooling_fan_high' ]
+
+TEMP_ACTIONS = [ 'heating_temp', 'cooling_temp' ]
+
+# Where the actions are sent, IFTTT webhooks, a device on the local network
+# or relays on the GPIO board's output lines (relay<line>_on/off actions)
+ACTUATORS = [ 'ifttt', 'lan', 'gpio' ]
+RELAY_ACTION = re.compile(r'^relay([0-9]+)_(on|off)$')
+
+# Integer zone settings, and their default (matches Zone)
+SETTINGS = { 'ac_min'                : 64,
+             'ac_max'                : 80,
+             'ac_temp_default'       : 70,
+             'ac_cooling_on_offset'  : -2,
+             'ac_cooling_off_offset' :  2,
+             'heating_min'           : 0,
+             'heating_max'           : 100,
+             'heating_default'       : 65,
+             'heating_on_offset'     :  2,
+             'heating_off_offset'    : -2 }
+
+# GPIO line numbers (0 is called for / active).  Lines 0-7 are on the first
+# board, 8-15 on the second and so on.
+GPIO_LINES  = [ 'gpio_cool', 'gpio_heat', 'gpio_fan' ]
+GPIO_WIDTH  = 8
+GPIO_BOARDS = 8
+
+# Additional heating/cooling stages, each with its own GPIO line and device
+# gpio_<stage> = <line>, <stage>_on = <action>, <stage>_off = <action>
+# where <stage> is heat<N> or cool<N>, i.e. heat3 or cool2
+STAGE_GPIO   = re.compile(r'^gpio_((?:heat|cool)[0-9]+)$')
+STAGE_ACTION = re.compile(r'^((?:heat|cool)[0-9]+)_(on|off)$')
+
+# Device ratings, in watts
+RATINGS = [ 'heat_watts', 'cool_watts' ]
+
+# Load management, the circuit the zone's devices are on and their priority
+# (lower is more important) when there isn't capacity for everything
+LOAD = { 'circuit' : None, 'load_priority' : 5 }
+
+# Local temperature sensor on a GPIO board ADC channel
+#   sensor = <line>, sensor_calibration = <raw>:<degrees>, ...,
+#   sensor_smoothing = <weight of a new reading, 0-1>
+SENSOR = [ 'sensor', 'sensor_calibration', 'sensor_smoothing' ]
+
+# Time of day fan speed rules
+FAN_RULES  = { 'fan_cooling' : 'cooling', 'fan_idle' : 'idle' }
+FAN_SPEEDS = [ 'auto', 'low', 'med', 'high' ]
+
+# Time of day setbacks, degrees added to the thermostat target
+SETBACK_RULES = { 'setback_heating' : 'heating', 'setback_cooling' : 'cooling' }
+
+KEYS = [ 'display_name', 'thermostat', 'actuator' ] + ACTIONS + SETTINGS.keys() + GPIO_LINES + RATINGS + \
+       LOAD.keys() + SENSOR + FAN_RULES.keys() + SETBACK_RULES.keys()
+
+class ZoneConfig():
+    def __init__(self, name):
+        self.name         = name
+        self.display_name = None
+        self.therm_name   = None
+        self.actuator     = 'ifttt'
+
+        self.actions      = {}   # action : (ifttt event, retry)
+        self.settings     = dict(SETTINGS)
+        self.gpio         = {}   # gpio_* : bit mask
+        self.stages       = {}   # stage : { 'gpio' : mask, 'on' : action, 'off' : action }
+        self.ratings      = {}   # *_watts : watts
+        self.load         = dict(LOAD)  # circuit, load_priority
+        self.sensor       = None # ADC line
+        self.sensor_calibration = []   # [ (raw, degrees) ]
+        self.sensor_smoothing   = 0.3
+        self.fan_rules    = {}   # cooling/idle : [ speed for hour 0..23 ]
+        self.setback_rules = {}  # heating/cooling : [ degrees for hour 0..23 ]
+
+    def __eq__(self, other):
+        return isinstance(other, ZoneConfig) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+def _int(section, key, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ConfigError("[%s] %s: '%s' is not a number" % (section, key, value))
+
+def _action(section, key, value):
+    fields = [field.strip() for field in value.split(',')]
+    if len(fields) > 2 or not fields[0]:
+        raise ConfigError("[%s] %s: expected '<event>[, <retry>]', got '%s'" % (section, key, value))
+
+    retry = 0
+    if len(fields) == 2:
+        retry = _int(section, key, fields[1])
+
+    if key in TEMP_ACTIONS and '%s' not in fields[0]:
+        raise ConfigError("[%s] %s: event '%s' must contain %%s for the temperature" % (section, key, fields[0]))
+
+    return (fields[0], retry)
+
+def _hour(section, key, value):
+    hour = _int(section, key, value)
+    if hour < 0 or hour > 24:
+        raise ConfigError("[%s] %s: hour %s out of range" % (section, key, hour))
+    return hour % 24
+
+def _fan_speed(section, key, value):
+    if value not in FAN_SPEEDS:
+        raise ConfigError("[%s] %s: unknown fan speed '%s'" % (section, key, value))
+    return value
+
+# Compile '<start>-<end>:<value>, ..., *:<value>' into a value per hour.
+# The first matching rule wins, ranges wrap around midnight (22-8).  Hours
+# not covered by any rule get the default, if there is one.
+def _hour_rules(section, key, value, convert, default=None):
+    table = [ None ] * 24
+
+    for rule in value.split(','):
+        rule = rule.strip()
+        if ':' not in rule:
+            raise ConfigError("[%s] %s: expected '<start>-<end>:<value>', got '%s'" % (section, key, rule))
+
+        (hours, result) = [field.strip() for field in rule.split(':', 1)]
+        result = convert(section, key, result)
+
+        if hours == '*':
+            span = range(24)
+        else:
+            if '-' not in hours:
+                raise ConfigError("[%s] %s: expected '<start>-<end>', got '%s'" % (section, key, hours))
+            (start, end) = hours.split('-', 1)
+            start = _hour(section, key, start)
+            end = _hour(section, key, end)
+            span = []
+            hour = start
+            while hour != end or not span:
+                span.append(hour)
+                hour = (hour + 1) % 24
+                if hour == start:
+                    break
+
+        for hour in span:
+            if table[hour] is None:
+                table[hour] = result
+
+    if default is not None:
+        table = [ (default if result is None else result) for result in table ]
+
+    if None in table:
+        raise ConfigError("[%s] %s: hour %d has no value, add a '*:<value>' rule" % (section, key, table.index(None)))
+
+    return table
+
+def _gpio_line(section, key, value):
+    line = _int(section, key, value)
+    if line < 0 or line >= GPIO_WIDTH * GPIO_BOARDS:
+        raise ConfigError("[%s] %s: GPIO line %d out of range" % (section, key, line))
+    return 1 << line
+
+def _float(section, key, value):
+    try:
+        return float(value)
+    except ValueError:
+        raise ConfigError("[%s] %s: '%s' is not a number" % (section, key, value))
+
+def _calibration(section, key, value):
+    points = []
+    for point in value.split(','):
+        if ':' not in point:
+            raise ConfigError("[%s] %s: expected '<raw>:<degrees>', got '%s'" % (section, key, point.strip()))
+        (raw, temp) = point.split(':', 1)
+        points.append((_int(section, key, raw.strip()), _float(section, key, temp.strip())))
+
+    if len(points) < 2 or len(set([raw for (raw, temp) in points])) != len(points):
+        raise ConfigError("[%s] %s: needs at least two points with different raw readings" % (section, key))
+
+    return sorted(points)
+
+def _zone(parser, section, name):
+    zone = ZoneConfig(name)
+
+    for key in parser.options(section):
+        value = parser.get(section, key).strip()
+
+        stage_gpio = STAGE_GPIO.match(key)
+        stage_action = STAGE_ACTION.match(key)
+
+        if key not in KEYS and not stage_gpio and not stage_action:
+            raise ConfigError("[%s] unknown setting '%s'" % (section, key))
+
+        if stage_gpio:
+            stage = zone.stages.setdefault(stage_gpio.group(1), {})
+            stage['gpio'] = _gpio_line(section, key, value)
+        elif stage_action:
+            stage = zone.stages.setdefault(stage_action.group(1), {})
+            stage[stage_action.group(2)] = _action(section, key, value)
+        elif key == 'display_name':
+            zone.display_name = value
+        elif key == 'thermostat':
+            zone.therm_name = value
+        elif key == 'actuator':
+            if value not in ACTUATORS:
+                raise ConfigError("[%s] %s: unknown actuator '%s'" % (section, key, value))
+            zone.actuator = value
+        elif key in ACTIONS:
+            zone.actions[key] = _action(section, key, value)
+        elif key in SETTINGS:
+            zone.settings[key] = _int(section, key, value)
+        elif key in GPIO_LINES:
+            zone.gpio[key] = _gpio_line(section, key, value)
+        elif key in RATINGS:
+            zone.ratings[key] = _int(section, key, value)
+        elif key == 'circuit':
+            zone.load[key] = value
+        elif key == 'load_priority':
+            zone.load[key] = _int(section, key, value)
+        elif key == 'sensor':
+            zone.sensor = _gpio_line(section, key, value).bit_length() - 1
+        elif key == 'sensor_calibration':
+            zone.sensor_calibration = _calibration(section, key, value)
+        elif key == 'sensor_smoothing':
+            zone.sensor_smoothing = _float(section, key, value)
+            if zone.sensor_smoothing <= 0 or zone.sensor_smoothing > 1:
+                raise ConfigError("[%s] %s: must be greater then 0, and at most 1" % (section, key))
+        elif key in FAN_RULES:
+            zone.fan_rules[FAN_RULES[key]] = _hour_rules(section, key, value, _fan_speed)
+        elif key in SETBACK_RULES:
+            zone.setback_rules[SETBACK_RULES[key]] = _hour_rules(section, key, value, _int, 0)
+
+    if not zone.therm_name:
+        raise ConfigError("[%s] no thermostat defined" % (section))
+
+    for stage in zone.stages:
+        for field in [ 'gpio', 'on', 'off' ]:
+            if field not in zone.stages[stage]:
+                raise ConfigError("[%s] stage %s has no %s defined" % (section, stage,
+                                  field == 'gpio' and 'gpio_%s' % stage or '%s_%s' % (stage, field)))
+
+    if zone.sensor is not None and not zone.sensor_calibration:
+        raise ConfigError("[%s] sensor requires a sensor_calibration" % (section))
+
+    if zone.actuator == 'gpio':
+        actions = zone.actions.items()
+        for stage in zone.stages:
+            actions += [ ('%s_%s' % (stage, field), zone.stages[stage][field]) for field in [ 'on', 'off' ] ]
+        for (key, (event, retry)) in actions:
+            match = RELAY_ACTION.match(event)
+            if not match:
+                raise ConfigError("[%s] %s: expected relay<line>_on or relay<line>_off, got '%s'" % (section, key, event))
+            line = _gpio_line(section, key, match.group(1))
+            for gpio in zone.gpio.values() + [ stage['gpio'] for stage in zone.stages.values() ]:
+                if gpio & line:
+                    raise ConfigError("[%s] %s: GPIO line %s is used as an input" % (section, key, match.group(1)))
+
+    for prefix in [ 'ac', 'heating' ]:
+        if zone.settings['%s_min' % prefix] > zone.settings['%s_max' % prefix]:
+            raise ConfigError("[%s] %s_min is greater then %s_max" % (section, prefix, prefix))
+
+    if zone.fan_rules:
+        for speed in FAN_SPEEDS:
+            if 'cooling_fan_%s' % speed not in zone.actions:
+                raise ConfigError("[%s] fan rules require a cooling_fan_%s action" % (section, speed))
+
+    return zone
+
+# Returns a list of ZoneConfig, in the order they appear in the file
+def load_zones(filename):
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(filename):
+        raise ConfigError("Unable to read zone configuration %s" % (filename))
+
+    zones = []
+    for section in parser.sections():
+        if not section.startswith('zone:'):
+            continue
+        name = section[len('zone:'):].strip()
+        if not name:
+            raise ConfigError("[%s] zone has no name" % (section))
+        zones.append(_zone(parser, section, name))
+
+    if not zones:
+        raise ConfigError("No [zone:<name>] sections in %s" % (filename))
+
+    return zones
+
+# Make sure every GPIO line used exists, there are 'lines' of them
+def check_gpio_lines(zones, lines):
+    for zone in zones:
+        used = zone.gpio.values() + [ stage['gpio'] for stage in zone.stages.values() ]
+        if zone.actuator == 'gpio':
+            used.append(relay_lines([ zone ]))
+        if zone.sensor is not None:
+            used.append(1 << zone.sensor)
+        for gpio in used:
+            if gpio >> lines:
+                raise ConfigError("[zone:%s] GPIO line %d is not available, there are %d lines" % (zone.name, gpio.bit_length() - 1, lines))
+
+# ADC lines used by the zones' sensors, line : (calibration, smoothing).
+# Zones sharing a sensor must describe it the same way.
+def sensor_lines(zones):
+    sensors = {}
+    for zone in zones:
+        if zone.sensor is None:
+            continue
+        sensor = (zone.sensor_calibration, zone.sensor_smoothing)
+        if sensors.setdefault(zone.sensor, sensor) != sensor:
+            raise ConfigError("[zone:%s] sensor %d is calibrated differently by another zone" % (zone.name, zone.sensor))
+        for gpio in zone.gpio.values() + [ stage['gpio'] for stage in zone.stages.values() ]:
+            if gpio == 1 << zone.sensor:
+                raise ConfigError("[zone:%s] sensor line %d is also a GPIO input" % (zone.name, zone.sensor))
+    return sensors
+
+# Bit mask of the GPIO lines driving relays, for zones with actuator = gpio
+def relay_lines(zones):
+    lines = 0x0
+    for zone in zones:
+        if zone.actuator != 'gpio':
+            continue
+        events = [ event for (event, retry) in zone.actions.values() ]
+        for stage in zone.stages.values():
+            events += [ stage['on'][0], stage['off'][0] ]
+        for event in events:
+            lines |= 1 << int(RELAY_ACTION.match(event).group(1))
+
+    for zone in zones:
+        inputs = zone.gpio.values() + [ stage['gpio'] for stage in zone.stages.values() ]
+        if zone.sensor is not None:
+            inputs.append(1 << zone.sensor)
+        for gpio in inputs:
+            if gpio & lines:
+                raise ConfigError("[zone:%s] GPIO line %d is driving a relay" % (zone.name, gpio.bit_length() - 1))
+
+    return lines
+
+class LoadLimits():
+    def __init__(self):
+        self.house    = 0    # watts, 0 = no limit
+        self.circuits = {}   # circuit : watts
+        self.rotate   = 1800 # seconds
+
+# The optional [load] section:
+#   house = <watts>, rotate = <seconds>, circuit_<name> = <watts>
+def load_limits(filename):
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(filename):
+        raise ConfigError("Unable to read zone configuration %s" % (filename))
+
+    limits = LoadLimits()
+    if not parser.has_section('load'):
+        return limits
+
+    for key in parser.options('load'):
+        value = parser.get('load', key).strip()
+        if key == 'house':
+            limits.house = _int('load', key, value)
+        elif key == 'rotate':
+            limits.rotate = _int('load', key, value)
+        elif key.startswith('circuit_'):
+            limits.circuits[key[len('circuit_'):]] = _int('load', key, value)
+        else:
+            raise ConfigError("[load] unknown setting '%s'" % (key))
+
+    return limits
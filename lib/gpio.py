@@ -1,6 +1,22 @@
 #! /usr/bin/env python
 #
-# Python module for managing the Numato USB 8-port GPIO board
+# Python module for managing the Numato USB 8-port GPIO boards
+#
+# Any number of boards are handled by a single thread, polling them all at
+# once and waiting on their responses with select().  The boards' lines are
+# combined into one bit space, board N's lines are bits N*8 to N*8+7, so a
+# zone can take its inputs from any board.
+#
+# A board that stops answering (USB reset, unplugged) is closed, and it is
+# reopened with a backoff once its device node reappears.  Nothing is
+# reported until every board has been read, and the reading goes back to
+# None (unknown) while one is disconnected, so the zones drop their calls
+# rather then act on a dead board's last reading.
+#
+# Lines are inputs (the thermostats calling) unless configured as outputs,
+# which drive relays.  Output changes are batched and sent in the same
+# serial exchange as the next read.  Lines with a temperature sensor are
+# read through the board's ADC in that same exchange.
 #
 # Written by Mark Hatle <mark@hatle.net>
 # Copyright (C) 2018 Mark Hatle
@@ -23,36 +39,153 @@
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import serial
-from time import sleep
+import select
+import os
+from time import time
 import threading
 import logging
 
-class Gpio():
-    def __init__(self, serial_port):
+from readiness import Readiness
+import metrics
+
+POLLS  = metrics.counter('gpio_polls_total', 'GPIO board polls', [ 'site' ])
+EDGES  = metrics.counter('gpio_edges_total', 'GPIO input lines that changed', [ 'site' ])
+ERRORS = metrics.counter('gpio_serial_errors_total', 'GPIO boards disconnected by a serial error or timeout', [ 'site', 'port' ])
+
+GPIO_WIDTH = 8       # Lines per board
+GPIO_MASK  = 0xff
+
+# One Numato board, the serial I/O is only done by the Gpio thread
+class Board():
+    # adc - the board's lines (0-7) read through the ADC
+    def __init__(self, port, base, outputs=0x0, adc=[]):
+        self.logger = logging.getLogger('HVAC.GPIO.%d' % (base // GPIO_WIDTH))
+
+        self.port    = port
+        self.base    = base      # First bit of the combined bit space
+        self.outputs = outputs & GPIO_MASK
+        self.adc     = sorted(adc)
+
+        self.fd      = None
+        self.buffer  = ""
+        self.commands = []       # Commands awaiting a response
+        self.value   = None      # Last good readall, None until read
+        self.timeouts = 0        # Polls in a row without a complete response
+
+        self.backoff  = 0        # Seconds to wait before reopening
+        self.retry_at = 0        # Time to try reopening
+
+        # Protected by the Gpio lock
+        self.output_value   = 0x0   # Output levels last written
+        self.output_pending = None  # (value, mask) not yet written
+        self.output_batches = []    # Events set once the pending writes are sent
+        self.sending        = None  # (value, mask) in the current poll
+        self.sending_batches = []
+        self.init = True
+
+    def connected(self):
+        return self.fd is not None
+
+    def open(self):
+        self.fd = serial.Serial(self.port, 115200, timeout=0)
+        self.buffer = ""
+        self.commands = []
+        self.timeouts = 0
+        self.init = True
+        self.logger.info("%s connected" % (self.port))
+
+    # Close and schedule a reopen, backing off up to a minute
+    def close(self, reason):
+        self.logger.warning("%s disconnected: %s" % (self.port, reason))
+        try:
+            if self.fd:
+                self.fd.close()
+        except Exception:
+            pass
+        self.fd = None
+        self.value = None
+        self.backoff = min(60, max(1, self.backoff * 2))
+        self.retry_at = time() + self.backoff
+
+    def fileno(self):
+        return self.fd.fileno()
+
+    def send(self, commands):
+        # Drop anything left over from a poll that timed out
+        while self.fd.read(256):
+            pass
+        #self.logger.debug('"%s" --> gpio' % commands)
+        self.fd.write(''.join([command + '\n' for command in commands]))
+        self.buffer = ""
+        self.commands = commands
+
+    # Read what the board has sent, returns True once every command has
+    # been answered (each response ends with a prompt)
+    def receive(self):
+        input = self.fd.read(256)
+        if not input:
+            raise serial.SerialException("readable but no data")
+        #self.logger.debug('"%s" <-- gpio' % input)
+        self.buffer += input
+        return self.buffer.count('>') >= len(self.commands)
+
+    # The lines each command produced
+    def responses(self):
+        results = []
+        for (command, response) in zip(self.commands, self.buffer.split('>')):
+            lines = []
+            for line in response.split('\n\r'):
+                # Skip blank lines
+                if not line:
+                    continue
+                # Skip output command
+                if line == command:
+                    continue
+                lines.append(line)
+            results.append(lines)
+
+        self.commands = []
+        #self.logger.debug('results: "%s"' % results)
+        return results
+
+class Gpio(Readiness):
+    # serial_ports - device node of each board (a single string is one board)
+    # outputs - bit mask of the lines driven by us, the rest are inputs
+    # sensors - line : Sensor, for the lines read through the ADC
+    # site - the site (house) the boards are in, '' if only one
+    def __init__(self, serial_ports, outputs=0x0, sensors={}, response_timeout=0.5, site=''):
         self.logger = logging.getLogger('HVAC.GPIO')
 
-        self.lock = threading.Lock()   # Thread lock for the data
+        Readiness.__init__(self, 'GPIO')
+
+        self.site = site
+        self.lock = metrics.TimedLock('gpio', site)   # Thread lock for the data
 
         try:
             self.lock.acquire()
 
             self.gpio      = None	# Stored GPIO value
+            self.gpio_time = None	# When the last change was seen
 
-            self.gpio_fd   = None
-            self.gpio_port = serial_port
+            if isinstance(serial_ports, basestring):
+                serial_ports = [ serial_ports ]
+            self.sensors = dict(sensors)
+            self.boards = []
+            for (index, port) in enumerate(serial_ports):
+                base = index * GPIO_WIDTH
+                adc = [ line - base for line in self.sensors if base <= line < base + GPIO_WIDTH ]
+                self.boards.append(Board(port, base, outputs >> base, adc))
 
-            self.events = []   # Thread events when data is updated
+            self.response_timeout = response_timeout
 
-            self.gpio_fd   = serial.Serial(self.gpio_port, 115200, timeout=0)
+            self.events = []   # Thread events when data is updated
 
-            self.init = True
+            self.wakeup = threading.Event()   # Writes pending, don't wait to poll
+            self.sensors_changed = False
 
         finally:
             self.lock.release()
 
-    def __del__(self):
-        self.gpio_fd.close()
-
     def registerEvent(self, event):
         if event not in self.events:
             self.events.append(event)
@@ -65,79 +198,326 @@ class Gpio():
         try:
             self.lock.acquire()
             #self.logger.debug("raw gpio  %s" % self.gpio)
-            if self.gpio:
+            # 0 is a valid reading (every line is being called for)
+            if self.gpio is not None:
                 return int(self.gpio)
             else:
                 return None
         finally:
             self.lock.release()
 
+    # When the last change was seen, as seconds since the epoch
+    def getGpioTime(self):
+        try:
+            self.lock.acquire()
+            return self.gpio_time
+        finally:
+            self.lock.release()
+
+    # Smoothed, calibrated degrees F from the sensor on line, or None
+    def getTemperature(self, line):
+        try:
+            self.lock.acquire()
+            sensor = self.sensors.get(line)
+            if sensor:
+                return sensor.getValue()
+            return None
+        finally:
+            self.lock.release()
+
+    # Boards currently connected, by port
+    def getBoards(self):
+        try:
+            self.lock.acquire()
+            return dict([ (board.port, board.connected()) for board in self.boards ])
+        finally:
+            self.lock.release()
+
+    # Set the output lines in mask to value.  Writes are merged with any
+    # others pending and sent with the next poll.  If wait is set, return
+    # once they have been written.  Returns False if a board they go to is
+    # disconnected, they are written once it is back.
+    def write(self, value, mask, wait=True):
+        if mask >> (len(self.boards) * GPIO_WIDTH):
+            raise ValueError("GPIO lines {0:b} are not on any board".format(mask))
+
+        result = True
+        batches = []
+        try:
+            self.lock.acquire()
+
+            for board in self.boards:
+                board_mask = (mask >> board.base) & GPIO_MASK
+                if not board_mask:
+                    continue
+                if board_mask & ~board.outputs:
+                    raise ValueError("GPIO lines {0:08b} of {1} are not outputs".format(board_mask & ~board.outputs, board.port))
+
+                board_value = (value >> board.base) & GPIO_MASK
+                (pending_value, pending_mask) = board.output_pending or (board.output_value, 0x0)
+                pending_value = (pending_value & ~board_mask) | (board_value & board_mask)
+                board.output_pending = (pending_value, pending_mask | board_mask)
+
+                if not board.connected():
+                    result = False
+                    continue
+
+                batch = threading.Event()
+                board.output_batches.append(batch)
+                batches.append((board, batch))
+        finally:
+            self.lock.release()
+
+        self.wakeup.set()
+
+        if not wait:
+            return result
+
+        for (board, batch) in batches:
+            batch.wait()
+            try:
+                self.lock.acquire()
+                if board.output_pending and board.output_pending[1] & (mask >> board.base):
+                    result = False
+            finally:
+                self.lock.release()
         return result
 
-    def poll_gpio(self):
-        def _gpio_write(output):
-            #self.logger.debug('"%s" --> gpio' % output)
-            self.gpio_fd.write(output + '\n')
-            # Give the device time to respond
-            sleep(.1)
-
-        def _gpio_readbuffer():
-            buffer = ""
-            while True:
-                input = self.gpio_fd.read()
-                #self.logger.debug('"%s" <-- gpio' % input)
-                if not input:
-                    break
-                buffer += input
-            return buffer
-
-        def _write_read_gpio(output):
-            _gpio_write(output)
-            buffer = _gpio_readbuffer()
-            lines = []
-            prompt = False
-            for line in buffer.split('\n\r'):
-                # Skip blank lines
-                if not line:
+    def getOutputs(self):
+        try:
+            self.lock.acquire()
+            value = 0x0
+            for board in self.boards:
+                value |= board.output_value << board.base
+            return value
+        finally:
+            self.lock.release()
+
+    # Commands for the next poll of a board, taking its pending writes
+    def _commands(self, board):
+        commands = []
+
+        try:
+            self.lock.acquire()
+
+            if board.init:
+                board.init = False
+                commands.append('')
+                if board.outputs:
+                    # iodir: 1 is input, 0 is output.  iomask: lines writeall may change
+                    commands.append('gpio iomask {0:02x}'.format(board.outputs))
+                    commands.append('gpio iodir {0:02x}'.format(GPIO_MASK & ~board.outputs))
+                    # Restore the outputs after a reconnect
+                    if not board.output_pending:
+                        board.output_pending = (board.output_value, board.outputs)
+
+            if board.output_pending:
+                board.sending = board.output_pending
+                board.sending_batches = board.output_batches
+                board.output_pending = None
+                board.output_batches = []
+                commands.append('gpio writeall {0:02x}'.format(board.sending[0]))
+            else:
+                board.sending = None
+                board.sending_batches = []
+        finally:
+            self.lock.release()
+
+        for channel in board.adc:
+            commands.append('adc read %d' % (channel))
+
+        commands.append('gpio readall')
+        return commands
+
+    # The board's writes didn't make it, put them back (under any newer
+    # ones) for when it is reconnected, and let the writers go
+    def _write_failed(self, board):
+        try:
+            self.lock.acquire()
+            if board.sending:
+                (value, mask) = board.sending
+                if board.output_pending:
+                    (newer_value, newer_mask) = board.output_pending
+                    value = (value & ~newer_mask) | (newer_value & newer_mask)
+                    mask |= newer_mask
+                board.output_pending = (value, mask)
+            board.init = True
+            batches = board.sending_batches + board.output_batches
+            board.sending = None
+            board.sending_batches = []
+            board.output_batches = []
+        finally:
+            self.lock.release()
+
+        for batch in batches:
+            batch.set()
+
+    def _written(self, board):
+        try:
+            self.lock.acquire()
+            if board.sending:
+                board.output_value = board.sending[0]
+                self.logger.debug("GPIO out {0}: {1:08b}".format(board.port, board.sending[0]))
+            batches = board.sending_batches
+            board.sending = None
+            board.sending_batches = []
+        finally:
+            self.lock.release()
+
+        for batch in batches:
+            batch.set()
+
+    def _disconnect(self, board, reason):
+        ERRORS.label(self.site, board.port).inc()
+        board.close(reason)
+        self._write_failed(board)
+
+        try:
+            self.lock.acquire()
+            for channel in board.adc:
+                if self.sensors[board.base + channel].reset():
+                    self.sensors_changed = True
+        finally:
+            self.lock.release()
+
+    # adc read responses, in board.adc order
+    def _read_sensors(self, board, results):
+        try:
+            self.lock.acquire()
+            for (channel, lines) in zip(board.adc, results):
+                try:
+                    raw = int(lines[0])
+                except (IndexError, ValueError):
+                    self.logger.warning("%s: bad adc read %d response %s" % (board.port, channel, lines))
                     continue
-                # Skip output command
-                if line == output:
+                if self.sensors[board.base + channel].update(raw):
+                    self.sensors_changed = True
+        finally:
+            self.lock.release()
+
+    # Reopen disconnected boards whose device node is back
+    def _reconnect(self):
+        now = time()
+        for board in self.boards:
+            if board.connected() or now < board.retry_at:
+                continue
+            if not os.path.exists(board.port):
+                continue
+            try:
+                board.open()
+                board.backoff = 0
+            except (serial.SerialException, OSError) as e:
+                board.close(e)
+
+    # Poll every connected board, returns the combined value, or None until
+    # every board has been read
+    def poll_gpio(self):
+        POLLS.label(self.site).inc()
+        self._reconnect()
+
+        waiting = {}    # fileno : board
+        for board in self.boards:
+            if not board.connected():
+                continue
+            try:
+                board.send(self._commands(board))
+                waiting[board.fileno()] = board
+            except (serial.SerialException, OSError) as e:
+                self._disconnect(board, e)
+
+        deadline = time() + self.response_timeout
+        while waiting:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            (readable, writable, errors) = select.select(waiting.keys(), [], [], remaining)
+            for fileno in readable:
+                board = waiting[fileno]
+                try:
+                    if not board.receive():
+                        continue
+                except (serial.SerialException, OSError) as e:
+                    del waiting[fileno]
+                    self._disconnect(board, e)
                     continue
-                # Skip prompt
-                if line == ">":
-                    prompt = True
-                    break
-                lines.append(line)
 
-            if not prompt:
-                raise exception("Input did not end with prompt")
+                del waiting[fileno]
+                board.timeouts = 0
+                results = board.responses()
+                self._written(board)
 
-            #self.logger.debug('line: "%s"' % lines)
-            return lines
+                self._read_sensors(board, results[-1 - len(board.adc):-1])
 
-        if self.init:
-            self.init = False
-            _write_read_gpio('')
+                lines = results[-1]
+                if len(lines) != 1:
+                    # Got unexpected data
+                    self.logger.warning("%s: expected one line of data: %s" % (board.port, lines))
+                try:
+                    board.value = int(lines[0], 16)
+                except (IndexError, ValueError):
+                    self.logger.warning("%s: bad readall response %s" % (board.port, lines))
 
-        lines = _write_read_gpio('gpio readall')
-        if len(lines) > 1:
-            # Got unexpected data
-            self.logger.warning("Got more then one line of data: %s" % lines)
+        # No (complete) response in time, give up on it after a few tries
+        for board in waiting.values():
+            board.timeouts += 1
+            self._write_failed(board)
+            if board.timeouts >= 3:
+                self._disconnect(board, "not responding")
 
-        return int(lines[0], 16)
+        value = 0x0
+        for board in self.boards:
+            if board.value is None:
+                return None
+            value |= board.value << board.base
+        return value
 
     # run the gpio API watcher.
     def run(self, wait_time=1):
+        for board in self.boards:
+            if board.connected():
+                self._disconnect(board, "restarting")
+            board.retry_at = 0
+
         last_gpio = self.getGpio()
         while True:
+            self.wakeup.clear()
+
             gpio = self.poll_gpio()
+            if gpio is None:
+                # Not every board has answered yet, or one was lost
+                if last_gpio is not None:
+                    try:
+                        self.lock.acquire()
+                        self.gpio = None
+                        self.gpio_time = time()
+                        last_gpio = None
+                    finally:
+                        self.lock.release()
+                        for event in self.events:
+                            event.set()
+                self.wakeup.wait(wait_time)
+                continue
+
+            try:
+                self.lock.acquire()
+                sensors_changed = self.sensors_changed
+                self.sensors_changed = False
+            finally:
+                self.lock.release()
+            if sensors_changed and gpio == last_gpio:
+                for event in self.events:
+                    event.set()
+
             if gpio != last_gpio:
+                if last_gpio is not None:
+                    EDGES.label(self.site).inc(bin(gpio ^ last_gpio).count('1'))
                 try:
                     #self.logger.debug("GPIO: %s" % gpio)
-                    self.logger.debug("GPIO: {0:08b}".format(gpio))
+                    self.logger.debug("GPIO: {0:0{1}b}".format(gpio, len(self.boards) * GPIO_WIDTH))
                     self.lock.acquire()
 
                     self.gpio = gpio
+                    self.gpio_time = time()
                     last_gpio = gpio
 
                 finally:
@@ -145,5 +525,7 @@ class Gpio():
                     for event in self.events:
                         event.set()
 
-            sleep(wait_time)
+            # Every board has been read, zones depending on GPIO can start
+            self.setReady()
 
+            self.wakeup.wait(wait_time)
@@ -0,0 +1,322 @@
+#! /usr/bin/env python
+#
+# Linux GPIO character device backend
+#
+# Reads the thermostat lines through /dev/gpiochipN (the v2 uAPI) instead
+# of polling a USB serial board.  The lines are requested with edge
+# detection, and we sleep in epoll until the kernel reports a change, so a
+# call for heat is seen as soon as it happens.  Changes carry the kernel's
+# timestamp of the edge.
+#
+# Same interface as Gpio, bit N of the value is lines[N] on the chip.  The
+# lines are requested with the realtime event clock, so the timestamps are
+# comparable with time().
+#
+# The ioctl and os.read calls are attributes, so the backend can be driven
+# by a stand-in fd without a chip.  On a real kernel the gpio-sim or
+# gpio-mockup modules provide a chip to test against.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+
+import fcntl
+import struct
+import select
+import os
+from time import time
+import threading
+import logging
+
+from readiness import Readiness
+import metrics
+
+EDGES = metrics.counter('gpio_edges_total', 'GPIO input lines that changed', [ 'site' ])
+
+# From <linux/gpio.h>
+GPIO_V2_LINES_MAX            = 64
+GPIO_MAX_NAME_SIZE           = 32
+GPIO_V2_LINE_NUM_ATTRS_MAX   = 10
+
+GPIO_V2_LINE_FLAG_INPUT      = 1 << 2
+GPIO_V2_LINE_FLAG_OUTPUT     = 1 << 3
+GPIO_V2_LINE_FLAG_EDGE_RISING  = 1 << 4
+GPIO_V2_LINE_FLAG_EDGE_FALLING = 1 << 5
+GPIO_V2_LINE_FLAG_BIAS_PULL_UP = 1 << 8
+GPIO_V2_LINE_FLAG_EVENT_CLOCK_REALTIME = 1 << 11
+
+GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES = 2
+GPIO_V2_LINE_ATTR_ID_DEBOUNCE      = 3
+
+GPIO_V2_LINE_EVENT_RISING_EDGE  = 1
+GPIO_V2_LINE_EVENT_FALLING_EDGE = 2
+
+# struct gpio_v2_line_config_attribute: attribute (id, padding, value) then mask
+LINE_CONFIG_ATTR = struct.Struct('=IIQQ')
+# struct gpio_v2_line_config: flags, num_attrs, padding[5], attrs[10]
+LINE_CONFIG_SIZE = 8 + 4 + 4 * 5 + LINE_CONFIG_ATTR.size * GPIO_V2_LINE_NUM_ATTRS_MAX
+# struct gpio_v2_line_request: offsets[64], consumer, config, num_lines,
+# event_buffer_size, padding[5], fd
+LINE_REQUEST_SIZE = 4 * GPIO_V2_LINES_MAX + GPIO_MAX_NAME_SIZE + LINE_CONFIG_SIZE + 4 + 4 + 4 * 5 + 4
+LINE_REQUEST_FD   = LINE_REQUEST_SIZE - 4
+# struct gpio_v2_line_values: bits, mask
+LINE_VALUES = struct.Struct('=QQ')
+# struct gpio_v2_line_event: timestamp_ns, id, offset, seqno, line_seqno, padding[6]
+LINE_EVENT  = struct.Struct('=QIIII24x')
+
+def _IOWR(type, nr, size):
+    return (3 << 30) | (size << 16) | (type << 8) | nr
+
+GPIO_V2_GET_LINE_IOCTL        = _IOWR(0xB4, 0x07, LINE_REQUEST_SIZE)
+GPIO_V2_LINE_GET_VALUES_IOCTL = _IOWR(0xB4, 0x0E, LINE_VALUES.size)
+GPIO_V2_LINE_SET_VALUES_IOCTL = _IOWR(0xB4, 0x0F, LINE_VALUES.size)
+
+def line_request(offsets, consumer, flags, attrs=[]):
+    config = struct.pack('=QI20x', flags, len(attrs))
+    for (id, value, mask) in attrs:
+        config += LINE_CONFIG_ATTR.pack(id, 0, value, mask)
+    config += '\0' * (LINE_CONFIG_SIZE - len(config))
+
+    return struct.pack('=%dI' % GPIO_V2_LINES_MAX, *(list(offsets) + [0] * (GPIO_V2_LINES_MAX - len(offsets)))) + \
+           struct.pack('=%ds' % GPIO_MAX_NAME_SIZE, consumer) + \
+           config + \
+           struct.pack('=II20xi', len(offsets), 0, 0)
+
+class GpioChip(Readiness):
+    # chip - i.e. /dev/gpiochip0
+    # lines - chip line offsets, bit N of the value is lines[N]
+    # outputs - bit mask of the lines driven by us, the rest are inputs
+    # debounce - microseconds an input must be stable (0 = no debounce)
+    # site - the site (house) the chip is in, '' if only one
+    def __init__(self, chip, lines, outputs=0x0, debounce=0, site=''):
+        self.logger = logging.getLogger('HVAC.GPIO')
+
+        Readiness.__init__(self, 'GPIO')
+
+        self.site = site
+        self.lock = metrics.TimedLock('gpio', site)   # Thread lock for the data
+
+        try:
+            self.lock.acquire()
+
+            self.gpio      = None	# Stored GPIO value
+            self.gpio_time = None	# Kernel timestamp of the last change
+
+            self.chip     = chip
+            self.lines    = list(lines)
+            self.outputs  = outputs
+            self.debounce = debounce
+
+            self.input_bits  = [ bit for bit in range(len(self.lines)) if not (outputs >> bit) & 1 ]
+            self.output_bits = [ bit for bit in range(len(self.lines)) if (outputs >> bit) & 1 ]
+
+            self.input_fd  = None
+            self.output_fd = None
+            self.output_value = 0x0
+
+            self.events = []   # Thread events when data is updated
+
+            self.ioctl = fcntl.ioctl
+            self.read  = os.read
+        finally:
+            self.lock.release()
+
+    def registerEvent(self, event):
+        if event not in self.events:
+            self.events.append(event)
+
+    def deregisterEvent(self, event):
+        if event in self.events:
+            self.events.remove(event)
+
+    def getGpio(self):
+        try:
+            self.lock.acquire()
+            # 0 is a valid reading (every line is being called for)
+            if self.gpio is not None:
+                return int(self.gpio)
+            else:
+                return None
+        finally:
+            self.lock.release()
+
+    # When the last change happened, as seconds since the epoch
+    def getGpioTime(self):
+        try:
+            self.lock.acquire()
+            return self.gpio_time
+        finally:
+            self.lock.release()
+
+    # No ADC on a gpiochip
+    def getTemperature(self, line):
+        return None
+
+    def getBoards(self):
+        return { self.chip : self.input_fd is not None }
+
+    def _request(self, chip_fd, bits, flags, attrs=[]):
+        offsets = [ self.lines[bit] for bit in bits ]
+        request = bytearray(line_request(offsets, 'hvac', flags, attrs))
+        self.ioctl(chip_fd, GPIO_V2_GET_LINE_IOCTL, request, True)
+        return struct.unpack_from('=i', request, LINE_REQUEST_FD)[0]
+
+    # Request values are by position in the request, map them to our bits
+    def _to_gpio(self, bits, values):
+        value = 0x0
+        for (index, bit) in enumerate(bits):
+            if (values >> index) & 1:
+                value |= 1 << bit
+        return value
+
+    def _from_gpio(self, bits, value):
+        values = 0x0
+        for (index, bit) in enumerate(bits):
+            if (value >> bit) & 1:
+                values |= 1 << index
+        return values
+
+    def open(self):
+        chip_fd = os.open(self.chip, os.O_RDWR)
+        try:
+            if self.input_bits:
+                flags = GPIO_V2_LINE_FLAG_INPUT | GPIO_V2_LINE_FLAG_BIAS_PULL_UP | \
+                        GPIO_V2_LINE_FLAG_EDGE_RISING | GPIO_V2_LINE_FLAG_EDGE_FALLING | \
+                        GPIO_V2_LINE_FLAG_EVENT_CLOCK_REALTIME
+                attrs = []
+                if self.debounce:
+                    attrs.append((GPIO_V2_LINE_ATTR_ID_DEBOUNCE, self.debounce, (1 << len(self.input_bits)) - 1))
+                self.input_fd = self._request(chip_fd, self.input_bits, flags, attrs)
+
+            if self.output_bits:
+                values = self._from_gpio(self.output_bits, self.output_value)
+                attrs = [ (GPIO_V2_LINE_ATTR_ID_OUTPUT_VALUES, values, (1 << len(self.output_bits)) - 1) ]
+                self.output_fd = self._request(chip_fd, self.output_bits, GPIO_V2_LINE_FLAG_OUTPUT, attrs)
+        finally:
+            os.close(chip_fd)
+
+        self.logger.info("%s: lines %s requested" % (self.chip, self.lines))
+
+    def close(self):
+        for fd in [ self.input_fd, self.output_fd ]:
+            if fd is not None:
+                os.close(fd)
+        self.input_fd = None
+        self.output_fd = None
+
+    # Set the output lines in mask to value, immediately
+    def write(self, value, mask, wait=True):
+        if mask & ~self.outputs:
+            raise ValueError("GPIO lines {0:b} are not outputs".format(mask & ~self.outputs))
+
+        try:
+            self.lock.acquire()
+
+            if self.output_fd is None:
+                # Applied when the lines are requested
+                self.output_value = (self.output_value & ~mask) | (value & mask)
+                return False
+
+            values = bytearray(LINE_VALUES.pack(self._from_gpio(self.output_bits, value),
+                                                self._from_gpio(self.output_bits, mask)))
+            self.ioctl(self.output_fd, GPIO_V2_LINE_SET_VALUES_IOCTL, values, True)
+            self.output_value = (self.output_value & ~mask) | (value & mask)
+            self.logger.debug("GPIO out: {0:b}".format(self.output_value))
+            return True
+        finally:
+            self.lock.release()
+
+    def getOutputs(self):
+        try:
+            self.lock.acquire()
+            return self.output_value
+        finally:
+            self.lock.release()
+
+    def _notify(self):
+        for event in self.events:
+            event.set()
+
+    def _read_values(self):
+        values = bytearray(LINE_VALUES.pack(0, (1 << len(self.input_bits)) - 1))
+        self.ioctl(self.input_fd, GPIO_V2_LINE_GET_VALUES_IOCTL, values, True)
+        (bits, mask) = LINE_VALUES.unpack(str(values))
+        return self._to_gpio(self.input_bits, bits)
+
+    # Apply edge events, returns True if the value changed
+    def _read_events(self):
+        data = self.read(self.input_fd, LINE_EVENT.size * 16)
+        if not data:
+            raise IOError("%s: line request closed" % (self.chip))
+
+        changed = False
+        try:
+            self.lock.acquire()
+            for index in range(len(data) // LINE_EVENT.size):
+                (timestamp, id, offset, seqno, line_seqno) = LINE_EVENT.unpack_from(data, index * LINE_EVENT.size)
+                bit = self.lines.index(offset)
+                if id == GPIO_V2_LINE_EVENT_RISING_EDGE:
+                    value = self.gpio | (1 << bit)
+                else:
+                    value = self.gpio & ~(1 << bit)
+                if value != self.gpio:
+                    EDGES.label(self.site).inc()
+                    self.gpio = value
+                    self.gpio_time = timestamp / 1e9
+                    changed = True
+            if changed:
+                self.logger.debug("GPIO: {0:0{1}b}".format(self.gpio, len(self.lines)))
+        finally:
+            self.lock.release()
+
+        return changed
+
+    def run(self):
+        self.close()
+        self.open()
+
+        try:
+            if not self.input_bits:
+                # Only driving relays
+                self.setReady()
+                while True:
+                    threading.Event().wait(3600)
+
+            poller = select.epoll()
+            poller.register(self.input_fd, select.EPOLLIN | select.EPOLLPRI)
+
+            try:
+                self.lock.acquire()
+                self.gpio = self._read_values()
+                self.gpio_time = time()
+            finally:
+                self.lock.release()
+            self.logger.debug("GPIO: {0:0{1}b}".format(self.gpio, len(self.lines)))
+            self._notify()
+
+            # First complete read, zones depending on GPIO can start
+            self.setReady()
+
+            while True:
+                for (fd, mask) in poller.poll():
+                    if self._read_events():
+                        self._notify()
+        finally:
+            self.close()
@@ -23,75 +23,391 @@
 #    with this program; if not, write to the Free Software Foundation, Inc.,
 #    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import urllib2
-from time import sleep
+import httplib
+import socket
+import urlparse
+import heapq
+from time import sleep, time
 import threading
 import os
 import stat
 import logging
 
-class IFTTT():
-    def __init__(self, token):
+from readiness import Readiness
+from ratelimit import TokenBucket
+from breaker import CircuitBreaker
+import metrics
+from profiler import span
+
+SENT     = metrics.counter('webhook_sent_total', 'Webhook actions the endpoint accepted', [ 'site' ])
+FAILED   = metrics.counter('webhook_failed_total', 'Webhook actions that could not be sent and were parked', [ 'site' ])
+RETRIED  = metrics.counter('webhook_retries_total', 'Webhook requests retried', [ 'site' ])
+ACKED    = metrics.counter('webhook_acknowledged_total', 'Webhook actions confirmed by the device', [ 'site' ])
+ACK_TIME = metrics.histogram('webhook_ack_latency_seconds', 'Time from sending an action to its confirmation', [ 'site' ])
+QUEUED   = metrics.gauge('webhook_queue_depth', 'Webhook actions waiting to be sent', [ 'site' ])
+PARKED   = metrics.gauge('webhook_parked', 'Webhook actions parked until their endpoint recovers', [ 'site' ])
+
+# Outbound action priorities, lower goes first
+PRIORITY_SAFETY   = 0   # Turning heat or A/C off
+PRIORITY_CONTROL  = 1   # Turning things on, changing modes
+PRIORITY_SETTING  = 2   # Set temperatures
+PRIORITY_COSMETIC = 3   # Fan speed
+
+class IFTTT(Readiness):
+    # rate/burst - token bucket (requests per second) for each endpoint
+    # connect_timeout/read_timeout - seconds before a request is abandoned
+    # attempts - tries per action, the retries also come out of a per
+    #            endpoint budget of retry_rate per second (retry_burst at once)
+    # threshold/reset_timeout - consecutive failed actions before an
+    #            endpoint's circuit opens, and how long it stays open
+    # site - the site (house) the account is for, '' if only one
+    def __init__(self, token, url="https://maker.ifttt.com/trigger/%s/with/key/{0}", rate=1, burst=5, connect_timeout=5, read_timeout=10,
+                 attempts=3, retry_rate=0.1, retry_burst=3, threshold=3, reset_timeout=60, site=''):
         self.logger = logging.getLogger('HVAC.IFTTT')
 
-        self.lock = threading.Lock()
+        Readiness.__init__(self, 'IFTTT')
+
+        self.site = site
+        self.lock = metrics.TimedLock('ifttt', site)
 
         try:
             self.lock.acquire()
 
             self.ifttt_token = token
-            self.ifttt_url   = "https://maker.ifttt.com/trigger/%s/with/key/{0}".format(self.ifttt_token)
+            self.ifttt_url   = url.format(self.ifttt_token)
             self.ifttt_actions = {}     # action : retry_timeout [if not acknowledged]
+            self.sent_time     = {}     # action : time sent [if not acknowledged]
+
+            self.rate      = rate
+            self.burst     = burst
+            self.buckets   = {}     # endpoint : TokenBucket
+
+            self.connect_timeout = connect_timeout
+            self.read_timeout    = read_timeout
+            self.attempts        = attempts
+            self.retry_rate      = retry_rate
+            self.retry_burst     = retry_burst
+            self.threshold       = threshold
+            self.reset_timeout   = reset_timeout
+            self.retry_budgets   = {}   # endpoint : TokenBucket
+            self.breakers        = {}   # endpoint : CircuitBreaker
+            self.parked          = {}   # endpoint : { action : (sequence, retry, priority) }
+
+            self.queue     = []     # heap of (priority, sequence, request)
+            self.queued    = {}     # action : request (not yet sent)
+            self.sequence  = 0      # keeps the queue FIFO within a priority
+            self.throttled = 0.0    # Seconds the senders waited on the rate limit
+
+            self.events = []   # Thread events when the queue or pending actions change
 
         finally:
             self.lock.release()
 
-    # retry of 0 means don't retry, otherwise it's the number of seconds to
-    # wait for a confirmation (via the named pipe/fifo)
-    def send_action(self, action, retry=0):
-        def _http_request(action):
-            while True:
+        self.queue_ready = threading.Condition(self.lock)
+
+        # Set as the queue changes, so a scrape never waits for our lock
+        self.queued_gauge = QUEUED.label(site)
+        self.parked_gauge = PARKED.label(site)
+
+    def registerEvent(self, event):
+        if event not in self.events:
+            self.events.append(event)
+
+    def deregisterEvent(self, event):
+        if event in self.events:
+            self.events.remove(event)
+
+    def _notify(self):
+        for event in self.events:
+            event.set()
+
+    def _endpoint(self, action):
+        return urlparse.urlparse(self.ifttt_url % (action)).netloc
+
+    # Per endpoint state, called with the lock held
+    def _bucket(self, endpoint):
+        if endpoint not in self.buckets:
+            self.buckets[endpoint] = TokenBucket(self.rate, self.burst)
+        return self.buckets[endpoint]
+
+    def _retry_budget(self, endpoint):
+        if endpoint not in self.retry_budgets:
+            self.retry_budgets[endpoint] = TokenBucket(self.retry_rate, self.retry_burst)
+        return self.retry_budgets[endpoint]
+
+    def _breaker(self, endpoint):
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker(endpoint, self.threshold, self.reset_timeout)
+        return self.breakers[endpoint]
+
+    def _http_get(self, url):
+        parts = urlparse.urlparse(url)
+        path = parts.path
+        if parts.query:
+            path += '?' + parts.query
+
+        if parts.scheme == 'https':
+            conn = httplib.HTTPSConnection(parts.netloc, timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(parts.netloc, timeout=self.connect_timeout)
+
+        try:
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+            conn.request('GET', path)
+            res = conn.getresponse()
+            return (res.status, res.reason, res.read())
+        finally:
+            conn.close()
+
+    # Returns True if the endpoint answered, False if it could not be reached
+    # (or had a server error) within the attempts and retry budget.
+    @span('IFTTT.request')
+    def _http_request(self, action, endpoint):
+        url = self.ifttt_url % (action)
+
+        for attempt in range(self.attempts):
+            if attempt:
                 try:
-                    #self.logger.info("Trying URL: %s" % (self.ifttt_url % (action)))
-                    res = urllib2.urlopen(urllib2.Request(self.ifttt_url % (action)))
-                    self.logger.debug("result: %s" % res.read())
-                    self.logger.info("Success: %s" % (action))
+                    self.lock.acquire()
+                    budget = self._retry_budget(endpoint).take()
+                finally:
+                    self.lock.release()
+                if not budget:
+                    self.logger.warning('Retry budget for %s exhausted, giving up on %s' % (endpoint, action))
                     break
-                except urllib2.HTTPError as e:
-                    self.logger.error("HTTP Error: %s: %s" % (e.code, e.reason))
-                    self.logger.debug(" Requested: %s" % (self.ifttt_url % (action)))
-                    self.logger.debug(" Actual:    %s" % (e.geturl()))
-                    sleep(5)
-                    self.logger.info('Retry request %s' % action)
-                except urllib2.URLError as e:
-                    self.logger.error('URLError: %s %s' % (self.ifttt_url % (action), e))
-                    sleep(5)
-                    self.logger.info('Retry request %s' % action)
-                except urllib2.BadStatusLine as e:
-                    self.logger.error('BadStatusLine: %s %s' % (self.ifttt_url % (action), e))
-                    sleep(5)
-                    self.logger.info('Retry request %s' % action)
-
-            return res
-
-        self.logger.info("Sending ifttt %s" % action)
+                sleep(attempt)
+                self.logger.info('Retry request %s' % action)
+                RETRIED.label(self.site).inc()
+
+            try:
+                (status, reason, body) = self._http_get(url)
+            except (socket.error, httplib.HTTPException) as e:
+                self.logger.error('%s: %s %s' % (type(e).__name__, url, e))
+                continue
+
+            if status >= 500:
+                self.logger.error("HTTP Error: %s: %s" % (status, reason))
+                continue
+
+            self.logger.debug("result: %s" % body)
+            if status >= 400:
+                # The service is up, but didn't like the request, retrying won't help
+                self.logger.error("HTTP Error: %s: %s" % (status, reason))
+                self.logger.debug(" Requested: %s" % (url))
+            else:
+                self.logger.info("Success: %s" % (action))
+            return True
+
+        return False
+
+    # Called with the lock held, whenever queued or parked change
+    def _update_gauges(self):
+        self.queued_gauge.set(len(self.queued))
+        self.parked_gauge.set(sum([len(parked) for parked in self.parked.values()]))
+
+    # Hold on to an action until its endpoint's circuit closes again, only
+    # the most recent request for each action is kept
+    def _park(self, request, endpoint):
+        FAILED.label(self.site).inc()
+        try:
+            self.lock.acquire()
+            self.sequence += 1
+            self.parked.setdefault(endpoint, {})[request['action']] = (self.sequence, request['retry'], request['priority'])
+            self._update_gauges()
+            self.logger.info("Parked ifttt %s (%s unavailable)" % (request['action'], endpoint))
+        finally:
+            self.lock.release()
 
+    # Resend parked actions in the order they were originally requested
+    def _replay_parked(self, endpoint):
         try:
             self.lock.acquire()
-            if action in self.ifttt_actions:
-                del self.ifttt_actions[action]
+            parked = self.parked.pop(endpoint, {})
+            self._update_gauges()
         finally:
             self.lock.release()
 
-        res = _http_request(action)
+        if not parked:
+            return
+
+        self.logger.info("Replaying %d parked actions for %s" % (len(parked), endpoint))
+
+        def replay():
+            for action in sorted(parked, key=lambda action: parked[action][0]):
+                (sequence, retry, priority) = parked[action]
+                self.send_action(action, retry, priority)
+
+        thread = threading.Thread(target=replay, name='IFTTT Replay')
+        thread.daemon = True
+        thread.start()
+
+    # retry of 0 means don't retry, otherwise it's the number of seconds to
+    # wait for a confirmation (via the named pipe/fifo)
+    #
+    # Actions are queued by priority and sent by the dispatch() workers.  If
+    # wait is set, we return once the action has been sent, or parked for
+    # later because the endpoint is unavailable.
+    @span('IFTTT.send_action')
+    def send_action(self, action, retry=0, priority=PRIORITY_CONTROL, wait=True):
+        try:
+            self.lock.acquire()
+
+            # Already queued, just make sure it goes out soon enough
+            request = self.queued.get(action)
+            if request:
+                request['retry'] = max(request['retry'], retry)
+                if priority < request['priority']:
+                    request['priority'] = priority
+                    self.sequence += 1
+                    heapq.heappush(self.queue, (priority, self.sequence, request))
+            else:
+                self.logger.info("Queueing ifttt %s" % action)
+                request = { 'action'   : action,
+                            'retry'    : retry,
+                            'priority' : priority,
+                            'queued'   : time(),
+                            'sent'     : threading.Event() }
+                self.queued[action] = request
+                self._update_gauges()
+                self.sequence += 1
+                heapq.heappush(self.queue, (priority, self.sequence, request))
+                self.queue_ready.notify()
+        finally:
+            self.lock.release()
+
+        self._notify()
+
+        if wait:
+            request['sent'].wait()
+
+    # Wait for the highest priority request that the rate limit allows
+    def _next_request(self):
+        try:
+            self.lock.acquire()
+
+            while True:
+                # Drop stale heap entries (request re-queued at a higher priority)
+                while self.queue and (self.queue[0][2]['priority'] != self.queue[0][0] or
+                                      self.queued.get(self.queue[0][2]['action']) is not self.queue[0][2]):
+                    heapq.heappop(self.queue)
+
+                if not self.queue:
+                    self.queue_ready.wait()
+                    continue
+
+                request = self.queue[0][2]
+                bucket = self._bucket(self._endpoint(request['action']))
+                delay = bucket.delay()
+                if delay > 0 or not bucket.take():
+                    # Throttled, a higher priority request may arrive meanwhile
+                    start = time()
+                    self.queue_ready.wait(max(delay, 0.01))
+                    self.throttled += time() - start
+                    continue
+
+                heapq.heappop(self.queue)
+                del self.queued[request['action']]
+                self._update_gauges()
+                return request
+        finally:
+            self.lock.release()
+
+    # Worker sending the queued actions
+    def dispatch(self):
+        while True:
+            request = self._next_request()
+            action = request['action']
+            endpoint = self._endpoint(action)
+
+            try:
+                self.lock.acquire()
+                breaker = self._breaker(endpoint)
+            finally:
+                self.lock.release()
+
+            # Fail fast while the endpoint is unhealthy
+            if not breaker.allow():
+                self._park(request, endpoint)
+                request['sent'].set()
+                self._notify()
+                continue
+
+            self.logger.info("Sending ifttt %s (queued %.2fs)" % (action, time() - request['queued']))
 
-        if retry > 0:
             try:
                 self.lock.acquire()
-                self.ifttt_actions[action] = retry
+                if action in self.ifttt_actions:
+                    del self.ifttt_actions[action]
             finally:
                 self.lock.release()
-        sleep(1)
+
+            try:
+                if not self._http_request(action, endpoint):
+                    breaker.failure()
+                    self._park(request, endpoint)
+                    continue
+                SENT.label(self.site).inc()
+
+                if request['retry'] > 0:
+                    try:
+                        self.lock.acquire()
+                        self.ifttt_actions[action] = request['retry']
+                        self.sent_time[action] = time()
+                    finally:
+                        self.lock.release()
+
+                breaker.success()
+                self._replay_parked(endpoint)
+            finally:
+                request['sent'].set()
+                self._notify()
+
+    # An action was confirmed by the device (via the cgi-bin fifo or the
+    # status server)
+    def acknowledge(self, action):
+        self.logger.debug("Clear action: %s" % action)
+        try:
+            self.lock.acquire()
+            if action not in self.ifttt_actions:
+                return
+            del self.ifttt_actions[action]
+            sent = self.sent_time.pop(action, None)
+        finally:
+            self.lock.release()
+
+        ACKED.label(self.site).inc()
+        if sent:
+            ACK_TIME.label(self.site).observe(time() - sent)
+
+        self._notify()
+
+    # Actions sent and waiting for a confirmation, action : retry seconds
+    def getPending(self):
+        try:
+            self.lock.acquire()
+            return dict(self.ifttt_actions)
+        finally:
+            self.lock.release()
+
+    # Queue depth (total and by priority), time spent throttled, parked
+    # actions and the state of each endpoint's circuit
+    def getQueueStats(self):
+        try:
+            self.lock.acquire()
+            depth = {}
+            for request in self.queued.values():
+                depth[request['priority']] = depth.get(request['priority'], 0) + 1
+            circuits = {}
+            for endpoint in self.breakers:
+                circuits[endpoint] = self.breakers[endpoint].getState()
+            return { 'depth'       : len(self.queued),
+                     'by_priority' : depth,
+                     'throttled'   : self.throttled,
+                     'parked'      : sum([len(parked) for parked in self.parked.values()]),
+                     'circuits'    : circuits }
+        finally:
+            self.lock.release()
 
     def run(self, wait_time=10, pipe_name='/var/www/cgi-bin/hvac-fifo'):
         if not os.path.exists(pipe_name):
@@ -101,19 +417,33 @@ class IFTTT():
 
         fifo = os.open(pipe_name, os.O_RDONLY | os.O_NONBLOCK)
 
+        # Acknowledgement channel is open
+        self.setReady()
+
         while True:
             while True:
-                action = os.read(fifo, 256).strip()
-                if len(action) == 0:
+                actions = os.read(fifo, 256).strip()
+                if len(actions) == 0:
                     break
 
-                self.logger.debug("Clear action: %s" % action)
-                try:
-                    self.lock.acquire()
-                    if action in self.ifttt_actions:
-                        del self.ifttt_actions[action]
-                finally:
-                    self.lock.release()
+                for action in actions.split():
+                    self.acknowledge(action)
+
+            stats = self.getQueueStats()
+            if stats['depth'] or stats['parked']:
+                self.logger.debug("Queue depth %d %s, throttled %.1fs, parked %d" % (stats['depth'], stats['by_priority'], stats['throttled'], stats['parked']))
+
+            # Nothing else may be sent to a parked endpoint, so try it again
+            # once its circuit is ready for a trial
+            try:
+                self.lock.acquire()
+                endpoints = [endpoint for endpoint in self.parked if self.parked[endpoint]]
+                breakers = [self._breaker(endpoint) for endpoint in endpoints]
+            finally:
+                self.lock.release()
+            for (endpoint, breaker) in zip(endpoints, breakers):
+                if breaker.ready():
+                    self._replay_parked(endpoint)
 
             if self.ifttt_actions:
                  self.logger.debug("Action list:")
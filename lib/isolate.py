@@ -0,0 +1,613 @@
+# Worker process isolation
+#
+# Optionally the Nest, GPIO and IFTTT workers each run in a process of
+# their own, so a hung read or a leak in one of them can't stall or grow the
+# rest of the daemon, and each gets a core (and interpreter lock) to itself.
+#
+# A worker publishes its state into a fixed size shared memory segment,
+# which the zones read directly through a view with the same interface as
+# the worker object.  The segment is guarded by a sequence lock: the writer
+# makes the sequence odd while it is updating, and a reader retries if the
+# sequence was odd or changed while it read.  Readers never block the
+# writer.  A state too big for its segment is published as not ready.
+#
+# Changes are announced, and calls that have to reach the worker (sending an
+# action, writing relays) are made, over a pipe to the process.  The
+# process's metrics are fetched over the same pipe, for the status server.
+#
+# If a worker process dies its supervisor thread returns, and hvac.py
+# restarts it like any other worker, building a fresh worker object in the
+# new process.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import multiprocessing
+import ctypes
+import ctypes.util
+import signal
+import struct
+import mmap
+import json
+import os
+from time import sleep, time
+import threading
+import logging
+
+import metrics
+import ifttt
+
+# sequence, length of the data, time written
+HEADER = struct.Struct('<QId')
+
+class Segment():
+    # size - bytes available for the data
+    def __init__(self, size):
+        self.size = size
+        # Anonymous maps are shared with the processes forked from us
+        self.map = mmap.mmap(-1, HEADER.size + size)
+
+    # Only ever called from the worker process, by one thread.  The sequence
+    # is odd while writing.  It is forced odd, rather then incremented, so a
+    # writer that died part way through can't leave the parity inverted.
+    def write(self, data):
+        if len(data) > self.size:
+            raise ValueError("%d bytes does not fit in a %d byte segment" % (len(data), self.size))
+
+        (sequence, length, written) = HEADER.unpack_from(self.map, 0)
+        sequence = (sequence + 1) | 1
+        HEADER.pack_into(self.map, 0, sequence, length, written)
+        self.map[HEADER.size:HEADER.size + len(data)] = data
+        HEADER.pack_into(self.map, 0, sequence + 1, len(data), time())
+
+    # Forget the data, a new worker process is about to publish its own.
+    # Only called while no worker process is running.
+    def clear(self):
+        sequence = HEADER.unpack_from(self.map, 0)[0]
+        HEADER.pack_into(self.map, 0, (sequence | 1) + 1, 0, 0)
+
+    # Returns (sequence, function(map, offset, length)) of a consistent copy
+    # of the segment, or (sequence, None) if there is no data, or it didn't
+    # hold still for retries attempts.  The function works on the shared map
+    # directly, so it must not keep references into it.
+    def read_version(self, function, retries=1000):
+        for attempt in range(retries):
+            (sequence, length, written) = HEADER.unpack_from(self.map, 0)
+            if sequence == 0 or (not sequence & 1 and length == 0):
+                return (sequence, None)
+            if not sequence & 1:
+                try:
+                    result = function(self.map, HEADER.size, length)
+                except Exception:
+                    # Only an error if it wasn't from a write getting in the way
+                    if HEADER.unpack_from(self.map, 0)[0] == sequence:
+                        raise
+                    continue
+                if HEADER.unpack_from(self.map, 0)[0] == sequence:
+                    return (sequence, result)
+            # A write is in progress
+            sleep(0 if attempt < 10 else 0.001)
+        return (sequence, None)
+
+    def read(self, function, retries=1000):
+        return self.read_version(function, retries)[1]
+
+    def getSequence(self):
+        return HEADER.unpack_from(self.map, 0)[0]
+
+# Decodes a segment once for each write, the views' accessors share the
+# result until the worker publishes again.  What get() returns is shared by
+# every caller, so it must not be changed.
+class Decoded():
+    def __init__(self, segment, function):
+        self.segment  = segment
+        self.function = function
+        self.cached   = (None, None)   # (sequence, decoded), replaced as a whole
+
+    def get(self):
+        cached = self.cached
+        if cached[0] is not None and cached[0] == self.segment.getSequence():
+            return cached[1]
+        (sequence, decoded) = self.segment.read_version(self.function)
+        if decoded is not None:
+            self.cached = (sequence, decoded)
+        return decoded
+
+def _read_json(buf, offset, length):
+    return json.loads(buf[offset:offset + length])
+
+def set_affinity(cpu):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    mask = ctypes.c_ulong(1 << cpu)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+class Worker():
+    # name - used for the process and in the logs
+    # factory - builds the worker object, called in the new process
+    # threads - threads(obj) returns the (name, target, args) to run there
+    # encode - encode(obj) returns the data to publish in segment
+    # overflow - published instead, when that doesn't fit.  It must not be
+    #            ready, so nothing acts on the last state that did.
+    # cpu - core to pin the process to, or None
+    def __init__(self, name, factory, threads, encode, segment, overflow, cpu=None):
+        self.logger = logging.getLogger('HVAC.Isolate')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.name    = name
+            self.factory = factory
+            self.threads = threads
+            self.encode  = encode
+            self.segment = segment
+            self.overflow = overflow
+            self.cpu     = cpu
+
+            self.conn    = None     # Pipe to the running process
+            self.calls   = {}       # call id : [ event, result ]
+            self.call_id = 0
+            self.pid     = None
+            self.events  = []
+        finally:
+            self.lock.release()
+
+    def registerEvent(self, event):
+        if event not in self.events:
+            self.events.append(event)
+
+    def deregisterEvent(self, event):
+        if event in self.events:
+            self.events.remove(event)
+
+    def _notify(self):
+        for event in self.events:
+            event.set()
+
+    # Send (kind, call id, args...) to the worker process, and wait for the
+    # reply.  Returns default if the process isn't running, or stops before
+    # answering.
+    def _request(self, kind, args, default):
+        event = threading.Event()
+        try:
+            self.lock.acquire()
+            if not self.conn:
+                return default
+            self.call_id += 1
+            call_id = self.call_id
+            self.calls[call_id] = [ event, default ]
+            self.conn.send((kind, call_id) + args)
+        finally:
+            self.lock.release()
+
+        event.wait()
+
+        try:
+            self.lock.acquire()
+            result = self.calls.pop(call_id)[1]
+        finally:
+            self.lock.release()
+
+        return result
+
+    # Call obj.method(*args) in the worker process
+    def call(self, method, args=(), default=None):
+        result = self._request('call', (method, args), default)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    # The process's metrics.REGISTRY.collect(), [] if it isn't running
+    def getMetrics(self):
+        return self._request('metrics', (), [])
+
+    def getPid(self):
+        return self.pid
+
+    # Forking while another thread holds one of these locks would leave it
+    # held, forever, in the child.  So they are taken around the fork, and
+    # released again on both sides.
+    def _fork_locks(self):
+        locks = [ handler.lock for handler in logging.getLogger('HVAC').handlers + logging.getLogger().handlers
+                  if handler.lock ]
+        return locks + [ metrics.REGISTRY.lock ]
+
+    def _acquire_fork_locks(self, locks):
+        logging._acquireLock()
+        for lock in locks:
+            lock.acquire()
+
+    def _release_fork_locks(self, locks):
+        for lock in reversed(locks):
+            lock.release()
+        logging._releaseLock()
+
+    # Runs the process until it stops, as a thread of the supervisor
+    def run(self):
+        # The last process may have stopped part way through a write
+        self.segment.clear()
+
+        locks = self._fork_locks()
+
+        (conn, child_conn) = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=self._child, args=(child_conn, locks, os.getpid()), name=self.name)
+        process.daemon = True
+
+        self._acquire_fork_locks(locks)
+        try:
+            process.start()
+        finally:
+            self._release_fork_locks(locks)
+        child_conn.close()
+
+        try:
+            self.lock.acquire()
+            self.conn = conn
+            self.pid  = process.pid
+        finally:
+            self.lock.release()
+
+        self.logger.info("%s worker process %d started" % (self.name, process.pid))
+
+        try:
+            while process.is_alive():
+                if not conn.poll(1):
+                    continue
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    break
+
+                if message[0] == 'notify':
+                    self._notify()
+                elif message[0] == 'reply':
+                    (call_id, result) = message[1:]
+                    try:
+                        self.lock.acquire()
+                        if call_id in self.calls:
+                            self.calls[call_id][1] = result
+                            self.calls[call_id][0].set()
+                    finally:
+                        self.lock.release()
+        finally:
+            try:
+                self.lock.acquire()
+                self.conn = None
+                self.pid  = None
+                # Nobody is going to answer these now
+                for (event, result) in self.calls.values():
+                    event.set()
+            finally:
+                self.lock.release()
+
+            if process.is_alive():
+                process.terminate()
+            process.join()
+            conn.close()
+
+        self.logger.error("%s worker process %d stopped (exit code %s)" % (self.name, process.pid, process.exitcode))
+
+    # Everything below runs in the worker process
+
+    def _send(self, conn, message):
+        try:
+            self.send_lock.acquire()
+            conn.send(message)
+        finally:
+            self.send_lock.release()
+
+    # Exit, but not part way through publishing (the segment would be left
+    # mid-write), unless the publisher is stuck
+    def _exit(self, code):
+        end = time() + 5
+        while not self.publish_lock.acquire(False) and time() < end:
+            sleep(0.01)
+        os._exit(code)
+
+    def _child(self, conn, locks, parent):
+        self._release_fork_locks(locks)
+
+        # The signals are for the parent's profiler and configuration
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        self.send_lock = threading.Lock()
+        self.publish_lock = threading.Lock()
+        self.published = None
+
+        # The parent reports its own
+        metrics.REGISTRY.reset()
+
+        if self.cpu is not None:
+            try:
+                set_affinity(self.cpu)
+            except OSError as e:
+                self.logger.error("%s: unable to use cpu %d: %s" % (self.name, self.cpu, e))
+
+        obj = self.factory()
+
+        threads = []
+        for (name, target, args) in self.threads(obj) + [ ('%s Publish' % (self.name), self._publish, (obj, conn)) ]:
+            thread = threading.Thread(target=target, args=args, name=name)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        while True:
+            # Other workers may hold a copy of our end of the pipe, so it
+            # doesn't always close with the parent
+            if os.getppid() != parent:
+                self._exit(0)
+
+            for thread in threads:
+                if not thread.isAlive():
+                    self.logger.error("%s: %s Thread failed, restarting the process" % (self.name, thread.name))
+                    self._exit(1)
+
+            try:
+                if not conn.poll(1):
+                    continue
+                message = conn.recv()
+            except (EOFError, IOError):
+                # The parent has gone away
+                self._exit(0)
+
+            if message[0] == 'call':
+                thread = threading.Thread(target=self._call, args=(obj, conn) + message[1:])
+                thread.daemon = True
+                thread.start()
+            elif message[0] == 'metrics':
+                self._send(conn, ('reply', message[1], metrics.REGISTRY.collect()))
+
+    def _call(self, obj, conn, call_id, method, args):
+        try:
+            result = getattr(obj, method)(*args)
+        except Exception as e:
+            result = e
+        # So the caller sees the effect of the call once it returns
+        self._publish_state(obj, conn)
+        self._send(conn, ('reply', call_id, result))
+
+    def _publish_state(self, obj, conn):
+        try:
+            self.publish_lock.acquire()
+            data = self.encode(obj)
+            if len(data) > self.segment.size:
+                if self.published != self.overflow:
+                    self.logger.error("%s: %d bytes of state does not fit in a %d byte segment, publishing not ready" %
+                                      (self.name, len(data), self.segment.size))
+                data = self.overflow
+            if data == self.published:
+                return
+            self.segment.write(data)
+            self.published = data
+        except ValueError as e:
+            self.logger.error("%s: unable to publish: %s" % (self.name, e))
+            return
+        finally:
+            self.publish_lock.release()
+        self._send(conn, ('notify',))
+
+    # Publish the worker's state whenever it changes (and at least check
+    # every second, for changes that aren't announced, like readiness)
+    def _publish(self, obj, conn):
+        event = threading.Event()
+        obj.registerEvent(event)
+
+        while True:
+            self._publish_state(obj, conn)
+            event.wait(1)
+            event.clear()
+
+# Common parts of the views, which stand in for the worker objects
+class View():
+    def __init__(self, worker):
+        self.worker = worker
+
+    def registerEvent(self, event):
+        self.worker.registerEvent(event)
+
+    def deregisterEvent(self, event):
+        self.worker.deregisterEvent(event)
+
+    # Returns True if ready, False if the timeout expired first
+    def waitReady(self, timeout=None):
+        event = threading.Event()
+        self.registerEvent(event)
+        try:
+            end = None
+            if timeout is not None:
+                end = time() + timeout
+            while not self.isReady():
+                if end is None:
+                    event.wait()
+                else:
+                    remaining = end - time()
+                    if remaining <= 0:
+                        return False
+                    event.wait(remaining)
+                event.clear()
+            return True
+        finally:
+            self.deregisterEvent(event)
+
+    def getMetrics(self):
+        return self.worker.getMetrics()
+
+    def run(self):
+        self.worker.run()
+
+# ready, value is set, value, outputs, time of the last change
+GPIO_STATE = struct.Struct('<BBQQd')
+
+class GpioView(View):
+    # lines - number of GPIO lines, the temperatures of each are published
+    def __init__(self, factory, lines, cpu=None, size=4096):
+        self.lines = lines
+        self.temperatures = struct.Struct('<%dd' % (lines))
+        overflow = (GPIO_STATE.pack(False, False, 0, 0, float('nan')) +
+                    self.temperatures.pack(*[ float('nan') ] * lines) + json.dumps({}))
+        View.__init__(self, Worker('GPIO', factory, lambda gpio: [ ('GPIO', gpio.run, ()) ],
+                                   self.encode, Segment(size), overflow, cpu))
+
+    # Fixed layout: GPIO_STATE, a temperature (NaN for none) per line, then
+    # the boards as JSON
+    def encode(self, gpio):
+        value = gpio.getGpio()
+        temperatures = []
+        for line in range(self.lines):
+            temperature = gpio.getTemperature(line)
+            if temperature is None:
+                temperature = float('nan')
+            temperatures.append(temperature)
+        gpio_time = gpio.getGpioTime()
+        if gpio_time is None:
+            gpio_time = float('nan')
+        return (GPIO_STATE.pack(gpio.isReady(), value is not None, value or 0, gpio.getOutputs(), gpio_time) +
+                self.temperatures.pack(*temperatures) + json.dumps(gpio.getBoards()))
+
+    def _state(self):
+        return self.worker.segment.read(lambda buf, offset, length: GPIO_STATE.unpack_from(buf, offset))
+
+    def isReady(self):
+        state = self._state()
+        return bool(state and state[0])
+
+    def getGpio(self):
+        state = self._state()
+        if not state or not state[1]:
+            return None
+        return int(state[2])
+
+    def getOutputs(self):
+        state = self._state()
+        if not state:
+            return 0x0
+        return int(state[3])
+
+    def getGpioTime(self):
+        state = self._state()
+        if not state or state[4] != state[4]:
+            return None
+        return state[4]
+
+    def getTemperature(self, line):
+        if line < 0 or line >= self.lines:
+            return None
+        offset = GPIO_STATE.size + line * 8
+        temperature = self.worker.segment.read(lambda buf, start, length: struct.unpack_from('<d', buf, start + offset)[0])
+        if temperature is None or temperature != temperature:
+            return None
+        return temperature
+
+    def getBoards(self):
+        start = GPIO_STATE.size + self.temperatures.size
+        return self.worker.segment.read(lambda buf, offset, length: json.loads(buf[offset + start:offset + length])) or {}
+
+    def write(self, value, mask, wait=True):
+        return self.worker.call('write', (value, mask, wait), False)
+
+# Published by the JSON views when their state doesn't fit
+OVERFLOW = json.dumps({ 'ready' : False, 'overflow' : True })
+
+def _read_nest(buf, offset, length):
+    state = _read_json(buf, offset, length)
+    thermostats = state.get('thermostats') or {}
+    state['names'] = dict([ (thermostat.get('name_long'), id) for (id, thermostat) in thermostats.items() ])
+    return state
+
+class NestView(View):
+    def __init__(self, factory, cpu=None, size=65536):
+        segment = Segment(size)
+        View.__init__(self, Worker('Works with Nest', factory, lambda nest: [ ('Works with Nest', nest.run, (True,)) ],
+                                   self.encode, segment, OVERFLOW, cpu))
+        self.decoded = Decoded(segment, _read_nest)
+
+    def encode(self, nest):
+        (updated, thermostats) = nest.getThermostats()
+        return json.dumps({ 'ready'       : nest.isReady(),
+                            'provisional' : nest.isProvisional(),
+                            'updated'     : updated,
+                            'thermostats' : thermostats })
+
+    # The thermostats are shared with the other callers, they must not be
+    # changed
+    def _state(self):
+        return self.decoded.get() or {}
+
+    def isReady(self):
+        return self._state().get('ready', False)
+
+    def isProvisional(self):
+        return self._state().get('provisional', False)
+
+    def getThermostats(self):
+        state = self._state()
+        return (state.get('updated'), state.get('thermostats'))
+
+    def getThermostatId(self, name):
+        return self._state().get('names', {}).get(name)
+
+    def getThermostatNames(self):
+        return sorted(self._state().get('names', {}))
+
+    def getThermostat(self, id, since=None):
+        state = self._state()
+        thermostats = state.get('thermostats') or {}
+        if id not in thermostats:
+            return (None, None)
+        updated = (state.get('updated') or {}).get(id, 0)
+        if since is not None and updated <= since:
+            return (updated, None)
+        return (updated, thermostats[id])
+
+class IFTTTView(View):
+    # senders - dispatch() threads to run, args - arguments of run()
+    def __init__(self, factory, senders=1, cpu=None, size=65536, args=()):
+        threads = lambda ifttt: ([ ('IFTTT', ifttt.run, args) ] +
+                                 [ ('IFTTT Sender %d' % (sender), ifttt.dispatch, ()) for sender in range(senders) ])
+        segment = Segment(size)
+        View.__init__(self, Worker('IFTTT', factory, threads, self.encode, segment, OVERFLOW, cpu))
+        self.decoded = Decoded(segment, _read_json)
+
+    def encode(self, ifttt):
+        return json.dumps({ 'ready'   : ifttt.isReady(),
+                            'pending' : ifttt.getPending(),
+                            'queue'   : ifttt.getQueueStats() })
+
+    def _state(self):
+        return self.decoded.get() or {}
+
+    def isReady(self):
+        return self._state().get('ready', False)
+
+    def getPending(self):
+        return self._state().get('pending', {})
+
+    def getQueueStats(self):
+        return self._state().get('queue', {})
+
+    def send_action(self, action, retry=0, priority=ifttt.PRIORITY_CONTROL, wait=True):
+        return self.worker.call('send_action', (action, retry, priority, wait), False)
+
+    def acknowledge(self, action):
+        self.worker.call('acknowledge', (action,))
@@ -0,0 +1,258 @@
+# Whole house electrical load manager
+#
+# The plug in heaters and window air conditioners are switched by
+# independent zone threads.  Before a zone turns one on it asks for a
+# grant here, so the total load on each circuit, and the house as a whole,
+# stays under the configured limits.  Zones that don't fit wait in a queue
+# ordered by priority and how far they are from their target, and long
+# running lower priority devices are rotated out in favour of them.
+#
+# Only bookkeeping happens under the lock, the zones do their own I/O.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from time import sleep, time
+import threading
+import logging
+
+class LoadManager():
+    # house_limit - maximum watts of managed devices on at once (0 = no limit)
+    # circuit_limits - circuit : maximum watts
+    # rotate_time - seconds a device may hold its grant while a more (or
+    #               equally) important device is waiting
+    def __init__(self, house_limit=0, circuit_limits={}, rotate_time=1800):
+        self.logger = logging.getLogger('HVAC.Load')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.house_limit    = house_limit
+            self.circuit_limits = dict(circuit_limits)
+            self.rotate_time    = rotate_time
+
+            self.devices = {}   # device : { 'watts', 'circuit', 'priority', 'callback' }
+            self.granted = {}   # device : time granted
+            self.waiting = {}   # device : deficit (degrees from target)
+            self.revoked = set()  # granted devices asked to turn off
+            self.yielding = {}    # device rotated out : device it made way for
+        finally:
+            self.lock.release()
+
+    # New limits, from a configuration reload.  Devices already granted keep
+    # their grant, waiting ones that now fit are granted.
+    def configure(self, house_limit=0, circuit_limits={}, rotate_time=1800):
+        callbacks = []
+        try:
+            self.lock.acquire()
+
+            self.house_limit    = house_limit
+            self.circuit_limits = dict(circuit_limits)
+            self.rotate_time    = rotate_time
+
+            callbacks = self._grant_waiting()
+        finally:
+            self.lock.release()
+
+        self._notify(callbacks)
+
+    # priority - lower numbers are more important
+    # callback - called (without the lock held) when the grant changes
+    def register(self, device, watts, circuit=None, priority=5, callback=None):
+        try:
+            self.lock.acquire()
+            self.devices[device] = { 'watts'    : watts,
+                                     'circuit'  : circuit,
+                                     'priority' : priority,
+                                     'callback' : callback }
+        finally:
+            self.lock.release()
+
+    # The device is no longer managed, its grant (if any) is given back
+    def deregister(self, device):
+        callbacks = []
+        try:
+            self.lock.acquire()
+
+            if device not in self.devices:
+                return
+            granted = device in self.granted
+            del self.devices[device]
+            self.granted.pop(device, None)
+            self.waiting.pop(device, None)
+            self.revoked.discard(device)
+            self.yielding.pop(device, None)
+            self.logger.info("%s: no longer managed (house %dW)" % (device, self._load()))
+            if granted:
+                callbacks = self._grant_waiting()
+        finally:
+            self.lock.release()
+
+        self._notify(callbacks)
+
+    def _load(self, circuit=None):
+        total = 0
+        for device in self.granted:
+            if circuit is None or self.devices[device]['circuit'] == circuit:
+                total += self.devices[device]['watts']
+        return total
+
+    def _fits(self, device):
+        info = self.devices[device]
+
+        if self.house_limit and self._load() + info['watts'] > self.house_limit:
+            return False
+
+        limit = self.circuit_limits.get(info['circuit'])
+        if limit and self._load(info['circuit']) + info['watts'] > limit:
+            return False
+
+        return True
+
+    def _rank(self, device):
+        return (self.devices[device]['priority'], -self.waiting[device])
+
+    # A device rotated out waits until the device it made way for has been
+    # granted (or stopped waiting), however far it is from its own target
+    def _yields(self, device):
+        waiter = self.yielding.get(device)
+        if waiter is None:
+            return False
+        if waiter in self.waiting:
+            return True
+        del self.yielding[device]
+        return False
+
+    # Grant waiting devices, best first, that now fit.  Returns the
+    # callbacks to run once the lock is released.
+    def _grant_waiting(self):
+        callbacks = []
+        for device in sorted(self.waiting, key=self._rank):
+            if not self._yields(device) and self._fits(device):
+                del self.waiting[device]
+                self.granted[device] = time()
+                self.logger.info("%s: granted %dW (house %dW)" % (device, self.devices[device]['watts'], self._load()))
+                callbacks.append(self.devices[device]['callback'])
+        return callbacks
+
+    def _notify(self, callbacks):
+        for callback in callbacks:
+            if callback:
+                callback()
+
+    # Ask to turn device on, deficit is how far the zone is from its target.
+    # Returns True if the device may be (or stay) on.
+    def request(self, device, deficit=0):
+        try:
+            self.lock.acquire()
+
+            if device not in self.devices:
+                return True
+
+            if device in self.granted and device not in self.revoked:
+                return True
+
+            if device not in self.granted and not self._yields(device) and self._fits(device):
+                if device in self.waiting:
+                    del self.waiting[device]
+                self.granted[device] = time()
+                self.logger.info("%s: granted %dW (house %dW)" % (device, self.devices[device]['watts'], self._load()))
+                return True
+
+            if device not in self.waiting:
+                self.logger.info("%s: waiting for %dW" % (device, self.devices[device]['watts']))
+            self.waiting[device] = deficit
+            return False
+        finally:
+            self.lock.release()
+
+    # The device is off, give up the grant.  If it is still waiting to come
+    # back on, it stays in the queue.
+    def release(self, device):
+        callbacks = []
+        try:
+            self.lock.acquire()
+
+            if device in self.granted:
+                del self.granted[device]
+                self.revoked.discard(device)
+                self.logger.info("%s: released (house %dW)" % (device, self._load()))
+                callbacks = self._grant_waiting()
+        finally:
+            self.lock.release()
+
+        self._notify(callbacks)
+
+    # The device no longer wants to be on
+    def cancel(self, device):
+        try:
+            self.lock.acquire()
+            if device in self.waiting:
+                del self.waiting[device]
+        finally:
+            self.lock.release()
+
+    # Revoke devices that have been on too long while something at least as
+    # important is waiting for the capacity.
+    def rotate(self):
+        callbacks = []
+        try:
+            self.lock.acquire()
+
+            now = time()
+            for device in sorted(self.waiting, key=self._rank):
+                info = self.devices[device]
+                candidates = []
+                for holder in self.granted:
+                    hold = self.devices[holder]
+                    if holder in self.revoked or hold['priority'] < info['priority']:
+                        continue
+                    if now - self.granted[holder] < self.rotate_time:
+                        continue
+                    # Only a holder on the same circuit helps, unless the
+                    # house limit is what is holding us back
+                    if info['circuit'] != hold['circuit'] and not self.house_limit:
+                        continue
+                    candidates.append(holder)
+
+                if candidates:
+                    holder = min(candidates, key=lambda holder: self.granted[holder])
+                    self.revoked.add(holder)
+                    self.yielding[holder] = device
+                    self.logger.info("%s: rotating out in favour of %s" % (holder, device))
+                    callbacks.append(self.devices[holder]['callback'])
+        finally:
+            self.lock.release()
+
+        self._notify(callbacks)
+
+    def getLoad(self):
+        try:
+            self.lock.acquire()
+            return (self._load(), dict(self.granted), dict(self.waiting))
+        finally:
+            self.lock.release()
+
+    def run(self, wait_time=60):
+        while True:
+            sleep(wait_time)
+            self.rotate()
@@ -0,0 +1,275 @@
+# Metrics
+#
+# Counters, gauges and histograms, exposed in the Prometheus text format on
+# the status server's /metrics.
+#
+# The hot paths never take a lock to count.  Each thread gets its own slot
+# in a metric, which only that thread writes, and a scrape adds the slots
+# up.  Gauges may instead be read from a function at scrape time (queue
+# depths and the like) so the workers don't have to keep them current.
+#
+# A worker running in a process of its own (see isolate.py) starts from an
+# empty copy of the registry, and its samples are merged into the parent's
+# when scraped.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from time import time
+import threading
+
+class Metric():
+    type = None
+
+    def __init__(self, name, help, labels=[], values=None):
+        self.name   = name
+        self.help   = help
+        self.labels = list(labels)
+        self.values = dict(values or {})   # this child's label values
+        self.local  = threading.local()
+        self.slots  = []      # Every thread's slot, only read from here
+        self.children = {}    # label values : child metric
+        self.unused   = False # reset, and not written since
+
+    # The child metric for a set of label values
+    def label(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values,
+                        self.__class__(self.name, self.help, [], dict(zip(self.labels, values))))
+        return child
+
+    def _new_slot(self):
+        return [ 0.0 ]
+
+    # This thread's slot, created on first use
+    def slot(self):
+        slot = getattr(self.local, 'slot', None)
+        if slot is None:
+            slot = self.local.slot = self._new_slot()
+            self.slots.append(slot)
+            self.unused = False
+        return slot
+
+    def _total(self):
+        total = self._new_slot()
+        for slot in list(self.slots):
+            for index in range(len(total)):
+                total[index] += slot[index]
+        return total
+
+    def _format_labels(self, extra={}):
+        values = dict(self.values)
+        values.update(extra)
+        if not values:
+            return ''
+        return '{%s}' % ','.join([ '%s="%s"' % (key, str(values[key]).replace('\\', '\\\\').replace('"', '\\"'))
+                                   for key in sorted(values) ])
+
+    def _samples(self):
+        return [ (self.name, self._format_labels(), self._total()[0]) ]
+
+    # (name, labels, value) of this metric and every child
+    def samples(self):
+        if self.unused:
+            return []
+        metrics = [ self ]
+        if self.labels:
+            metrics = [ self.children[values] for values in sorted(self.children) ]
+        samples = []
+        for metric in metrics:
+            samples += metric._samples()
+        return samples
+
+    # Forget every value, and every child
+    def reset(self):
+        self.local = threading.local()
+        self.slots = []
+        self.children = {}
+        self.unused = not self.labels
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self.slot()[0] += amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=[], values=None):
+        Metric.__init__(self, name, help, labels, values)
+        self.value = 0.0
+        self.function = None
+
+    # A gauge has one writer at a time, so it is simply stored
+    def set(self, value):
+        self.value = value
+        self.unused = False
+
+    # Read the value from function when scraped
+    def set_function(self, function):
+        self.function = function
+        self.unused = False
+
+    def reset(self):
+        Metric.reset(self)
+        self.value = 0.0
+        self.function = None
+
+    def _samples(self):
+        value = self.value
+        if self.function:
+            value = self.function()
+        return [ (self.name, self._format_labels(), value) ]
+
+BUCKETS = [ 0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60 ]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=[], values=None, buckets=BUCKETS):
+        self.buckets = sorted(buckets)
+        Metric.__init__(self, name, help, labels, values)
+
+    def label(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values,
+                        Histogram(self.name, self.help, [], dict(zip(self.labels, values)), self.buckets))
+        return child
+
+    # [ count per bucket ..., +Inf count, sum ]
+    def _new_slot(self):
+        return [ 0.0 ] * (len(self.buckets) + 2)
+
+    def observe(self, value):
+        slot = self.slot()
+        for (index, bound) in enumerate(self.buckets):
+            if value <= bound:
+                slot[index] += 1
+                break
+        else:
+            slot[len(self.buckets)] += 1
+        slot[-1] += value
+
+    def _samples(self):
+        total = self._total()
+        samples = []
+        count = 0
+        for (index, bound) in enumerate(self.buckets + [ '+Inf' ]):
+            count += total[index]
+            samples.append((self.name + '_bucket', self._format_labels({ 'le' : bound }), count))
+        samples.append((self.name + '_sum', self._format_labels(), total[-1]))
+        samples.append((self.name + '_count', self._format_labels(), count))
+        return samples
+
+class Registry():
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+            self.metrics = {}   # name : metric
+        finally:
+            self.lock.release()
+
+    # Returns the existing metric if it was already registered, so every
+    # instance of a class shares its metrics
+    def register(self, metric):
+        try:
+            self.lock.acquire()
+            return self.metrics.setdefault(metric.name, metric)
+        finally:
+            self.lock.release()
+
+    # [ (name, type, help, samples) ] of every metric, which can be sent to
+    # another process
+    def collect(self):
+        try:
+            self.lock.acquire()
+            metrics = [ self.metrics[name] for name in sorted(self.metrics) ]
+        finally:
+            self.lock.release()
+        return [ (metric.name, metric.type, metric.help, metric.samples()) for metric in metrics ]
+
+    # Called in a newly forked process, so it only reports its own values
+    def reset(self):
+        try:
+            self.lock.acquire()
+            for metric in self.metrics.values():
+                metric.reset()
+        finally:
+            self.lock.release()
+
+    # others - collect() of other processes, merged in by metric name
+    def expose(self, others=[]):
+        families = {}   # name : (type, help, samples)
+        for collected in [ self.collect() ] + list(others):
+            for (name, type, help, samples) in collected:
+                if name not in families:
+                    families[name] = (type, help, [])
+                families[name][2].extend(samples)
+
+        lines = []
+        for name in sorted(families):
+            (type, help, samples) = families[name]
+            lines += [ '# HELP %s %s' % (name, help),
+                       '# TYPE %s %s' % (name, type) ]
+            for (sample, labels, value) in samples:
+                lines.append('%s%s %s' % (sample, labels, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=[]):
+    return REGISTRY.register(Counter(name, help, labels))
+
+def gauge(name, help, labels=[]):
+    return REGISTRY.register(Gauge(name, help, labels))
+
+def histogram(name, help, labels=[], buckets=BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets=buckets))
+
+# A drop in threading.Lock that records how long acquire() waited
+class TimedLock():
+    # site - the site (house) of the worker owning the lock, '' if only one
+    def __init__(self, name, site=''):
+        self.lock = threading.Lock()
+        self.wait = histogram('hvac_lock_wait_seconds', 'Time spent waiting for a worker lock', [ 'site', 'lock' ]).label(site, name)
+
+    def acquire(self, blocking=1):
+        if self.lock.acquire(0):
+            self.wait.observe(0)
+            return True
+        if not blocking:
+            return False
+        start = time()
+        self.lock.acquire()
+        self.wait.observe(time() - start)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
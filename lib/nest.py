@@ -31,12 +31,28 @@ import json
 import copy
 import threading
 import logging
-
-class Nest():
-    def __init__(self, token, url='https://developer-api.nest.com'):
+from time import time
+
+from readiness import Readiness
+from state import write_atomic, read_json
+import metrics
+from profiler import span
+
+PUTS     = metrics.counter('nest_puts_total', 'Nest data updates received', [ 'site' ])
+CHANGES  = metrics.counter('nest_field_changes_total', 'Thermostat fields changed by the updates', [ 'site' ])
+CONNECTS = metrics.counter('nest_connects_total', 'Nest streaming connections made', [ 'site' ])
+
+class Nest(Readiness):
+    # cache - file to save the last snapshot to, and preload it from on startup
+    # cache_max_age - seconds a cached snapshot is still considered usable
+    # site - the site (house) the account is for, '' if only one
+    def __init__(self, token, url='https://developer-api.nest.com', cache=None, cache_max_age=3600, site=''):
         self.logger = logging.getLogger('HVAC.Nest')
 
-        self.lock = threading.Lock()     # Thread lock for the data
+        Readiness.__init__(self, 'Nest')
+
+        self.site = site
+        self.lock = metrics.TimedLock('nest', site)     # Thread lock for the data
 
         try:
             self.lock.acquire()
@@ -44,11 +60,79 @@ class Nest():
             self.nest_url = url
             self.nest_token = token
             self.thermostats = {}
+            self.names = {}      # name_long : id
             self.updated = {}
+            self.received = {}   # Time each thermostat last changed
             self.events = []     # Thread events when data is updated
+
+            self.cache = cache
+            self.cache_max_age = cache_max_age
+            self.provisional = False  # Data came from the cache, not the live API
+        finally:
+            self.lock.release()
+
+        self.load_cache()
+
+    # Preload the last snapshot, so zones can start before the stream connects
+    def load_cache(self):
+        try:
+            data = read_json(self.cache)
+        except (IOError, ValueError) as e:
+            self.logger.warning("Ignoring unreadable Nest cache %s: %s" % (self.cache, e))
+            return
+
+        if not data:
+            return
+
+        # A cache from another version, or cut short, is as good as none
+        try:
+            (saved, thermostats, updated, received) = (data['saved'], data['thermostats'],
+                                                       data['updated'], data['received'])
+            names = dict([ (thermostat.get('name_long'), id) for (id, thermostat) in thermostats.items() ])
+        except (KeyError, TypeError, AttributeError) as e:
+            self.logger.warning("Ignoring incomplete Nest cache %s: %r" % (self.cache, e))
+            return
+
+        age = time() - saved
+        if age > self.cache_max_age:
+            self.logger.info("Nest cache is %ds old, ignoring" % (age))
+            return
+
+        try:
+            self.lock.acquire()
+
+            self.thermostats = thermostats
+            self.names = names
+            self.updated = updated
+            self.received = received
+            self.provisional = True
+        finally:
+            self.lock.release()
+
+        self.logger.info("Loaded provisional Nest snapshot (%ds old)" % (age))
+        self.setReady()
+
+    def save_cache(self):
+        if not self.cache:
+            return
+
+        try:
+            self.lock.acquire()
+            data = json.dumps({ 'saved'       : time(),
+                                'thermostats' : self.thermostats,
+                                'updated'     : self.updated,
+                                'received'    : self.received })
         finally:
             self.lock.release()
 
+        try:
+            write_atomic(self.cache, data)
+        except (IOError, OSError) as e:
+            self.logger.error("Unable to write Nest cache %s: %s" % (self.cache, e))
+
+    def isProvisional(self):
+        return self.provisional
+
     def registerEvent(self, event):
         if event not in self.events:
             self.events.append(event)
@@ -100,6 +184,7 @@ class Nest():
 
                 break
 
+            CONNECTS.label(self.site).inc()
             client = sseclient.SSEClient(response)
             return client
 
@@ -133,8 +218,39 @@ class Nest():
 
         return (updated, thermostats)
 
+    # Id of the thermostat named name (its name_long), or None
+    def getThermostatId(self, name):
+        try:
+            self.lock.acquire()
+            return self.names.get(name)
+        finally:
+            self.lock.release()
+
+    def getThermostatNames(self):
+        try:
+            self.lock.acquire()
+            return sorted(self.names)
+        finally:
+            self.lock.release()
+
+    # Returns (update count, thermostat) for the thermostat id.  If since
+    # is given, thermostat is None unless it has changed since that count.
+    def getThermostat(self, id, since=None):
+        try:
+            self.lock.acquire()
+            if id not in self.thermostats:
+                return (None, None)
+            updated = self.updated.get(id, 0)
+            if since is not None and updated <= since:
+                return (updated, None)
+            return (updated, copy.deepcopy(self.thermostats[id]))
+        finally:
+            self.lock.release()
+
+    @span('Nest.load')
     def load(self, data):
         updated = False
+        PUTS.label(self.site).inc()
 
         try:
             self.lock.acquire()
@@ -147,26 +263,41 @@ class Nest():
                 self.logger.error("No devices or thermostats in devices: %s" % data)
                 return
 
+            # The first live data replaces the cached snapshot entirely.  The
+            # update counters carry on, so zones see every field as changed.
+            if self.provisional:
+                self.logger.info("Live Nest data received, replacing provisional snapshot")
+                self.provisional = False
+                self.thermostats = {}
+                self.names = {}
+
             for id in data['devices']['thermostats']:
                 thermostat = data['devices']['thermostats'][id]
 
                 if not (id in self.thermostats):
                     self.thermostats[id] = {}
+                if not (id in self.updated):
                     self.updated[id] = 0
 
                 updated_items = ""
                 for element in thermostat:
                     if element not in self.thermostats[id] or \
                        self.thermostats[id][element] != thermostat[element]:
+                        if element == 'name_long':
+                            self.names.pop(self.thermostats[id].get('name_long'), None)
+                            self.names[thermostat[element]] = id
                         self.thermostats[id][element] = thermostat[element]
 
                         # We only care about fields changing, not the connection time
                         if element != "last_connection":
                             updated_items += " { '%s':'%s' }" % (element, thermostat[element])
                             self.updated[id] += 1
+                            CHANGES.label(self.site).inc()
                             updated = True
 
                 if updated_items:
+                    self.received[id] = time()
+
                     name = id
                     if 'name_long' in thermostat:
                         name = thermostat['name_long']
@@ -175,8 +306,11 @@ class Nest():
         finally:
             self.lock.release()
             if updated:
+                # First snapshot loaded, zones can resolve their thermostats
+                self.setReady()
                 for event in self.events:
                     event.set()
+                self.save_cache()
 
 
     # run the nest API watcher.
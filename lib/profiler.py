@@ -0,0 +1,221 @@
+# Sampling profiler
+#
+# Started and stopped while running (SIGUSR1, or the status server's
+# /profile), it samples every thread's stack at a fixed rate and counts them
+# by worker (thread) name.  The counts are written in the collapsed format
+# flamegraph.pl and speedscope read.
+#
+# While it runs, the functions wrapped with span() are also timed, and can
+# be saved as Chrome trace JSON (chrome://tracing, Perfetto).
+#
+# When it isn't running there is no sampling thread, and a span only checks
+# a flag.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from collections import deque
+from time import sleep, time
+import functools
+import threading
+import os.path
+import json
+import sys
+import logging
+
+class Profiler():
+    # rate - samples per second, max_spans - spans kept (oldest dropped)
+    def __init__(self, rate=100, max_spans=10000):
+        self.logger = logging.getLogger('HVAC.Profiler')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.rate      = rate
+            self.running   = False
+            self.sampler   = None
+            self.started   = None     # time the current (or last) run started
+            self.stopped   = None
+            self.samples   = 0
+            self.stacks    = {}       # collapsed stack : count
+            self.spans     = deque(maxlen=max_spans)   # (name, thread ident, thread name, start, end)
+        finally:
+            self.lock.release()
+
+    def configure(self, rate, max_spans):
+        try:
+            self.lock.acquire()
+            self.rate = rate
+            self.spans = deque(self.spans, maxlen=max_spans)
+        finally:
+            self.lock.release()
+
+    def start(self):
+        try:
+            self.lock.acquire()
+            if self.running:
+                return False
+            self.stacks  = {}
+            self.samples = 0
+            self.spans.clear()
+            self.started = time()
+            self.stopped = None
+            self.running = True
+            self.sampler = threading.Thread(target=self._sample, name='Profiler')
+            self.sampler.daemon = True
+            self.sampler.start()
+        finally:
+            self.lock.release()
+
+        self.logger.info("Profiling started, %d samples per second" % (self.rate))
+        return True
+
+    def stop(self):
+        try:
+            self.lock.acquire()
+            if not self.running:
+                return False
+            self.running = False
+            self.stopped = time()
+            sampler = self.sampler
+            self.sampler = None
+        finally:
+            self.lock.release()
+
+        sampler.join()
+        self.logger.info("Profiling stopped, %d samples and %d spans" % (self.samples, len(self.spans)))
+        return True
+
+    def toggle(self):
+        if not self.stop():
+            self.start()
+        return self.running
+
+    def _frame_name(self, frame):
+        code = frame.f_code
+        return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        interval = 1.0 / self.rate
+
+        while self.running:
+            names = dict([ (thread.ident, thread.name) for thread in threading.enumerate() ])
+
+            collapsed = []
+            for (ident, frame) in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame:
+                    stack.append(self._frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'Thread %d' % (ident)).replace(';', ':'))
+                stack.reverse()
+                collapsed.append(';'.join(stack))
+
+            try:
+                self.lock.acquire()
+                for stack in collapsed:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+            finally:
+                self.lock.release()
+
+            sleep(interval)
+
+    # Called by span(), the deque append doesn't need the lock
+    def record(self, name, start, end):
+        thread = threading.current_thread()
+        self.spans.append((name, thread.ident, thread.name, start, end))
+
+    # Stack counts, one '<worker>;<outer>;...;<inner> <count>' per line
+    def getFlamegraph(self):
+        try:
+            self.lock.acquire()
+            stacks = dict(self.stacks)
+        finally:
+            self.lock.release()
+
+        return ''.join([ '%s %d\n' % (stack, stacks[stack]) for stack in sorted(stacks) ])
+
+    def getTrace(self):
+        try:
+            self.lock.acquire()
+            started = self.started or time()
+            spans = list(self.spans)
+        finally:
+            self.lock.release()
+
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for (name, ident, thread, start, end) in spans:
+            threads[ident] = thread
+            events.append({ 'name' : name, 'cat' : 'span', 'ph' : 'X', 'pid' : pid, 'tid' : ident,
+                            'ts'   : int((start - started) * 1000000),
+                            'dur'  : int((end - start) * 1000000) })
+        for (ident, thread) in threads.items():
+            events.append({ 'name' : 'thread_name', 'ph' : 'M', 'pid' : pid, 'tid' : ident,
+                            'args' : { 'name' : thread } })
+
+        return json.dumps({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' })
+
+    def getState(self):
+        try:
+            self.lock.acquire()
+            return { 'running' : self.running,
+                     'rate'    : self.rate,
+                     'started' : self.started,
+                     'stopped' : self.stopped,
+                     'samples' : self.samples,
+                     'spans'   : len(self.spans) }
+        finally:
+            self.lock.release()
+
+    # Write <prefix>.folded and <prefix>.trace.json
+    def save(self, prefix):
+        for (filename, data) in [ (prefix + '.folded', self.getFlamegraph()),
+                                  (prefix + '.trace.json', self.getTrace()) ]:
+            f = open(filename, 'w')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        self.logger.info("Profile saved to %s.folded and %s.trace.json" % (prefix, prefix))
+
+PROFILER = Profiler()
+
+# Decorator timing each call of a function while the profiler runs
+def span(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            if not PROFILER.running:
+                return function(*args, **kwargs)
+            start = time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                PROFILER.record(name, start, time())
+        return timed
+    return decorate
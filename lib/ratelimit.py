@@ -0,0 +1,70 @@
+# Token bucket rate limiting
+#
+# Used to pace the requests we send to an endpoint, allowing a short burst
+# but keeping the long term rate under what the service will accept.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from time import time
+import threading
+
+class TokenBucket():
+    # rate - tokens added per second, burst - maximum tokens held
+    def __init__(self, rate, burst):
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.rate   = float(rate)
+            self.burst  = float(burst)
+            self.tokens = float(burst)
+            self.last   = time()
+        finally:
+            self.lock.release()
+
+    def _refill(self):
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    # Seconds until a token is available (0 if one is available now)
+    def delay(self):
+        try:
+            self.lock.acquire()
+            self._refill()
+            if self.tokens >= 1:
+                return 0
+            return (1 - self.tokens) / self.rate
+        finally:
+            self.lock.release()
+
+    # Take a token, returns False if none was available
+    def take(self):
+        try:
+            self.lock.acquire()
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+        finally:
+            self.lock.release()
@@ -0,0 +1,51 @@
+# Worker readiness tracking
+#
+# Each worker (GPIO, Nest, IFTTT) publishes when it has completed the first
+# piece of work the zones depend on, so zones can start as soon as their
+# own inputs are available instead of sleeping for a fixed period.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from time import time
+import threading
+
+class Readiness():
+    def __init__(self, stage):
+        self.ready_stage = stage          # Name used when reporting
+        self.ready_event = threading.Event()
+        self.ready_start = time()         # When we started waiting
+        self.ready_time  = None           # Seconds it took to become ready
+
+    # Called by the worker once the first piece of data is available
+    def setReady(self):
+        if self.ready_event.is_set():
+            return
+
+        self.ready_time = time() - self.ready_start
+        self.ready_event.set()
+        self.logger.info("%s ready after %.2fs" % (self.ready_stage, self.ready_time))
+
+    def isReady(self):
+        return self.ready_event.is_set()
+
+    # Returns True if ready, False if the timeout expired first
+    def waitReady(self, timeout=None):
+        return self.ready_event.wait(timeout)
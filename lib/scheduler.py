@@ -0,0 +1,141 @@
+# Time of day scheduler
+#
+# Zones register the times of day their rules change (fan speed bands,
+# night setbacks) and are woken exactly at each boundary, instead of only
+# noticing the next time some other event happens.
+#
+# The rules are kept in a timer wheel with one slot per minute of the day.
+# Everything registered in the same slot is fired together.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import bisect
+import datetime
+import threading
+import logging
+
+SLOTS = 24 * 60    # One slot per minute of the day
+
+class Scheduler():
+    def __init__(self):
+        self.logger = logging.getLogger('HVAC.Scheduler')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.wheel = {}      # slot : [ callback ]
+            self.slots = []      # sorted slots that have callbacks
+            self.changed = threading.Event()   # Wheel changed, recompute next boundary
+        finally:
+            self.lock.release()
+
+    # Call callback every day at hour:minute
+    def register(self, hour, minute, callback):
+        slot = (hour * 60 + minute) % SLOTS
+
+        try:
+            self.lock.acquire()
+
+            callbacks = self.wheel.setdefault(slot, [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+            if slot not in self.slots:
+                bisect.insort(self.slots, slot)
+        finally:
+            self.lock.release()
+
+        self.changed.set()
+
+    def deregister(self, callback):
+        try:
+            self.lock.acquire()
+
+            for slot in list(self.slots):
+                callbacks = self.wheel[slot]
+                if callback in callbacks:
+                    callbacks.remove(callback)
+                if not callbacks:
+                    del self.wheel[slot]
+                    self.slots.remove(slot)
+        finally:
+            self.lock.release()
+
+        self.changed.set()
+
+    # Return (time, slot) of the next boundary after now, or (None, None)
+    def next_boundary(self, now):
+        try:
+            self.lock.acquire()
+
+            if not self.slots:
+                return (None, None)
+
+            current = now.hour * 60 + now.minute
+            index = bisect.bisect_right(self.slots, current)
+            if index < len(self.slots):
+                slot = self.slots[index]
+                day = now.date()
+            else:
+                # Wrap around to tomorrow
+                slot = self.slots[0]
+                day = now.date() + datetime.timedelta(days=1)
+        finally:
+            self.lock.release()
+
+        boundary = datetime.datetime.combine(day, datetime.time(slot // 60, slot % 60))
+        return (boundary, slot)
+
+    def fire(self, slot):
+        try:
+            self.lock.acquire()
+            callbacks = list(self.wheel.get(slot, []))
+        finally:
+            self.lock.release()
+
+        self.logger.debug("%02d:%02d boundary, firing %d rules" % (slot // 60, slot % 60, len(callbacks)))
+        for callback in callbacks:
+            callback()
+
+    def run(self):
+        while True:
+            self.changed.clear()
+
+            (boundary, slot) = self.next_boundary(datetime.datetime.now())
+
+            # Sleep until the boundary, or until the rules change
+            while True:
+                if boundary is None:
+                    remaining = None
+                else:
+                    delta = boundary - datetime.datetime.now()
+                    remaining = delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+                    if remaining <= 0:
+                        break
+
+                if self.changed.wait(remaining):
+                    break
+
+            if self.changed.is_set():
+                continue
+
+            self.fire(slot)
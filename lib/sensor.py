@@ -0,0 +1,73 @@
+# Local temperature sensors
+#
+# Thermistors read through the GPIO board's ADC channels.  Each channel has
+# its own calibration, a table of (raw reading, degrees F) points that is
+# interpolated between, and is smoothed with an exponential moving average
+# to take out the ADC noise.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+class Sensor():
+    # points - [ (raw, degrees) ], at least two, any order
+    # smoothing - weight of a new reading (1 = no smoothing)
+    def __init__(self, points, smoothing=0.3):
+        self.points    = sorted(points)
+        self.smoothing = smoothing
+        self.raw       = None
+        self.value     = None   # Smoothed degrees F
+
+    # Degrees F for a raw reading, extrapolating past the end points
+    def calibrate(self, raw):
+        points = self.points
+        for index in range(1, len(points) - 1):
+            if raw < points[index][0]:
+                break
+        else:
+            index = len(points) - 1
+
+        ((raw0, temp0), (raw1, temp1)) = (points[index - 1], points[index])
+        return temp0 + (raw - raw0) * float(temp1 - temp0) / (raw1 - raw0)
+
+    # Add a reading, returns True if the reported (rounded) value changed
+    def update(self, raw):
+        last = self.getValue()
+
+        self.raw = raw
+        temp = self.calibrate(raw)
+        if self.value is None:
+            self.value = temp
+        else:
+            self.value += self.smoothing * (temp - self.value)
+
+        return self.getValue() != last
+
+    # Lost the sensor, start over when it is back
+    def reset(self):
+        changed = self.value is not None
+        self.raw = None
+        self.value = None
+        return changed
+
+    # Degrees F to a tenth of a degree, None if not read yet
+    def getValue(self):
+        if self.value is None:
+            return None
+        return round(self.value, 1)
@@ -0,0 +1,221 @@
+# Shadow zones
+#
+# A candidate zone implementation, or configuration, runs beside the
+# production zones on the same live Nest and GPIO inputs.  Its actions go to
+# a recording sink rather then the devices, and are compared with what the
+# production zones actually sent.
+#
+# An action is in agreement when the other side sent the same action within
+# the window.  Anything left unmatched once it is older then the window is a
+# disagreement, and is logged and kept for the status server's /shadow.
+#
+# The shadow zones run in threads of their own, production only appends to
+# a list when it sends something.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from collections import deque
+from time import sleep, time
+import threading
+import logging
+
+PRODUCTION = 'production'
+SHADOW     = 'shadow'
+
+# Stands in for every actuator of a shadow zone
+class RecordingSink():
+    def __init__(self, report, zone):
+        self.report = report
+        self.zone   = zone
+
+    def send_action(self, action, retry=0, priority=None, wait=True):
+        self.report.record(SHADOW, self.zone, action)
+        return True
+
+    def isReady(self):
+        return True
+
+    def waitReady(self, timeout=None):
+        return True
+
+# The production state, so the shadow zones start from the same device
+# state, but never write it
+class ReadOnlyState():
+    def __init__(self, state):
+        self.state = state
+
+    def get(self, name):
+        return self.state.get(name)
+
+    def save(self, name, state):
+        pass
+
+# The production load manager's grants, so the shadow zones are held back
+# when production is, without ever taking capacity of their own
+class ReadOnlyLoad():
+    def __init__(self, load):
+        self.load = load
+
+    def register(self, device, watts, circuit=None, priority=5, callback=None):
+        pass
+
+    def deregister(self, device):
+        pass
+
+    def request(self, device, deficit=0):
+        if device not in self.load.devices:
+            return True
+        (load, granted, waiting) = self.load.getLoad()
+        return device in granted
+
+    def release(self, device):
+        pass
+
+    def cancel(self, device):
+        pass
+
+class ShadowReport():
+    # window - seconds the two sides may differ in sending the same action
+    # keep - disagreements kept for the report, per zone
+    def __init__(self, window=60, keep=50):
+        self.logger = logging.getLogger('HVAC.Shadow')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.window = window
+            self.keep   = keep
+            self.events  = []   # (time, side, zone, action) recorded since the last compare
+            self.pending = []   # compared, but may still be matched
+            self.zones   = {}   # zone : totals and recent disagreements
+        finally:
+            self.lock.release()
+
+    # Called by the production zones as they send an action, and by the sinks
+    def record(self, side, zone, action):
+        self.events.append((time(), side, zone, action))
+
+    def production(self, zone, action):
+        self.record(PRODUCTION, zone, action)
+
+    def _zone(self, zone):
+        if zone not in self.zones:
+            self.zones[zone] = { 'production'      : 0,
+                                 'shadow'          : 0,
+                                 'agreed'          : 0,
+                                 'production_only' : 0,
+                                 'shadow_only'     : 0,
+                                 'delay'           : 0.0,   # total shadow - production time, of the agreed
+                                 'disagreements'   : deque(maxlen=self.keep) }
+        return self.zones[zone]
+
+    # Match the events up, and report those that are no longer going to be
+    def compare(self, now=None):
+        if now is None:
+            now = time()
+
+        # Swapped rather then copied, so record() never waits for us
+        (events, self.events) = (self.events, [])
+
+        try:
+            self.lock.acquire()
+
+            for (when, side, zone, action) in events:
+                self._zone(zone)[side] += 1
+
+            events = sorted(self.pending + events)
+
+            pending = []
+            disagreements = []
+            matched = set()
+            for (index, event) in enumerate(events):
+                if index in matched:
+                    continue
+                (when, side, zone, action) = event
+
+                # The first unmatched event of the other side, for the same
+                # zone and action, within the window
+                found = False
+                for other in range(index + 1, len(events)):
+                    (other_when, other_side, other_zone, other_action) = events[other]
+                    if other_when - when > self.window:
+                        break
+                    if other in matched or other_side == side or other_zone != zone or other_action != action:
+                        continue
+                    matched.add(other)
+                    found = True
+                    totals = self._zone(zone)
+                    totals['agreed'] += 1
+                    if side == PRODUCTION:
+                        totals['delay'] += other_when - when
+                    else:
+                        totals['delay'] += when - other_when
+                    break
+
+                if not found:
+                    if now - when <= self.window:
+                        # Its match may still come
+                        pending.append(event)
+                    else:
+                        totals = self._zone(zone)
+                        totals['%s_only' % (side)] += 1
+                        totals['disagreements'].append({ 'time' : when, 'side' : side, 'action' : action })
+                        disagreements.append(event)
+
+            self.pending = pending
+        finally:
+            self.lock.release()
+
+        for (when, side, zone, action) in disagreements:
+            other = SHADOW if side == PRODUCTION else PRODUCTION
+            self.logger.info("%s: %s sent %s, %s did not" % (zone, side, action, other))
+
+    def getReport(self):
+        try:
+            self.lock.acquire()
+            report = {}
+            for zone in self.zones:
+                totals = dict(self.zones[zone])
+                totals['disagreements'] = list(totals['disagreements'])
+                if totals['agreed']:
+                    totals['delay'] = totals['delay'] / totals['agreed']
+                report[zone] = totals
+            return { 'window' : self.window, 'zones' : report }
+        finally:
+            self.lock.release()
+
+    def run(self, interval=10, summary=300):
+        last = time()
+        while True:
+            sleep(interval)
+            self.compare()
+
+            if time() - last >= summary:
+                last = time()
+                report = self.getReport()['zones']
+                for zone in sorted(report):
+                    totals = report[zone]
+                    self.logger.info("%s: %d production, %d shadow actions, %d agreed (shadow %+.1fs), "
+                                     "%d production only, %d shadow only" % (
+                                     zone, totals['production'], totals['shadow'], totals['agreed'],
+                                     totals['delay'], totals['production_only'], totals['shadow_only']))
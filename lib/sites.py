@@ -0,0 +1,321 @@
+# Sites
+#
+# A site is one house: its own Nest and IFTTT accounts, GPIO boards, zones,
+# state and load limits.  Each site is built from the settings module, with
+# the settings that differ for it given in SITES (see settings.py).
+#
+# The sites run in one process share the scheduler, the status server, the
+# connection pools of LAN actuators at the same address, logging and
+# metrics.  The metrics of each site's workers and zones are labelled with
+# its name.
+#
+# A site's zones.conf is reloaded on SIGHUP, or when the file changes.  The
+# new file is checked as a whole first, then the zones whose settings changed
+# are handed their new configuration, and only send what it calls for.
+# Adding, removing or renaming zones, or changing what they are wired to
+# (thermostat, actuator, relay lines, sensors), needs a restart.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import os.path
+import importlib
+import threading
+import ConfigParser
+import logging
+
+import nest
+import gpio
+import gpiochip
+import sensor
+import status
+import ifttt
+import state
+import config
+import zone
+import load
+import actuator
+import isolate
+import shadow
+
+# Files a site writes, which default to a name of their own for each site
+SITE_FILES = [ 'STATE_FILE', 'NEST_CACHE', 'IFTTT_FIFO' ]
+
+class Site():
+    # name - '' for the only site
+    # defaults - the settings module
+    # options - setting : value, for the settings that differ for this site
+    def __init__(self, name, defaults, options={}):
+        self.logger = logging.getLogger('HVAC.Site')
+
+        self.name     = name
+        self.defaults = defaults
+        self.options  = dict(options)
+
+        for key in self.options:
+            if not hasattr(defaults, key):
+                raise config.ConfigError("Site %s: unknown setting %s" % (name, key))
+
+        self.status  = None
+        self.workers = []
+
+        self.reload_event = threading.Event()   # Set to reload zones.conf
+        self.config_mtime = None
+        self.zone_configs = []   # Running ZoneConfigs, in zones.conf order
+        self.zones        = {}   # zone name : (Zone, ZoneGroup)
+
+    def setting(self, key):
+        if key in self.options:
+            return self.options[key]
+        value = getattr(self.defaults, key)
+        if self.name and key in SITE_FILES:
+            (directory, filename) = os.path.split(value)
+            value = os.path.join(directory, '%s-%s' % (self.name, filename))
+        return value
+
+    # Worker (thread) name, prefixed with the site's
+    def label(self, name):
+        if not self.name:
+            return name
+        return '%s: %s' % (self.name, name)
+
+    # Build the site's workers and zones.
+    # scheduler - the shared Scheduler
+    # lan_actuators - url : LanActuator, shared with the other sites
+    def build(self, scheduler, lan_actuators):
+        setting = self.setting
+
+        self.config_mtime = self._mtime(setting('ZONE_CONFIG'))
+        zone_configs = config.load_zones(setting('ZONE_CONFIG'))
+        load_limits = config.load_limits(setting('ZONE_CONFIG'))
+
+        sensors = {}
+        for (line, (calibration, smoothing)) in config.sensor_lines(zone_configs).items():
+            sensors[line] = sensor.Sensor(calibration, smoothing)
+
+        if setting('GPIO_BACKEND') == 'gpiochip':
+            if sensors:
+                raise config.ConfigError("Temperature sensors need the numato GPIO backend")
+            gpio_lines = len(setting('GPIO_CHIP_LINES'))
+            config.check_gpio_lines(zone_configs, gpio_lines)
+            gpio_factory = lambda: gpiochip.GpioChip(setting('GPIO_CHIP'), setting('GPIO_CHIP_LINES'),
+                                                     outputs=config.relay_lines(zone_configs),
+                                                     debounce=setting('GPIO_CHIP_DEBOUNCE'), site=self.name)
+        else:
+            gpio_ports = setting('GPIO_SERIAL')
+            if isinstance(gpio_ports, basestring):
+                gpio_ports = [ gpio_ports ]
+            gpio_lines = len(gpio_ports) * config.GPIO_WIDTH
+            config.check_gpio_lines(zone_configs, gpio_lines)
+            gpio_factory = lambda: gpio.Gpio(gpio_ports, outputs=config.relay_lines(zone_configs), sensors=sensors,
+                                             site=self.name)
+        nest_factory = lambda: nest.Nest(setting('NEST_TOKEN'), cache=setting('NEST_CACHE'),
+                                         cache_max_age=setting('NEST_CACHE_MAX_AGE'), site=self.name)
+        ifttt_factory = lambda: ifttt.IFTTT(setting('IFTTT_TOKEN'), rate=setting('IFTTT_RATE'), burst=setting('IFTTT_BURST'),
+                                            connect_timeout=setting('IFTTT_CONNECT_TIMEOUT'),
+                                            read_timeout=setting('IFTTT_READ_TIMEOUT'),
+                                            threshold=setting('IFTTT_FAILURES'),
+                                            reset_timeout=setting('IFTTT_RESET'), site=self.name)
+        ifttt_args = (10, setting('IFTTT_FIFO'))
+
+        if setting('ISOLATE_WORKERS'):
+            # Each in a process of its own, the objects here are views of them
+            cpus = list(setting('ISOLATE_CPUS') or []) + [ None ] * 3
+            gpio_obj = isolate.GpioView(gpio_factory, gpio_lines, cpus[0], setting('ISOLATE_GPIO_SIZE'))
+            nest_obj = isolate.NestView(nest_factory, cpus[1], setting('ISOLATE_NEST_SIZE'))
+            ifttt_obj = isolate.IFTTTView(ifttt_factory, setting('IFTTT_SENDERS'), cpus[2], setting('ISOLATE_IFTTT_SIZE'),
+                                          args=ifttt_args)
+        else:
+            gpio_obj = gpio_factory()
+            nest_obj = nest_factory()
+            ifttt_obj = ifttt_factory()
+
+        actuators = { 'gpio' : actuator.GpioActuator(gpio_obj) }
+        lan_url = setting('LAN_ACTUATOR_URL')
+        if lan_url:
+            if lan_url not in lan_actuators:
+                lan_actuators[lan_url] = actuator.LanActuator(lan_url, setting('LAN_ACTUATOR_POOL'),
+                                                              setting('LAN_ACTUATOR_TIMEOUT'))
+            actuators['lan'] = lan_actuators[lan_url]
+        state_obj = state.StateStore(setting('STATE_FILE'), setting('STATE_MAX_AGE'))
+        load_obj = load.LoadManager(load_limits.house, load_limits.circuits, load_limits.rotate)
+
+        if setting('ISOLATE_WORKERS'):
+            # The processes run the streaming Nest worker and the IFTTT senders
+            workers = [ ('GPIO', gpio_obj.run, ()),
+                        ('Works with Nest', nest_obj.run, ()),
+                        ('IFTTT', ifttt_obj.run, ()),
+                        ('Load', load_obj.run, ()) ]
+        else:
+            workers = [ ('GPIO', gpio_obj.run, ()),
+                        ('Works with Nest', nest_obj.run, (True,)),
+                        ('IFTTT', ifttt_obj.run, ifttt_args),
+                        ('Load', load_obj.run, ()) ]
+
+            for sender in range(setting('IFTTT_SENDERS')):
+                workers.append(('IFTTT Sender %d' % (sender), ifttt_obj.dispatch, ()))
+
+        report = None
+        if setting('SHADOW_CONFIG') or setting('SHADOW_ZONE'):
+            report = shadow.ShadowReport(setting('SHADOW_WINDOW'))
+
+        self.status = status.Status(nest_obj, gpio_obj, ifttt_obj, load_obj, shadow=report)
+
+        # Zones sharing a thermostat are run together, in zones.conf order
+        groups = {}
+        order = []
+        for zone_config in zone_configs:
+            if zone_config.actuator != 'ifttt' and zone_config.actuator not in actuators:
+                raise config.ConfigError("[zone:%s] actuator %s is not configured in settings" % (zone_config.name, zone_config.actuator))
+            zone_obj = zone.Zone(nest_obj, gpio_obj, ifttt_obj, state_obj, config=zone_config,
+                                 scheduler=scheduler, load=load_obj, actuators=actuators,
+                                 status=self.status, site=self.name)
+            if zone_config.therm_name not in groups:
+                groups[zone_config.therm_name] = []
+                order.append(zone_config.therm_name)
+            groups[zone_config.therm_name].append(zone_obj)
+
+            if report:
+                zone_obj.observer = report.production
+
+        for therm_name in order:
+            group = zone.ZoneGroup(groups[therm_name])
+            workers.append((group.name, group.run, ()))
+            for zone_obj in group.zones:
+                self.zones[zone_obj.name] = (zone_obj, group)
+
+        self.zone_configs = zone_configs
+        self.load_limits  = load_limits
+        self.gpio_lines   = gpio_lines
+        self.load_obj     = load_obj
+        workers.append(('Config', self.watch, (setting('CONFIG_WATCH'),)))
+
+        if report:
+            workers += self.build_shadow(report, nest_obj, gpio_obj, state_obj, load_obj, scheduler)
+
+        self.workers = [ (self.label(name), target, args) for (name, target, args) in workers ]
+        self.logger.info(self.label('%d zones' % (len(zone_configs))))
+        return self.workers
+
+    def _mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    # Reload zones.conf when reload_event is set (SIGHUP), or when the file
+    # changed, checked every interval seconds (0 only reloads on the event)
+    def watch(self, interval=10):
+        filename = self.setting('ZONE_CONFIG')
+
+        while True:
+            self.reload_event.wait(interval or None)
+            if self.reload_event.is_set():
+                self.reload_event.clear()
+            else:
+                # Not while it is being replaced, or unchanged
+                mtime = self._mtime(filename)
+                if mtime is None or mtime == self.config_mtime:
+                    continue
+            self.reload()
+
+    # Check the whole of zones.conf, then hand the zones whose settings
+    # changed their new configuration.  Returns the number of zones changed,
+    # or None if the file was not taken (the zones keep running as they were).
+    def reload(self):
+        filename = self.setting('ZONE_CONFIG')
+        self.config_mtime = self._mtime(filename)
+
+        try:
+            zone_configs = config.load_zones(filename)
+            load_limits = config.load_limits(filename)
+
+            if [ zone_config.name for zone_config in zone_configs ] != [ zone_config.name for zone_config in self.zone_configs ]:
+                raise config.ConfigError("zones were added, removed or reordered, restart to apply")
+            running = dict([ (zone_config.name, zone_config) for zone_config in self.zone_configs ])
+            for zone_config in zone_configs:
+                for (field, key) in [ ('therm_name', 'thermostat'), ('actuator', 'actuator') ]:
+                    if getattr(zone_config, field) != getattr(running[zone_config.name], field):
+                        raise config.ConfigError("[zone:%s] %s changed, restart to apply" % (zone_config.name, key))
+
+            config.check_gpio_lines(zone_configs, self.gpio_lines)
+            if config.relay_lines(zone_configs) != config.relay_lines(self.zone_configs):
+                raise config.ConfigError("relay lines changed, restart to apply")
+            if config.sensor_lines(zone_configs) != config.sensor_lines(self.zone_configs):
+                raise config.ConfigError("sensors changed, restart to apply")
+        except (config.ConfigError, ConfigParser.Error) as e:
+            self.logger.error(self.label("%s not reloaded: %s" % (filename, e)))
+            return None
+
+        changed = 0
+        for zone_config in zone_configs:
+            if zone_config != running[zone_config.name]:
+                (zone_obj, group) = self.zones[zone_config.name]
+                group.reconfigure(zone_obj, zone_config)
+                changed += 1
+        self.zone_configs = zone_configs
+
+        if load_limits.__dict__ != self.load_limits.__dict__:
+            self.load_obj.configure(load_limits.house, load_limits.circuits, load_limits.rotate)
+            self.load_limits = load_limits
+            self.logger.info(self.label("Load limits reloaded"))
+
+        self.logger.info(self.label("%s reloaded, %d of %d zones changed" % (filename, changed, len(zone_configs))))
+        return changed
+
+    # The candidate zones (SHADOW_ZONE class, SHADOW_CONFIG zones) run on the
+    # same Nest and GPIO as the site's, with every action recorded by the
+    # report rather then sent.  They read the site's state and load grants,
+    # but never change them.
+    def build_shadow(self, report, nest_obj, gpio_obj, state_obj, load_obj, scheduler):
+        setting = self.setting
+
+        zone_class = zone.Zone
+        if setting('SHADOW_ZONE'):
+            (module, name) = setting('SHADOW_ZONE').rsplit('.', 1)
+            zone_class = getattr(importlib.import_module(module), name)
+
+        zone_configs = config.load_zones(setting('SHADOW_CONFIG') or setting('ZONE_CONFIG'))
+
+        state_view = shadow.ReadOnlyState(state_obj)
+        load_view = shadow.ReadOnlyLoad(load_obj)
+
+        groups = {}
+        order = []
+        for zone_config in zone_configs:
+            sink = shadow.RecordingSink(report, zone_config.name)
+            actuators = { zone_config.actuator : sink }
+            zone_obj = zone_class(nest_obj, gpio_obj, sink, state_view, config=zone_config,
+                                  scheduler=scheduler, load=load_view, actuators=actuators,
+                                  site=' '.join(filter(None, [ self.name, 'shadow' ])))
+            if zone_config.therm_name not in groups:
+                groups[zone_config.therm_name] = []
+                order.append(zone_config.therm_name)
+            groups[zone_config.therm_name].append(zone_obj)
+
+        workers = []
+        for therm_name in order:
+            group = zone.ZoneGroup(groups[therm_name])
+            workers.append(('Shadow %s' % (group.name), group.run, ()))
+        workers.append(('Shadow Report', report.run, (10, setting('SHADOW_REPORT'))))
+
+        self.logger.info(self.label('%d shadow zones (%s)' % (len(zone_configs), zone_class.__name__)))
+        return workers
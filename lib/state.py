@@ -0,0 +1,118 @@
+# Persistent state checkpointing
+#
+# Zones remember what they last told each device to do.  Saving that to a
+# small local file lets a restart pick up where it left off, instead of
+# re-sending every action to every device.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import os
+import threading
+import logging
+from time import time
+
+# Write the data to a temp file and rename it over the original, so a crash
+# or power loss leaves either the old or the new file -- never half of one.
+def write_atomic(filename, data):
+    tmpname = "%s.tmp" % filename
+
+    fd = open(tmpname, 'w')
+    try:
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+    finally:
+        fd.close()
+
+    os.rename(tmpname, filename)
+
+def read_json(filename):
+    if not filename or not os.path.exists(filename):
+        return None
+
+    fd = open(filename, 'r')
+    try:
+        return json.load(fd)
+    finally:
+        fd.close()
+
+class StateStore():
+    # max_age - seconds a saved entry is trusted for after it was written
+    def __init__(self, filename, max_age=3600):
+        self.logger = logging.getLogger('HVAC.State')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.filename = filename
+            self.max_age  = max_age
+            self.entries  = {}   # name : { 'saved' : time, 'state' : {...} }
+
+            try:
+                data = read_json(self.filename)
+                if data:
+                    self.entries = data
+            except (IOError, ValueError) as e:
+                self.logger.warning("Ignoring unreadable state file %s: %s" % (self.filename, e))
+
+        finally:
+            self.lock.release()
+
+    # Return the saved state for name, or None if missing or stale
+    def get(self, name):
+        try:
+            self.lock.acquire()
+
+            if name not in self.entries:
+                return None
+
+            entry = self.entries[name]
+            age = time() - entry['saved']
+            if age > self.max_age:
+                self.logger.info("%s: saved state is %ds old, ignoring" % (name, age))
+                return None
+
+            return dict(entry['state'])
+
+        finally:
+            self.lock.release()
+
+    def save(self, name, state):
+        try:
+            self.lock.acquire()
+
+            # Unchanged state only needs rewriting to keep it from going stale
+            if name in self.entries and self.entries[name]['state'] == state and \
+               time() - self.entries[name]['saved'] < self.max_age / 2:
+                return
+
+            self.entries[name] = { 'saved' : time(), 'state' : dict(state) }
+
+            try:
+                write_atomic(self.filename, json.dumps(self.entries, sort_keys=True))
+            except (IOError, OSError) as e:
+                self.logger.error("Unable to write state file %s: %s" % (self.filename, e))
+
+        finally:
+            self.lock.release()
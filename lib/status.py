@@ -0,0 +1,344 @@
+# Status server
+#
+# Serves a JSON snapshot of the zones, thermostats, GPIO and pending
+# actions over HTTP.  The snapshot is only rendered again after something
+# changed, every other request is served from the cached copy, and clients
+# sending If-None-Match with the current ETag just get a 304.
+#
+# Zones publish their own snapshot, the workers are read when rendering.
+# Devices may also confirm IFTTT actions with GET /ack?<action>, in place
+# of cgi-bin/hvac-status.
+#
+# GET /events is a server-sent events stream, a snapshot of the zones
+# followed by the parts of a zone that changed as they happen.  Each client
+# has a bounded queue, a client that falls behind is dropped rather then
+# ever holding up a zone.
+#
+# GET /shadow reports how the shadow zones (see shadow.py) compare with
+# the zones in control.
+#
+# When running several sites, each is served under /<site>/, i.e.
+# /cabin/status.  /metrics and /profile are shared by all of them.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import hashlib
+import json
+import Queue
+from time import time
+import threading
+import logging
+
+import metrics
+from profiler import PROFILER
+
+class Client():
+    def __init__(self, size):
+        self.queue   = Queue.Queue(size)
+        self.dropped = False
+
+class Status():
+    # client_buffer - events queued for each stream client before it is dropped
+    # shadow - ShadowReport of the site's shadow zones, if any
+    def __init__(self, nest=None, gpio=None, ifttt=None, load=None, shadow=None, client_buffer=64):
+        self.logger = logging.getLogger('HVAC.Status')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.nest  = nest
+            self.gpio  = gpio
+            self.ifttt = ifttt
+            self.load  = load
+            self.shadow = shadow
+
+            self.zones = {}     # zone name : snapshot
+
+            self.dirty = threading.Event()   # Something changed since the last render
+            self.dirty.set()
+
+            self.body = None    # Cached rendering
+            self.etag = None
+            self.render_lock = threading.Lock()   # One render at a time
+
+            self.client_buffer = client_buffer
+            self.clients  = []  # Stream clients
+            self.event_id = 0
+        finally:
+            self.lock.release()
+
+        for worker in [ nest, gpio, ifttt ]:
+            if worker:
+                worker.registerEvent(self.dirty)
+
+    # Called by the zones with their current state
+    def update(self, name, snapshot):
+        try:
+            self.lock.acquire()
+
+            last = self.zones.get(name) or {}
+            if last == snapshot:
+                return
+            self.zones[name] = snapshot
+
+            changes = {}
+            for key in snapshot:
+                if last.get(key) != snapshot[key]:
+                    changes[key] = snapshot[key]
+            self._publish('zone', { 'zone' : name, 'changes' : changes })
+        finally:
+            self.lock.release()
+
+        self.dirty.set()
+
+    # Queue an event for every stream client, called with the lock held.
+    # Never blocks, a client without room is dropped.
+    def _publish(self, event, data):
+        self.event_id += 1
+        message = 'id: %d\nevent: %s\ndata: %s\n\n' % (self.event_id, event, json.dumps(data, sort_keys=True))
+
+        for client in list(self.clients):
+            try:
+                client.queue.put_nowait(message)
+            except Queue.Full:
+                client.dropped = True
+                self.clients.remove(client)
+                self.logger.info("Dropping stream client, %d events behind" % (self.client_buffer))
+
+    # A new stream client, it starts with a snapshot of every zone
+    def subscribe(self):
+        client = Client(self.client_buffer)
+        try:
+            self.lock.acquire()
+            message = 'id: %d\nevent: snapshot\ndata: %s\n\n' % (self.event_id, json.dumps(self.zones, sort_keys=True))
+            client.queue.put_nowait(message)
+            self.clients.append(client)
+        finally:
+            self.lock.release()
+        return client
+
+    def unsubscribe(self, client):
+        try:
+            self.lock.acquire()
+            if client in self.clients:
+                self.clients.remove(client)
+        finally:
+            self.lock.release()
+
+    def getClients(self):
+        try:
+            self.lock.acquire()
+            return len(self.clients)
+        finally:
+            self.lock.release()
+
+    def _snapshot(self):
+        snapshot = { 'time' : time() }
+
+        try:
+            self.lock.acquire()
+            snapshot['zones'] = dict(self.zones)
+        finally:
+            self.lock.release()
+
+        if self.nest:
+            (updated, thermostats) = self.nest.getThermostats()
+            snapshot['thermostats'] = thermostats
+            snapshot['provisional'] = self.nest.isProvisional()
+
+        if self.gpio:
+            snapshot['gpio'] = { 'value'   : self.gpio.getGpio(),
+                                 'outputs' : self.gpio.getOutputs(),
+                                 'boards'  : self.gpio.getBoards() }
+
+        if self.ifttt:
+            snapshot['actions'] = { 'pending' : self.ifttt.getPending(),
+                                    'queue'   : self.ifttt.getQueueStats() }
+
+        snapshot['stream_clients'] = self.getClients()
+
+        if self.load:
+            (house, granted, waiting) = self.load.getLoad()
+            snapshot['load'] = { 'house'   : house,
+                                 'granted' : sorted(granted),
+                                 'waiting' : waiting }
+
+        return snapshot
+
+    # The metrics of the workers running in processes of their own (see
+    # isolate.py), for the parent's /metrics
+    def getWorkerMetrics(self):
+        collected = []
+        for worker in [ self.nest, self.gpio, self.ifttt ]:
+            if worker and hasattr(worker, 'getMetrics'):
+                collected.append(worker.getMetrics())
+        return collected
+
+    # Returns (etag, body), rendering only if something has changed.  Other
+    # requests wait for a render in progress rather then see the old (or no)
+    # body.
+    def getSnapshot(self):
+        try:
+            self.render_lock.acquire()
+
+            if self.dirty.is_set() or self.body is None:
+                # Clear first, so a change while rendering isn't lost, but
+                # set it again if the render fails
+                self.dirty.clear()
+                try:
+                    body = json.dumps(self._snapshot(), sort_keys=True)
+                except:
+                    self.dirty.set()
+                    raise
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+                try:
+                    self.lock.acquire()
+                    self.body = body
+                    self.etag = etag
+                finally:
+                    self.lock.release()
+
+            return (self.etag, self.body)
+        finally:
+            self.render_lock.release()
+
+class StatusServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # status - the Status, or a dict of site name : Status when serving
+    #          several sites, each under /<site>/
+    def __init__(self, address, status):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StatusHandler)
+        self.logger = logging.getLogger('HVAC.Status')
+        if not isinstance(status, dict):
+            status = { '' : status }
+        self.sites = status
+
+    # Returns (Status, path within the site), or (None, path) for none
+    def site(self, path):
+        if '' in self.sites:
+            return (self.sites[''], path)
+        (site, sep, path) = path.lstrip('/').partition('/')
+        return (self.sites.get(site), '/' + path)
+
+    def run(self):
+        self.serve_forever()
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, code, body='', headers={}):
+        self.send_response(code)
+        for header in headers:
+            self.send_header(header, headers[header])
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+
+        # Shared by all the sites
+        if url.path == '/profile':
+            if url.query == 'start':
+                PROFILER.start()
+            elif url.query == 'stop':
+                PROFILER.stop()
+            self._reply(200, json.dumps(PROFILER.getState()), { 'Content-Type'  : 'application/json',
+                                                                 'Cache-Control' : 'no-cache' })
+            return
+        elif url.path == '/profile/flame':
+            self._reply(200, PROFILER.getFlamegraph(), { 'Content-Type'  : 'text/plain',
+                                                         'Cache-Control' : 'no-cache' })
+            return
+        elif url.path == '/profile/trace':
+            self._reply(200, PROFILER.getTrace(), { 'Content-Type'  : 'application/json',
+                                                    'Cache-Control' : 'no-cache' })
+            return
+        elif url.path == '/metrics':
+            others = []
+            for status in self.server.sites.values():
+                others += status.getWorkerMetrics()
+            self._reply(200, metrics.REGISTRY.expose(others), { 'Content-Type'  : 'text/plain; version=0.0.4',
+                                                                'Cache-Control' : 'no-cache' })
+            return
+
+        (status, path) = self.server.site(url.path)
+        if not status:
+            self._reply(404, 'not found\n', { 'Content-Type' : 'text/plain' })
+        elif path == '/status':
+            (etag, body) = status.getSnapshot()
+            if self.headers.get('If-None-Match') == etag:
+                self._reply(304, headers={ 'ETag' : etag })
+            else:
+                self._reply(200, body, { 'Content-Type'  : 'application/json',
+                                         'Cache-Control' : 'no-cache',
+                                         'ETag'          : etag })
+        elif path == '/events':
+            self._stream(status)
+        elif path == '/shadow' and status.shadow:
+            self._reply(200, json.dumps(status.shadow.getReport()), { 'Content-Type'  : 'application/json',
+                                                                      'Cache-Control' : 'no-cache' })
+        elif path == '/ack' and status.ifttt and url.query:
+            status.ifttt.acknowledge(url.query)
+            self._reply(200, 'accepted\n', { 'Content-Type' : 'text/plain' })
+        else:
+            self._reply(404, 'not found\n', { 'Content-Type' : 'text/plain' })
+
+    do_HEAD = do_GET
+
+    def _stream(self, status, keepalive=15):
+        self.close_connection = 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        # A client that stops reading blocks this thread, not the zones,
+        # and is dropped once its queue fills
+        self.connection.settimeout(keepalive * 2)
+
+        client = status.subscribe()
+        try:
+            while not client.dropped:
+                try:
+                    message = client.queue.get(True, keepalive)
+                except Queue.Empty:
+                    message = ': keepalive\n\n'
+                self.wfile.write(message)
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            status.unsubscribe(client)
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("%s %s" % (self.address_string(), format % args))
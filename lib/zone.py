@@ -26,20 +26,40 @@
 import nest
 import gpio
 import ifttt
+import config as zoneconfig
+import metrics
+from profiler import span
 import threading
-from time import sleep
+from time import time
+import datetime
 import logging
 
+WAKEUPS   = metrics.counter('zone_wakeups_total', 'Zone thread wakeups', [ 'site', 'zone', 'reason' ])
+RECONCILE = metrics.counter('zone_reconcile_total', 'Zone reconcile passes', [ 'site', 'zone' ])
+DECISIONS = metrics.counter('zone_actions_total', 'Device changes decided by the zones', [ 'site', 'zone' ])
+
 class Zone():
-    # The class that uses this MUST set has_heat, has_cool, has_fan
+    # Zones are normally defined by a ZoneConfig (see zones.conf), otherwise
+    # the class that uses this MUST set has_heat, has_cool, has_fan
     # ifttt_* actions, and therm_name
-    def __init__(self, nest=None, gpio=None, ifttt=None):
+    def __init__(self, nest=None, gpio=None, ifttt=None, state=None, config=None, scheduler=None, load=None,
+                 actuators=None, status=None, site=''):
         self.logger = logging.getLogger('HVAC.Zone')
 
         self.nest        = nest
         self.gpio        = gpio
         self.ifttt       = ifttt
-
+        self.actuators   = actuators or {}  # name : backend, other then ifttt
+        self.actuator    = 'ifttt'  # Backend the actions are sent to
+        self.state       = state   # StateStore used to checkpoint the fields below
+        self.scheduler   = scheduler  # Wakes us at time of day rule boundaries
+        self.load        = load       # LoadManager granting power to the heater and A/C
+        self.status      = status     # Status server we publish our snapshot to
+        self.site        = site       # Name of the site (house) we're in, '' if only one
+        self.observer    = None       # Called with (zone name, action) for each action sent
+
+        self.name         = None  # Zone name from the configuration
+        self.config       = None  # ZoneConfig we're running with
         self.display_name = None
 
         self.has_heat    = False  # IFTTT controllable (secondary) heat
@@ -62,7 +82,10 @@ class Zone():
         self.ifttt_heating_off  = None
         self.ifttt_heating_temp = None
 
-        # Current zone settings
+        self.ifttt_cooling_fan  = {}  # fan speed : action
+
+        # Current zone settings, as last acknowledged by the devices.
+        # reconcile() moves these towards desired_state()
         self.fan_on       = None  # Is the fan on or off?
 
         self.heat_on      = None  # Is the heater on or off?
@@ -82,6 +105,21 @@ class Zone():
         self.ac_temp_default = 70  # Default temp if no info from the thermostat
         self.ac_cooling_on_offset  = -2 # When cooling drop temp by N degrees
         self.ac_cooling_off_offset =  2 # When NOT cooling raise temp by N degrees
+        self.ac_cooling_fan    = None  # Air conditioner fan speed
+        self.cooling_fan_rules = {}    # cooling/idle : [ fan speed for each hour ]
+        self.setback_rules     = {}    # heating/cooling : [ degrees added to the target each hour ]
+
+        self.ratings     = {}    # Device ratings (heat_watts, cool_watts)
+        self.load_circuit  = None  # Circuit the devices are on
+        self.load_priority = 5     # Lower is more important
+        self.load_wanted   = {}    # heat/cool : wants to run
+
+        # Device state that survives a restart (see checkpoint/restore_state)
+        self.state_fields = [ 'fan_on',
+                              'heat_on', 'heating_on', 'heating_temp',
+                              'ac_on', 'ac_cooling', 'ac_temp', 'ac_cooling_fan',
+                              'stage_on' ]
+        self.state_restored = False
 
         # Nest specific settings
         self.therm_id      = None  # ID for this thermostat (set by looking up the name)
@@ -90,78 +128,146 @@ class Zone():
         self.therm_target_low  = 0     # Degrees F thermostat min temp (default value)
         self.therm_target_high = 0     # Degrees F thermostat max temp (default value)
         self.therm_ambient = None  # Degrees F thermostat has detected
+        self.sensor        = None  # GPIO line of a local temperature sensor
+        self.local_ambient = None  # Degrees F from the local sensor
+        self.ambient_hysteresis = 0.3  # Degrees F past the half degree before the compensation moves
+        self.compensation  = {}    # heating/cooling : whole degrees F last compensated to
         self.therm_mode    = None  # Mode thermostat is set to: off, heat, cool, heat-cool, eco
         self.therm_state   = None  # Current state: off, heating, cooling
+        self.therm_direction = None  # heat-cool/eco: last heating or cooling state
 
         # GPIO specific settings
         self.gpio_cool    = 0x0
         self.gpio_heat    = 0x0
         self.gpio_fan     = 0x0
+        self.gpio_mask    = 0x0
+        self.gpio_table   = {}    # (last, new) masked GPIO : [ (operation, args) ]
         self.last_gpio    = None
 
-    def _action(self, ifttt_action, args=None):
-        if ifttt_action is None:
-            # Action not implemented...
-            return
-
-        (action, retry) = ifttt_action
-        if args:
-            action = action % (args)
-        self.ifttt.send_action(action, retry)
+        # Additional heating/cooling stages driven by their own GPIO line
+        self.stages       = {}    # stage : { 'gpio' : mask, 'on' : action, 'off' : action }
+        self.stage_on     = {}    # stage : Is this stage's device on?
+
+        # What the GPIO lines are calling for (None until first read)
+        self.call_cool     = None
+        self.call_heat     = None
+        self.call_fan      = None
+        self.call_stage    = {}    # stage : called for?
+        self.call_conflict = False # Both heating and cooling called for
+
+        # How long to wait for the IFTTT acknowledgement channel before
+        # starting anyway (actions can still be sent without it)
+        self.ifttt_ready_timeout = 30
+
+        if config:
+            self.configure(config)
+
+    # Apply a (validated) ZoneConfig to this zone
+    def configure(self, config):
+        self.config       = config
+        self.name         = config.name
+        if self.site:
+            self.logger   = logging.getLogger('HVAC.Zone.%s.%s' % (self.site, config.name))
+        else:
+            self.logger   = logging.getLogger('HVAC.Zone.%s' % config.name)
+        self.display_name = config.display_name
+        self.therm_name   = config.therm_name
+        self.actuator     = config.actuator
+
+        self.ifttt_cooling_fan = {}
+        for action in zoneconfig.ACTIONS:
+            value = config.actions.get(action)
+            if action.startswith('cooling_fan_'):
+                if value:
+                    self.ifttt_cooling_fan[action[len('cooling_fan_'):]] = value
+            else:
+                setattr(self, 'ifttt_%s' % action, value)
 
-    def turn_on_fan(self):
-        if self.has_fan and self.fan_on != True:
-            self._action(self.ifttt_fan_on)
-            self.fan_on = True
+        for setting in config.settings:
+            setattr(self, setting, config.settings[setting])
 
-    def turn_off_fan(self):
-        if self.has_fan and self.fan_on != False:
-            self._action(self.ifttt_fan_off)
-            self.fan_on = False
+        for line in zoneconfig.GPIO_LINES:
+            setattr(self, line, config.gpio.get(line, 0x0))
 
-    def turn_on_heat(self):
-        if self.has_heat and self.heat_on != True:
-            self._action(self.ifttt_heat_on)
-            self.heat_on = True
+        self.stages = {}
+        for stage in config.stages:
+            self.stages[stage] = dict(config.stages[stage])
 
-    def turn_off_heat(self):
-        if self.has_heat and self.heat_on != False:
-            self._action(self.ifttt_heat_off)
-            self.heat_on = False
+        self.sensor = config.sensor
 
-    def turn_on_heating(self):
-        # If both heat and A/C are called for, stop both!
-        if self.ac_cooling == True:
-            self.logger.error("Both heating and cooling called for at the same time!")
-            self.turn_off_ac()
-            self.turn_off_heat()
-            return
+        self.ratings = dict(config.ratings)
+        self.load_circuit = config.load['circuit']
+        self.load_priority = config.load['load_priority']
+        self.cooling_fan_rules = dict(config.fan_rules)
+        self.setback_rules = dict(config.setback_rules)
 
-        if self.has_heat and self.heat_on and self.heating_on != True:
-            self._action(self.ifttt_heating_on)
-            self.heating_on = True
-            self.set_heat_temp()
-
-    def turn_off_heating(self):
-        if self.has_heat and self.heat_on and self.heating_on != False:
-            self._action(self.ifttt_heating_off)
-            self.heating_on = False
-            self.set_heat_temp()
-
-    def set_heat_temp(self, force=False):
-        if not self.has_heat or self.heat_on != True:
-            self.heating_temp = 0
+    def _action(self, ifttt_action, args=None, priority=ifttt.PRIORITY_CONTROL):
+        if ifttt_action is None:
+            # Action not implemented...
             return
 
+        (action, retry) = ifttt_action
+        if args:
+            action = action % (args)
+        result = self.backend().send_action(action, retry, priority)
+        if self.observer and result != False:
+            self.observer(self.name, action)
+        return result
+
+    def backend(self):
+        if self.actuator == 'ifttt':
+            return self.ifttt
+        return self.actuators[self.actuator]
+
+    # Turning things off goes ahead of everything else queued for IFTTT,
+    # fan speed changes go last
+    def action_priority(self, field, value):
+        if isinstance(field, tuple):
+            field = field[0]
+        if value == False and field in [ 'heating_on', 'stage_on', 'heat_on', 'ac_on', 'fan_on' ]:
+            return ifttt.PRIORITY_SAFETY
+        if field in [ 'ac_temp', 'heating_temp' ]:
+            return ifttt.PRIORITY_SETTING
+        if field == 'ac_cooling_fan':
+            return ifttt.PRIORITY_COSMETIC
+        return ifttt.PRIORITY_CONTROL
+
+    def hour(self):
+        return datetime.datetime.now().hour
+
+    # Time of day adjustment to the thermostat target
+    def setback(self, mode):
+        rules = self.setback_rules.get(mode)
+        if rules:
+            return rules[self.hour()]
+        return 0
+
+    # The ambient temperature, in whole degrees, to compensate the set
+    # temperature with.  It only moves once the reading is clearly past the
+    # next half degree, so a local sensor wavering in tenths of a degree
+    # doesn't send a new set temperature with every reading.
+    def compensated(self, direction, ambient):
+        last = self.compensation.get(direction)
+        if last is None or abs(ambient - last) > 0.5 + self.ambient_hysteresis:
+            last = int(round(ambient))
+            self.compensation[direction] = last
+        return last
+
+    # Temperature to set the heater to, 0 when it is not on
+    def heat_temp(self, heating):
         therm_target = self.therm_target_low
         if therm_target == 0:
             therm_target = self.heating_default  # reasonable default
+        therm_target += self.setback('heating')
 
-        if self.heating_on:
+        if heating:
             # There are cases when the nest might call for heating
             # where the set temp is higher then ambient, compensate for this
-            if self.therm_ambient and self.therm_ambient > therm_target:
-                therm_target = self.therm_ambient
+            ambient = self.ambient()
+            if ambient:
+                ambient = self.compensated('heating', ambient)
+                if ambient > therm_target:
+                    therm_target = ambient
             target_temp = therm_target + self.heating_on_offset
         else:
             target_temp = therm_target + self.heating_off_offset
@@ -170,58 +276,25 @@ class Zone():
             target_temp = self.heating_min
 
         if target_temp > self.heating_max:
-            target_temp  = self.heading_max
+            target_temp  = self.heating_max
 
-        if force or (target_temp != self.heating_temp):
-            self.heating_temp = target_temp
-            self._action(self.ifttt_heating_temp, self.heating_temp)
-
-
-    def turn_on_ac(self):
-        if self.has_cool and self.ac_on != True:
-            self._action(self.ifttt_cool_on)
-            self.ac_on = True
-
-    def turn_off_ac(self):
-        if self.has_cool and self.ac_on != False:
-            self._action(self.ifttt_cool_off)
-            self.ac_on = False
-
-    def turn_on_cooling(self):
-        # If both heat and A/C are called for, stop both!
-        if self.heating_on == True:
-            self.logger.error("Both heating and cooling called for at the same time!")
-            self.turn_off_ac()
-            self.turn_off_heat()
-            return
-
-        if self.has_cool and self.ac_on and self.ac_cooling != True:
-            self._action(self.ifttt_cooling_on)
-            self.ac_cooling = True
-            # Whenever we change modes, we MUST set the temp
-            self.set_ac_temp(force=True)
-
-    def turn_off_cooling(self):
-        if self.has_cool and self.ac_on and self.ac_cooling != False:
-            self._action(self.ifttt_cooling_off)
-            self.ac_cooling = False
-            # Whenever we change modes, we MUST set the temp
-            self.set_ac_temp(force=True)
-
-    def set_ac_temp(self, force=False):
-        if not self.has_cool or self.ac_on != True:
-            self.ac_temp = 0
-            return
+        return int(round(target_temp))
 
+    # Temperature to set the air conditioner to
+    def ac_set_temp(self, cooling):
         therm_target = self.therm_target_high
         if therm_target == 0:
             therm_target = self.ac_temp_default  # reasonable default
+        therm_target += self.setback('cooling')
 
-        if self.ac_cooling:
+        if cooling:
             # There are cases when the nest might call for cooling
             # where the set temp is higher then ambient, compensate for this
-            if self.therm_ambient and self.therm_ambient < therm_target:
-                therm_target = self.therm_ambient
+            ambient = self.ambient()
+            if ambient:
+                ambient = self.compensated('cooling', ambient)
+                if ambient < therm_target:
+                    therm_target = ambient
             target_temp = therm_target + self.ac_cooling_on_offset
         else:
             target_temp = therm_target + self.ac_cooling_off_offset
@@ -232,46 +305,278 @@ class Zone():
         if target_temp > self.ac_max:
             target_temp  = self.ac_max
 
-        if force or (target_temp != self.ac_temp):
-            self.ac_temp = target_temp
-            self._action(self.ifttt_cooling_temp, self.ac_temp)
-
-    def turn_on_fan(self):
-        if self.has_fan and self.fan_on != True:
-            self._action(self.ifttt_fan_on)
-            self.fan_on = True
+        return int(round(target_temp))
 
-    def turn_off_fan(self):
-        if self.has_fan and self.fan_on != False:
-            self._action(self.ifttt_fan_off)
-            self.fan_on = False
-
-
-    def init_nest(self, thermostats):
-        if not self.therm_name:
-            raise Exception("No thermostat 'name_long' (self.therm_name) defined!")
+    # Fan speed of the air conditioner.  The faster the fan, the louder it is
+    # so we follow the time of day rules for the zone.
+    def ac_fan_speed(self, cooling):
+        if cooling:
+            rules = self.cooling_fan_rules.get('cooling')
+        else:
+            rules = self.cooling_fan_rules.get('idle')
+
+        if rules:
+            return rules[self.hour()]
+        return None
+
+    # Room temperature, the local sensor is read far more often then the
+    # Nest reports so it is preferred
+    def ambient(self):
+        if self.local_ambient is not None:
+            return self.local_ambient
+        return self.therm_ambient
+
+    # Which devices the thermostat mode wants powered: (ac, heat)
+    # None means we don't know yet.
+    def mode_power(self):
+        mode = self.therm_mode
+        if mode is None:
+            return (None, None)
+        if mode == "off":
+            return (False, False)
+        if mode == "heat":
+            return (False, True)
+        if mode == "cool":
+            return (True, False)
+
+        # heat-cool and eco, follow what the thermostat last did
+        if self.therm_direction == 'heating':
+            return (False, True)
+        if self.therm_direction == 'cooling':
+            return (True, False)
+        return (True, True)
+
+    # Compute the one device state we want from the Nest and GPIO inputs.
+    # None means "don't care", that device is left as it is.  held are the
+    # kinds (heat/cool) without a load grant, they wait in eco.
+    def desired_state(self, held=()):
+        desired = {}
+        for field in self.state_fields:
+            desired[field] = None
+        desired['stage_on'] = {}
+
+        (ac_power, heat_power) = self.mode_power()
+
+        # GPIO always overrules the Nest, when we have no idea of the unit's state
+        has_cool = self.has_cool or (self.call_cool and self.ac_on is None)
+        has_heat = self.has_heat or (self.call_heat and self.heat_on is None)
+        has_fan  = self.has_fan  or (self.call_fan  and self.fan_on is None)
+
+        if ac_power is None and self.call_cool:
+            ac_power = True
+        if heat_power is None and self.call_heat:
+            heat_power = True
 
-        for id in thermostats:
-            thermostat = thermostats[id]
+        # If both heat and A/C are called for, stop both!
+        conflict = bool(self.call_cool and self.call_heat)
+        if conflict and not self.call_conflict:
+            self.logger.error("Both heating and cooling called for at the same time!")
+        self.call_conflict = conflict
+        if conflict:
+            ac_power = False
+            heat_power = False
+
+        self.load_wanted = {}
+
+        if has_cool:
+            desired['ac_on'] = ac_power
+            if ac_power:
+                call = self.call_cool
+                if call:
+                    self.load_wanted['cool'] = True
+                    if 'cool' in held:
+                        # Wait in eco until there is capacity to cool
+                        call = False
+                desired['ac_cooling'] = call
+                cooling = self.ac_cooling
+                if call is not None:
+                    cooling = call
+                desired['ac_temp'] = self.ac_set_temp(cooling)
+                desired['ac_cooling_fan'] = self.ac_fan_speed(cooling)
+            elif ac_power == False:
+                desired['ac_temp'] = 0
+
+        if has_heat:
+            desired['heat_on'] = heat_power
+            if heat_power:
+                call = self.call_heat
+                if call:
+                    self.load_wanted['heat'] = True
+                    if 'heat' in held:
+                        call = False
+                desired['heating_on'] = call
+                heating = self.heating_on
+                if call is not None:
+                    heating = call
+                desired['heating_temp'] = self.heat_temp(heating)
+            elif heat_power == False:
+                # Without power the heater is not heating either
+                desired['heating_on'] = False
+                desired['heating_temp'] = 0
+
+        if has_fan:
+            desired['fan_on'] = self.call_fan
+
+        # Additional stages follow their own GPIO line, when the mode allows
+        for stage in self.stages:
+            call = self.call_stage.get(stage)
+            if stage.startswith('heat'):
+                power = has_heat and heat_power
+            else:
+                power = has_cool and ac_power
+            if power == False:
+                call = False
+            desired['stage_on'][stage] = call
+
+        return desired
+
+    # The minimal ordered list of (field, value, action, args) to move the
+    # devices from the last acknowledged state to the desired one.  Things
+    # are turned off before anything is turned on.
+    def plan(self, desired):
+        steps = []
+
+        def changed(field, value):
+            return value is not None and getattr(self, field) != value
+
+        def step(field, value, action, args=None):
+            steps.append((field, value, action, args))
+
+        # Off first
+        if desired['heating_on'] == False and changed('heating_on', False):
+            step('heating_on', False, self.ifttt_heating_off)
+        for stage in sorted(desired['stage_on']):
+            if desired['stage_on'][stage] == False and self.stage_on.get(stage) != False:
+                step(('stage_on', stage), False, self.stages[stage]['off'])
+        if desired['heat_on'] == False and changed('heat_on', False):
+            step('heat_on', False, self.ifttt_heat_off)
+        if desired['ac_on'] == False and changed('ac_on', False):
+            step('ac_on', False, self.ifttt_cool_off)
+        if desired['fan_on'] == False and changed('fan_on', False):
+            step('fan_on', False, self.ifttt_fan_off)
+
+        # Air conditioner: power, mode, temp then fan
+        if desired['ac_on'] == True and changed('ac_on', True):
+            step('ac_on', True, self.ifttt_cool_on)
+        mode_changed = changed('ac_cooling', desired['ac_cooling'])
+        if mode_changed:
+            if desired['ac_cooling']:
+                step('ac_cooling', True, self.ifttt_cooling_on)
+            else:
+                step('ac_cooling', False, self.ifttt_cooling_off)
+        if desired['ac_temp'] == 0 and changed('ac_temp', 0):
+            step('ac_temp', 0, None)
+        elif desired['ac_temp'] and (mode_changed or changed('ac_temp', desired['ac_temp'])):
+            # Whenever we change modes, we MUST set the temp
+            step('ac_temp', desired['ac_temp'], self.ifttt_cooling_temp, desired['ac_temp'])
+        if changed('ac_cooling_fan', desired['ac_cooling_fan']):
+            step('ac_cooling_fan', desired['ac_cooling_fan'],
+                 self.ifttt_cooling_fan.get(desired['ac_cooling_fan']))
+
+        # Heater: power, heating then temp
+        if desired['heat_on'] == True and changed('heat_on', True):
+            step('heat_on', True, self.ifttt_heat_on)
+        if desired['heating_on'] == True and changed('heating_on', True):
+            step('heating_on', True, self.ifttt_heating_on)
+        if desired['heating_temp'] == 0 and changed('heating_temp', 0):
+            step('heating_temp', 0, None)
+        elif desired['heating_temp'] and changed('heating_temp', desired['heating_temp']):
+            step('heating_temp', desired['heating_temp'], self.ifttt_heating_temp, desired['heating_temp'])
+
+        if desired['fan_on'] == True and changed('fan_on', True):
+            step('fan_on', True, self.ifttt_fan_on)
+
+        for stage in sorted(desired['stage_on']):
+            if desired['stage_on'][stage] == True and self.stage_on.get(stage) != True:
+                step(('stage_on', stage), True, self.stages[stage]['on'])
+
+        return steps
+
+    # Bring the devices in line with the desired state, sending only the
+    # actions that are needed.  Cheap to call when nothing has changed.
+    #
+    # A device that is on keeps running while its grant holds.  One that is
+    # off asks for a grant just before the step turning it on, and without
+    # one the rest is planned again with it held in eco.
+    def reconcile(self):
+        RECONCILE.label(self.site, self.name).inc()
+
+        # (field, value) of the step turning each kind on
+        turn_on = { ('heating_on', True) : 'heat', ('ac_cooling', True) : 'cool' }
+
+        held = []
+        for (kind, on, call) in [ ('heat', self.heating_on, self.call_heat), ('cool', self.ac_cooling, self.call_cool) ]:
+            if on == True and call and not self.load_granted(kind):
+                held.append(kind)
+
+        steps = self.plan(self.desired_state(held))
+        while steps:
+            (field, value, action, args) = steps.pop(0)
+            kind = turn_on.get((field, value))
+            if kind and not self.load_granted(kind):
+                held.append(kind)
+                steps = self.plan(self.desired_state(held))
+                continue
 
-            if thermostat['name_long'] == self.therm_name:
-                self.therm_id = id
+            DECISIONS.label(self.site, self.name).inc()
+            if self._action(action, args, self.action_priority(field, value)) == False:
+                # The device didn't take it, try again on the next pass
+                self.logger.warning("%s: %s not acknowledged" % (self.display_name or self.therm_name, action[0]))
                 break
 
-        if not self.therm_id:
-            msg = "Thermostat %s not found!\nAvailable thermostats:\n" % (self.therm_name)
-            for id in thermostats:
-                msg += "  %s\n" % (thermostats[id]['name_long'])
-            self.logger.error(msg)
+            if isinstance(field, tuple):
+                getattr(self, field[0])[field[1]] = value
+            else:
+                setattr(self, field, value)
+
+        # Give back capacity once a device is off
+        if self.load:
+            for (kind, on) in [ ('heat', self.heating_on), ('cool', self.ac_cooling) ]:
+                device = '%s.%s' % (self.name, kind)
+                if on != True:
+                    self.load.release(device)
+                if not self.load_wanted.get(kind):
+                    self.load.cancel(device)
+
+    # Register our heater and air conditioner with the load manager,
+    # callback is run when the grant changes
+    def register_load(self, callback):
+        if not self.load:
+            return
 
-        return self.therm_id
+        for kind in [ 'heat', 'cool' ]:
+            watts = self.ratings.get('%s_watts' % kind)
+            if watts:
+                self.load.register('%s.%s' % (self.name, kind), watts,
+                                   self.load_circuit, self.load_priority, callback)
 
-    def update_nest(self, thermostats):
-        if not self.therm_id:
-            if not self.init_nest(thermostats):
-                self.logger.error("Thermostat not found for %s!" % self.therm_name)
-                return
+    # Stop managing the devices that were rated in ratings, but no longer are
+    def deregister_load(self, ratings):
+        if not self.load:
+            return
 
+        for kind in [ 'heat', 'cool' ]:
+            watts = '%s_watts' % kind
+            if ratings.get(watts) and not self.ratings.get(watts):
+                self.load.deregister('%s.%s' % (self.name, kind))
+
+    # May the heater/air conditioner run?  The load manager ranks the waiting
+    # devices by how far they are from target, 0 while the ambient is unknown.
+    def load_granted(self, kind):
+        if not self.load:
+            return True
+
+        deficit = 0
+        ambient = self.ambient()
+        if ambient is not None:
+            if kind == 'cool' and self.therm_target_high is not None:
+                deficit = ambient - self.therm_target_high
+            elif kind == 'heat' and self.therm_target_low is not None:
+                deficit = self.therm_target_low - ambient
+        return self.load.request('%s.%s' % (self.name, kind), deficit)
+
+    @span('Zone.update_nest')
+    def update_nest(self, thermostats):
         thermostat = thermostats[self.therm_id]
         self.therm_data = thermostat
 
@@ -288,11 +593,10 @@ class Zone():
         else:
             self.set_nest_temp(thermostat['target_temperature_f'], thermostat['target_temperature_f'])
 
-        # We need to set the mode -after- the temp, so on startup we don't end up sending
-        # it twice...
         self.set_nest_mode(thermostat['hvac_mode'])
         self.set_nest_state(thermostat['hvac_state'])
 
+        self.reconcile()
         self.getStatus()
 
     def set_nest_has_fan(self, fan):
@@ -309,53 +613,88 @@ class Zone():
 
     def set_nest_mode(self, mode):
         if self.therm_mode != mode:
-            if mode == "off":
-                self.turn_off_ac()
-                self.turn_off_heat()
-            elif mode == "heat":
-                self.turn_off_ac()
-                self.turn_on_heat()
-            elif mode == "cool":
-                self.turn_on_ac()
-                self.turn_off_heat()
-            elif mode == "heat-cool":
-                self.turn_on_ac()
-                self.turn_on_heat()
-            elif mode == "eco":
-                self.turn_on_ac()
-                self.turn_on_heat()
-            else:
+            if mode not in [ "off", "heat", "cool", "heat-cool", "eco" ]:
                 raise Exception("Unknown mode: %s" % mode)
 
             self.therm_mode = mode
+            # In heat-cool/eco both devices are available until the
+            # thermostat starts heating or cooling
+            self.therm_direction = None
 
     def set_nest_state(self, mode):
-        if self.therm_state != mode:
-            if self.therm_mode == 'heat-cool' or self.therm_mode == 'eco':
-                if mode == 'heating':
-                    self.turn_on_heat()
-                    self.turn_off_ac()
-                if mode == 'cooling':
-                    self.turn_on_ac()
-                    self.turn_off_heat()
+        if mode == 'heating' or mode == 'cooling':
+            self.therm_direction = mode
 
-            self.therm_state = mode
+        self.therm_state = mode
 
     def set_nest_ambient(self, temp):
         self.therm_ambient = temp
  
     def set_nest_temp(self, temp_low, temp_high):
-        if self.therm_target_low != temp_low:
-            self.therm_target_low = temp_low
-            self.set_heat_temp()
-
-        if self.therm_target_high != temp_high:
-            self.therm_target_high = temp_high
-            self.set_ac_temp()
+        self.therm_target_low = temp_low
+        self.therm_target_high = temp_high
+
+    # GPIO line is active (0) when the thermostat is calling for it
+    def set_gpio_call(self, call, active):
+        setattr(self, 'call_%s' % call, active)
+
+    def set_stage_call(self, stage, active):
+        self.call_stage[stage] = active
+
+    # Precompute the operations for every (previous, new) masked GPIO value,
+    # so each GPIO edge is a single lookup.
+    def compile_gpio(self):
+        # (mask, operations when active (0), operations when inactive)
+        channels = []
+        for call in [ 'cool', 'heat', 'fan' ]:
+            mask = getattr(self, 'gpio_%s' % call)
+            if mask:
+                channels.append((mask, [(self.set_gpio_call, (call, True))],
+                                       [(self.set_gpio_call, (call, False))]))
+        for stage in sorted(self.stages):
+            channels.append((self.stages[stage]['gpio'],
+                             [(self.set_stage_call, (stage, True))],
+                             [(self.set_stage_call, (stage, False))]))
+
+        self.gpio_mask = 0x0
+        for (mask, on_ops, off_ops) in channels:
+            self.gpio_mask |= mask
+
+        # Every value the masked lines can take
+        values = [0]
+        bit = 0
+        while self.gpio_mask >> bit:
+            if self.gpio_mask & (1 << bit):
+                values += [value | (1 << bit) for value in values]
+            bit += 1
+
+        self.gpio_table = {}
+        for last in [None] + values:
+            for lines in values:
+                ops = []
+                for (mask, on_ops, off_ops) in channels:
+                    if last is not None and (lines & mask) == (last & mask):
+                        continue
+                    if not lines & mask:
+                        ops += on_ops
+                    else:
+                        ops += off_ops
+                self.gpio_table[(last, lines)] = ops
 
+    @span('Zone.update_gpio')
     def update_gpio(self, gpio_lines):
-        # It may be too early to process this...
+        # It may be too early to process this, or a board was lost and the
+        # lines are unknown.  Drop the calls we had until they are read again.
         if gpio_lines is None:
+            if self.last_gpio is not None:
+                self.logger.warning("%s: GPIO unavailable, dropping calls" % (self._state_name()))
+                self.call_cool  = None
+                self.call_heat  = None
+                self.call_fan   = None
+                self.call_stage = {}
+                self.last_gpio  = None
+                self.reconcile()
+                self.getStatus()
             return
 
         gpio_lines = gpio_lines & self.gpio_mask
@@ -364,48 +703,29 @@ class Zone():
             if self.last_gpio == gpio_lines:
                 return
 
-            # Cooling
-            if (self.gpio_cool != 0) and (self.last_gpio is None or (gpio_lines & self.gpio_cool) != (self.last_gpio & self.gpio_cool)):
-                if not gpio_lines & self.gpio_cool:  #  0 is cooling
-                    # GPIO always overrules the Nest...
-                    if self.ac_on is None:
-                        # First time through, no idea the state of the air con unit...
-                        self.has_cool = True
-                        self.turn_on_ac()
-                    self.turn_on_cooling()
-                elif gpio_lines & self.gpio_cool:    # !0 is off
-                    self.turn_off_cooling()
-
-            # Heating
-            if (self.gpio_heat != 0) and (self.last_gpio is None or (gpio_lines & self.gpio_heat) != (self.last_gpio & self.gpio_heat)):
-                if not gpio_lines & self.gpio_heat:  #  0 is heating
-                    # GPIO always overrules the Nest...
-                    if self.heat_on is None:
-                        # First time through, no idea the state of the air con unit...
-                        self.has_heat = True
-                        self.turn_on_heat()
-                    self.turn_on_heating()
-                elif gpio_lines & self.gpio_heat:    # !0 is off
-                    self.turn_off_heating()
-
-            # Fan
-            if (self.gpio_fan != 0) and (self.last_gpio is None or (gpio_lines & self.gpio_fan) != (self.last_gpio & self.gpio_fan)):
-                if not gpio_lines & self.gpio_fan:  #  0 is fan on
-                    # GPIO always overrules the Nest...
-                    if self.fan_on is None:
-                        # First time through, no idea the state of the air con unit...
-                        self.has_fan = True
-                        self.turn_on_fan()
-                    self.turn_on_fan()
-                elif gpio_lines & self.gpio_fan:    # !0 is off
-                    self.turn_off_fan()
+            for (op, args) in self.gpio_table[(self.last_gpio, gpio_lines)]:
+                op(*args)
 
+            self.reconcile()
             self.getStatus()
 
+            changed = self.gpio.getGpioTime()
+            if changed:
+                self.logger.debug("%s: GPIO change handled after %.1fms" % (self._state_name(), (time() - changed) * 1000))
+
         finally:
             self.last_gpio = gpio_lines
 
 
+    def update_sensor(self):
+        if self.sensor is None:
+            return
+
+        temp = self.gpio.getTemperature(self.sensor)
+        if temp != self.local_ambient:
+            self.local_ambient = temp
+            self.reconcile()
+
     def getStatus(self):
         thermostat = self.therm_data
 
@@ -446,62 +766,302 @@ class Zone():
             else:
                 status = '%s to %s' % (status, temp_string)
 
-        self.logger.info("%s: %s (current %sF %s%%)" % (
+        # Until the live stream connects we are working from the cached snapshot
+        if self.nest.isProvisional():
+            status += " [provisional]"
+
+        local = ""
+        if self.local_ambient is not None:
+            local = " local %.1fF" % (self.local_ambient)
+
+        self.logger.info("%s: %s (current %sF %s%%%s)" % (
                  self.display_name or self.therm_name,
                  status,
                  thermostat['ambient_temperature_f'],
-                 thermostat['humidity'] ))
+                 thermostat['humidity'],
+                 local ))
 
 
-    def run(self):
-        self.gpio_mask    = self.gpio_cool | self.gpio_heat | self.gpio_fan
+    def _state_name(self):
+        return self.display_name or self.name or self.therm_name
 
-        zone_event = threading.Event()
-        zone_gpio  = threading.Event()
-        zone_nest  = threading.Event()
+    # Reload the last known device state, so we only send what is needed
+    def restore_state(self):
+        if self.state_restored or not self.state:
+            return
+        self.state_restored = True
 
-        self.gpio.registerEvent(zone_event)
-        self.gpio.registerEvent(zone_gpio)
+        saved = self.state.get(self._state_name())
+        if not saved:
+            return
+
+        for field in self.state_fields:
+            if field in saved:
+                setattr(self, field, saved[field])
+
+        self.logger.info("%s: restored device state %s" % (self._state_name(), saved))
+
+    # Save the current device state, the store only writes if it changed
+    def checkpoint(self):
+        if not self.state:
+            return
+
+        current = {}
+        for field in self.state_fields:
+            current[field] = getattr(self, field)
+
+        self.state.save(self._state_name(), current)
+
+    # Current inputs and device state, for the status server
+    def snapshot(self):
+        devices = {}
+        for field in self.state_fields:
+            value = getattr(self, field)
+            if isinstance(value, dict):
+                value = dict(value)
+            devices[field] = value
+
+        return { 'display_name' : self._state_name(),
+                 'thermostat'   : { 'name'        : self.therm_name,
+                                    'mode'        : self.therm_mode,
+                                    'state'       : self.therm_state,
+                                    'target_low'  : self.therm_target_low,
+                                    'target_high' : self.therm_target_high,
+                                    'ambient'     : self.therm_ambient },
+                 'local_ambient' : self.local_ambient,
+                 'calls'        : { 'cool'  : self.call_cool,
+                                    'heat'  : self.call_heat,
+                                    'fan'   : self.call_fan,
+                                    'stage' : dict(self.call_stage) },
+                 'devices'      : devices,
+                 'load_wanted'  : dict(self.load_wanted),
+                 'actuator'     : self.actuator }
+
+    def publish(self):
+        if self.status:
+            self.status.update(self.name or self._state_name(), self.snapshot())
+
+    # Hours of the day at which any of our time of day rules change
+    def rule_boundaries(self):
+        boundaries = set()
+        for rules in self.cooling_fan_rules.values() + self.setback_rules.values():
+            for hour in range(24):
+                if rules[hour] != rules[hour - 1]:
+                    boundaries.add(hour)
+        return sorted(boundaries)
+
+    def schedule_rules(self, callback):
+        if not self.scheduler:
+            return
 
-        self.nest.registerEvent(zone_event)
-        self.nest.registerEvent(zone_nest)
+        self.scheduler.deregister(callback)
+        for hour in self.rule_boundaries():
+            self.scheduler.register(hour, 0, callback)
 
-        # Give the system a chance to start up and query
-        sleep(5)
+    def wait_ready(self):
+        start = time()
+        stages = []
+
+        self.nest.waitReady()
+        stages.append("nest %.2fs" % (time() - start))
+
+        if self.gpio_mask:
+            self.gpio.waitReady()
+            stages.append("gpio %.2fs" % (time() - start))
+
+        if self.actuator == 'ifttt':
+            if not self.ifttt.waitReady(self.ifttt_ready_timeout):
+                self.logger.warning("%s: IFTTT acknowledgement channel not ready, starting anyway" % (
+                         self.display_name or self.therm_name))
+            stages.append("ifttt %.2fs" % (time() - start))
+
+        self.logger.info("%s: ready after %.2fs (%s)" % (
+                 self.display_name or self.therm_name,
+                 time() - start,
+                 ", ".join(stages)))
+
+    # Set up the zone's events, group_event is set (after the more specific
+    # event) whenever there is something for the zone to handle
+    def prepare(self, group_event):
+        self.compile_gpio()
+
+        self.gpio_event = threading.Event()
+        self.wakeup_event = threading.Event()
+
+        # Time of day boundaries and load grant changes.  All of our rules
+        # changing at the same boundary are handled in one pass.
+        def wakeup():
+            self.wakeup_event.set()
+            group_event.set()
+        self.wakeup = wakeup
+        self.schedule_rules(wakeup)
+        self.register_load(wakeup)
+
+        self.gpio.registerEvent(self.gpio_event)
+        self.gpio.registerEvent(group_event)
 
         # Start off by parsing everything
-        zone_event.set()
-        zone_gpio.set()
-        zone_nest.set()
+        self.gpio_event.set()
+
+    # Swap in a changed (validated) ZoneConfig while running, from the zone's
+    # thread.  What the devices were last sent is kept, so only the actions
+    # the new settings call for are sent.
+    def reconfigure(self, config):
+        ratings = self.ratings
+        self.configure(config)
+
+        self.compile_gpio()
+        self.schedule_rules(self.wakeup)
+        self.deregister_load(ratings)
+        self.register_load(self.wakeup)
+
+        # The GPIO lines may mean something else now, read them all again
+        self.call_cool  = None
+        self.call_heat  = None
+        self.call_fan   = None
+        self.call_stage = {}
+        self.last_gpio  = None
+
+        self.logger.info("%s: configuration reloaded" % (self.display_name or self.therm_name))
+
+        if self.therm_id:
+            self.update_gpio(self.gpio.getGpio())
+            self.reconcile()
+
+    # Periodic sweep, only sends something if a device is out of step
+    def sweep(self):
+        WAKEUPS.label(self.site, self.name, 'sweep').inc()
+        if self.therm_id:
+            self.reconcile()
+            self.checkpoint()
+            self.publish()
+
+    # Handle whatever woke us.  nest is set if the Nest data changed, and
+    # thermostat is our thermostat's (therm_id) data if it has changed.
+    def handle(self, nest, therm_id, thermostat):
+        # Process the nest first, so we can hopefully setup the state
+        # of the HVAC system...
+        if nest:
+            WAKEUPS.label(self.site, self.name, 'nest').inc()
+            if thermostat is not None:
+                self.therm_id = therm_id
+                self.update_nest({ therm_id : thermostat })
 
-        last_updated = 0
+        if not self.therm_id:
+            self.logger.debug("Waiting for Nest data to start up zone GPIO control...")
+            return
 
-        while True:
-            event = zone_event.wait(60)
-            if not event:
-                continue
-            zone_event.clear()
-
-            # Process the nest first, so we can hopefully setup the state
-            # of the HVAC system...
-            event = zone_nest.wait(.1)
-            if event:
-                zone_nest.clear()
-                (updated, thermostats) = self.nest.getThermostats()
-                if updated and self.therm_id:
-                    if updated[self.therm_id] <= last_updated:
-                        continue
-                    else:
-                        last_updated = updated[self.therm_id]
-                self.update_nest(thermostats)
+        # A time of day rule boundary passed, or our load grant changed
+        if self.wakeup_event.is_set():
+            self.wakeup_event.clear()
+            WAKEUPS.label(self.site, self.name, 'wakeup').inc()
+            self.logger.debug("%s: woken to reconcile" % (self._state_name()))
+            self.reconcile()
 
-            if not self.therm_id:
-                self.logger.debug("Waiting for Nest data to start up zone GPIO control...")
-                continue
+        # Process the GPIO even if the NEST isn't ready
+        # it will have to assume some basic info...
+        if self.gpio_event.is_set():
+            self.gpio_event.clear()
+            WAKEUPS.label(self.site, self.name, 'gpio').inc()
+            self.update_gpio(self.gpio.getGpio())
+            self.update_sensor()
+
+        self.checkpoint()
+        self.publish()
+
+    def run(self):
+        ZoneGroup([ self ]).run()
+
+# Zones sharing a thermostat, i.e. the stages of one room's heating and
+# cooling spread over the rooms next to it.  The thermostat is resolved
+# once, each change of it is fetched once, and one thread hands it to the
+# zones one after another in the group's order (zones.conf order, first
+# stage first), so the stages act together rather then racing each other.
+class ZoneGroup():
+    def __init__(self, zones):
+        self.logger = logging.getLogger('HVAC.Zone')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.zones      = list(zones)
+            self.nest       = self.zones[0].nest
+            self.therm_name = self.zones[0].therm_name
+            self.name       = ', '.join([ zone.name for zone in self.zones ])
+
+            self.group_event = threading.Event()
+            self.configs     = {}   # zone : ZoneConfig to swap in
+        finally:
+            self.lock.release()
+
+    # Hand a zone of the group a new configuration, it is swapped in by the
+    # group's thread between passes
+    def reconfigure(self, zone, config):
+        try:
+            self.lock.acquire()
+            self.configs[zone] = config
+        finally:
+            self.lock.release()
+        self.group_event.set()
+
+    def _reconfigure(self):
+        try:
+            self.lock.acquire()
+            (configs, self.configs) = (self.configs, {})
+        finally:
+            self.lock.release()
+
+        for zone in self.zones:
+            if zone in configs:
+                zone.reconfigure(configs[zone])
+
+    def run(self):
+        group_event = self.group_event
+        group_nest  = threading.Event()
 
-            # Process the GPIO even if the NEST isn't ready
-            # it will have to assume some basic info...
-            event = zone_gpio.wait(.1)
-            if event:
-                zone_gpio.clear()
-                self.update_gpio(self.gpio.getGpio())
+        for zone in self.zones:
+            zone.prepare(group_event)
+
+        # The specific event is set before group_event, so it can be
+        # checked without waiting once we're woken
+        self.nest.registerEvent(group_nest)
+        self.nest.registerEvent(group_event)
+
+        # Wait for the workers the zones depend on, rather then a fixed delay
+        for zone in self.zones:
+            zone.wait_ready()
+            zone.restore_state()
+
+        group_event.set()
+        group_nest.set()
+
+        therm_id = None
+        last_updated = None
+
+        while True:
+            if not group_event.wait(60):
+                for zone in self.zones:
+                    zone.sweep()
+                continue
+            group_event.clear()
+
+            self._reconfigure()
+
+            nest = group_nest.is_set()
+            thermostat = None
+            if nest:
+                group_nest.clear()
+                if not therm_id:
+                    therm_id = self.nest.getThermostatId(self.therm_name)
+                    if not therm_id and self.nest.isReady():
+                        self.logger.error("Thermostat %s not found for %s!  Available thermostats: %s" % (
+                                 self.therm_name, self.name, ", ".join(self.nest.getThermostatNames())))
+                if therm_id:
+                    # Skip the update if our thermostat hasn't changed, but
+                    # still handle any timer or GPIO events
+                    (last_updated, thermostat) = self.nest.getThermostat(therm_id, last_updated)
+
+            for zone in self.zones:
+                zone.handle(nest, therm_id, thermostat)
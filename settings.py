@@ -3,4 +3,116 @@
 
 IFTTT_TOKEN = "" # IFTTT Token goes here
 NEST_TOKEN  = "" # Nest oauth2 token goes here
-GPIO_SERIAL = "" # Numato 8-port GPIO board port here
+GPIO_SERIAL = "" # Numato 8-port GPIO board port here (or a list of ports)
+
+# Device state checkpoint, used to avoid re-sending actions after a restart.
+# Saved state older then STATE_MAX_AGE seconds is ignored.
+STATE_FILE    = "hvac-state.json"
+STATE_MAX_AGE = 3600
+
+# Last Nest snapshot, preloaded at startup until the live stream connects.
+# A cached snapshot older then NEST_CACHE_MAX_AGE seconds is ignored.
+NEST_CACHE         = "hvac-nest.json"
+NEST_CACHE_MAX_AGE = 3600
+
+# Zone definitions, see zones.conf for the format
+ZONE_CONFIG = "zones.conf"
+
+# Outbound IFTTT requests, at most IFTTT_RATE per second (with bursts of up
+# to IFTTT_BURST) to each endpoint, sent by IFTTT_SENDERS threads
+IFTTT_RATE    = 1
+IFTTT_BURST   = 5
+IFTTT_SENDERS = 2
+
+# Named pipe the IFTTT confirmations are written to (by cgi-bin/hvac-status)
+IFTTT_FIFO = "/var/www/cgi-bin/hvac-fifo"
+
+# Outbound IFTTT requests are abandoned after these many seconds, and after
+# IFTTT_FAILURES failed actions in a row the endpoint is left alone for
+# IFTTT_RESET seconds.  Actions requested meanwhile are sent afterwards.
+IFTTT_CONNECT_TIMEOUT = 5
+IFTTT_READ_TIMEOUT    = 10
+IFTTT_FAILURES        = 3
+IFTTT_RESET           = 60
+
+# Local network actuator, used by zones with 'actuator = lan'.  Actions are
+# sent as GET <LAN_ACTUATOR_URL>/<event>, i.e. "http://192.168.1.20:8080"
+LAN_ACTUATOR_URL     = ""
+LAN_ACTUATOR_POOL    = 2    # Connections kept open
+LAN_ACTUATOR_TIMEOUT = 2    # Seconds
+
+# GPIO backend, 'numato' polls the boards in GPIO_SERIAL, 'gpiochip' uses
+# edge events from a Linux GPIO character device.  GPIO_CHIP_LINES are the
+# chip's line offsets, zones.conf line N is GPIO_CHIP_LINES[N].
+GPIO_BACKEND       = "numato"
+GPIO_CHIP          = "/dev/gpiochip0"
+GPIO_CHIP_LINES    = [ 0, 1, 2, 3, 4, 5, 6, 7 ]
+GPIO_CHIP_DEBOUNCE = 0  # microseconds
+
+# Status server, GET /status for a JSON snapshot of everything (0 disables).
+# Devices may also confirm actions with GET /ack?<action>, and GET /metrics has
+# counters and timings in the Prometheus text format.  Nothing is
+# authenticated, anyone who can reach it can clear pending actions and run
+# the profiler, so it only listens on this host by default.  "" listens on
+# every interface, only do that on a trusted network.
+STATUS_ADDRESS = "127.0.0.1"
+STATUS_PORT    = 8080
+
+# Profiler, toggled with 'kill -USR1 <pid>' or GET /profile?start and
+# /profile?stop.  Stopping with the signal saves PROFILE_OUTPUT.folded
+# (flamegraph.pl) and PROFILE_OUTPUT.trace.json (chrome://tracing), the
+# status server also has them as /profile/flame and /profile/trace.
+PROFILE_RATE   = 100    # Samples per second
+PROFILE_SPANS  = 10000  # Timed calls kept
+PROFILE_OUTPUT = "hvac-profile"
+
+# Run the GPIO, Nest and IFTTT workers each in a process of their own,
+# sharing their state with the zones through shared memory.  ISOLATE_CPUS
+# optionally pins them, in that order, to the given cores, i.e. [ 1, 2, 3 ].
+# Each worker's state has to fit its segment, a worker whose state has
+# outgrown it (many thermostats, a long action queue) reports not ready
+# until the size is raised.
+ISOLATE_WORKERS    = False
+ISOLATE_CPUS       = []
+ISOLATE_GPIO_SIZE  = 4096   # Bytes
+ISOLATE_NEST_SIZE  = 65536
+ISOLATE_IFTTT_SIZE = 65536
+
+# zones.conf is reloaded on 'kill -HUP <pid>', and when it changes, checked
+# every CONFIG_WATCH seconds (0 only reloads on the signal).  Only the zones
+# whose settings changed are updated, and only send the actions their new
+# settings call for.  Adding or removing zones, or rewiring them, needs a
+# restart.
+CONFIG_WATCH = 10  # Seconds
+
+# Several sites (houses) run by one daemon.  Each site is a dict of the
+# settings above that differ for it, i.e.
+#   SITES = { 'home'  : { 'NEST_TOKEN'  : "...", 'IFTTT_TOKEN' : "...",
+#                         'GPIO_SERIAL' : "/dev/ttyACM0", 'ZONE_CONFIG' : "home.conf" },
+#             'cabin' : { 'NEST_TOKEN'  : "...", 'IFTTT_TOKEN' : "...",
+#                         'GPIO_SERIAL' : "/dev/ttyACM1", 'ZONE_CONFIG' : "cabin.conf" } }
+# STATE_FILE, NEST_CACHE and IFTTT_FIFO default to a file of their own for
+# each site, i.e. cabin-hvac-state.json.  The status server has each site
+# under /<site>/, i.e. /cabin/status.  An empty SITES runs the one site
+# configured above.
+#
+# The sites are spread over SITE_PROCESSES processes, each on a core of its
+# own, with its status server on STATUS_PORT + <process number>.  0 runs
+# every site in this process.  Each process serves only its own sites'
+# /metrics and /profile, and SIGUSR1 toggles every process's profiler,
+# which save to PROFILE_OUTPUT.<process number>.
+SITES          = {}
+SITE_PROCESSES = 0
+
+# Shadow mode, a candidate zone implementation (SHADOW_ZONE, a dotted class
+# name, i.e. "myzone.Zone") and/or zones.conf (SHADOW_CONFIG) runs beside
+# the zones in control, on the same Nest and GPIO.  Its actions are only
+# recorded, and compared with the ones actually sent: an action either side
+# sends without the other sending it within SHADOW_WINDOW seconds is a
+# disagreement.  Disagreements are logged as they're found, totals every
+# SHADOW_REPORT seconds, and the status server has the report as /shadow.
+# Neither set disables it.
+SHADOW_ZONE   = ""
+SHADOW_CONFIG = ""
+SHADOW_WINDOW = 60      # Seconds
+SHADOW_REPORT = 300     # Seconds
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Actuator latency benchmark
+#
+# Sends the same actions through the IFTTT webhook backend and the local
+# network backend, both pointed at the device stand-in (lan_device.py), and
+# reports how long the zone waits for each.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import sys
+import argparse
+import threading
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import ifttt
+import actuator
+import lan_device
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def bench(name, send, count):
+    times = []
+    for n in range(count):
+        start = time()
+        send('bench_%s_%d' % (name, n))
+        times.append(time() - start)
+
+    print("%-6s %5d actions  mean %7.3fs  p50 %7.3fs  p95 %7.3fs  max %7.3fs" % (
+          name, count, sum(times) / len(times), percentile(times, 50), percentile(times, 95), max(times)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Actuator latency benchmark')
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--device-delay', type=float, default=0.05)
+    parser.add_argument('--cloud-delay', type=float, default=1.5)
+    args = parser.parse_args()
+
+    server = lan_device.DeviceServer(('127.0.0.1', args.port), args.device_delay, args.cloud_delay)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    base_url = 'http://127.0.0.1:%d' % (args.port)
+
+    # No rate limit, we're measuring the path not the pacing
+    ifttt_obj = ifttt.IFTTT('bench', url=base_url + '/trigger/%s/with/key/{0}', rate=1000, burst=1000)
+    sender = threading.Thread(target=ifttt_obj.dispatch)
+    sender.daemon = True
+    sender.start()
+
+    lan_obj = actuator.LanActuator(base_url)
+
+    bench('ifttt', lambda action: ifttt_obj.send_action(action), args.count)
+    bench('lan', lambda action: lan_obj.send_action(action), args.count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Local device stand-in
+#
+# Pretends to be the devices the zones control, so the actuator backends
+# can be exercised (and timed) without real hardware.  It answers both:
+#
+#   GET /<event>                          - as a device on the local network
+#   GET /trigger/<event>/with/key/<key>   - as the IFTTT webhook, after
+#                                           --cloud-delay seconds (the trip
+#                                           through the vendor's cloud), and
+#                                           then acknowledges the event on
+#                                           --fifo like the cgi-bin script
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import threading
+import logging
+from time import sleep
+
+class DeviceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, device_delay=0.0, cloud_delay=0.0, fifo=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, DeviceHandler)
+
+        self.logger = logging.getLogger('HVAC.Device')
+
+        self.lock = threading.Lock()
+
+        try:
+            self.lock.acquire()
+
+            self.device_delay = device_delay
+            self.cloud_delay  = cloud_delay
+            self.fifo         = fifo
+            self.events       = []   # Events received, in order
+        finally:
+            self.lock.release()
+
+    def event(self, event, cloud):
+        if cloud:
+            sleep(self.cloud_delay)
+        sleep(self.device_delay)
+
+        try:
+            self.lock.acquire()
+            self.events.append(event)
+        finally:
+            self.lock.release()
+
+        self.logger.debug("%s%s" % (event, cloud and " (cloud)" or ""))
+
+        if cloud and self.fifo:
+            # Acknowledge like cgi-bin/hvac-status, in the background
+            def ack():
+                sleep(self.cloud_delay)
+                with open(self.fifo, 'w') as f:
+                    f.write(event + '\n')
+            thread = threading.Thread(target=ack)
+            thread.daemon = True
+            thread.start()
+
+class DeviceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep alive, so the LAN backend's connection pool is used
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        fields = self.path.strip('/').split('/')
+        if len(fields) == 5 and fields[0] == 'trigger' and fields[2:4] == [ 'with', 'key' ]:
+            (event, cloud) = (fields[1], True)
+        elif len(fields) == 1 and fields[0]:
+            (event, cloud) = (fields[0], False)
+        else:
+            self.send_error(404)
+            return
+
+        self.server.event(event, cloud)
+
+        body = "Congratulations! You've fired the %s event" % (event)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Local device stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--device-delay', type=float, default=0.05,
+                        help='seconds the device takes to act (default 0.05)')
+    parser.add_argument('--cloud-delay', type=float, default=1.5,
+                        help='seconds added to webhook requests (default 1.5)')
+    parser.add_argument('--fifo', help='acknowledge webhook events on this fifo')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)-12s %(message)s')
+
+    server = DeviceServer((args.host, args.port), args.device_delay, args.cloud_delay, args.fifo)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
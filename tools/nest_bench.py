@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+#
+# Nest and zone pipeline stress benchmark
+#
+# Feeds Nest.load() whole account payloads, as the streaming API sends
+# them, for a number of synthetic thermostats, with zone threads following
+# them.  Each put changes the target temperature of one thermostat (in
+# turn) to one it didn't have before, which its zones answer with that A/C
+# set temperature (the zones have no offsets) sent to a recording actuator.
+#
+# Reports the puts per second load() kept up with, how long the Nest lock
+# was held, how many zone wakeups each put caused, the memory growth and the
+# time from a put to the zones' decisions.
+#
+# Written by Mark Hatle <mark@hatle.net>
+# Copyright (C) 2018-2020 Mark Hatle
+#
+# All of the items here are licensed under the GNU General Public License 2.0, unless
+# otherwise noted.  See COPYING for further details.
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License along
+#    with this program; if not, write to the Free Software Foundation, Inc.,
+#    51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import sys
+import gc
+import argparse
+import resource
+import tempfile
+import threading
+from time import sleep, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import nest
+import zone
+import config
+import scheduler
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+# Records how long each acquire() of the wrapped lock was held
+class HoldTimer():
+    def __init__(self, lock):
+        self.lock  = lock
+        self.local = threading.local()
+        self.holds = []
+
+    def acquire(self, blocking=1):
+        result = self.lock.acquire(blocking)
+        if result:
+            self.local.start = time()
+        return result
+
+    def release(self):
+        self.holds.append(time() - self.local.start)
+        self.lock.release()
+
+# No GPIO lines are configured, the zones only need the interface
+class IdleGpio():
+    def registerEvent(self, event):
+        pass
+
+    def deregisterEvent(self, event):
+        pass
+
+    def getGpio(self):
+        return None
+
+    def getGpioTime(self):
+        return None
+
+    def getTemperature(self, line):
+        return None
+
+# Actuator recording when each zone decided on a new set temperature
+class Recorder():
+    def __init__(self, changed):
+        self.changed = changed     # (thermostat id, target) : time of the put setting it
+        self.latency = []
+        self.actions = 0
+
+    def send_action(self, action, retry=0, priority=None):
+        self.actions += 1
+        # bench_<zone>_<thermostat>_ac_set_<temp>, the temp is the target
+        parts = action.split('_')
+        if parts[3:5] == [ 'ac', 'set' ]:
+            changed = self.changed.get((parts[2], int(parts[5])))
+            if changed:
+                self.latency.append(time() - changed)
+        return True
+
+def therm_id(index):
+    return 't%04d' % (index)
+
+def thermostat(index, target, now):
+    return { 'device_id'                : therm_id(index),
+             'name'                     : 'Bench %d' % (index),
+             'name_long'                : 'Bench Thermostat %d' % (index),
+             'locale'                   : 'en-US',
+             'software_version'         : '5.9.3-5',
+             'structure_id'             : 'bench',
+             'where_id'                 : 'w%04d' % (index),
+             'last_connection'          : now,
+             'is_online'                : True,
+             'can_cool'                 : True,
+             'can_heat'                 : False,
+             'is_using_emergency_heat'  : False,
+             'has_fan'                  : False,
+             'fan_timer_active'         : False,
+             'fan_timer_timeout'        : '1970-01-01T00:00:00.000Z',
+             'has_leaf'                 : False,
+             'temperature_scale'        : 'F',
+             'away_temperature_high_f'  : 80,
+             'away_temperature_low_f'   : 62,
+             'eco_temperature_high_f'   : 80,
+             'eco_temperature_low_f'    : 62,
+             'is_locked'                : False,
+             'locked_temp_min_f'        : 64,
+             'locked_temp_max_f'        : 86,
+             'sunlight_correction_enabled' : True,
+             'sunlight_correction_active'  : False,
+             'label'                    : '',
+             'hvac_mode'                : 'cool',
+             'hvac_state'               : 'off',
+             'target_temperature_f'     : target,
+             'target_temperature_high_f': target + 2,
+             'target_temperature_low_f' : target - 2,
+             'ambient_temperature_f'    : 74,
+             'humidity'                 : 45,
+             'time_to_target'           : '~0',
+             'time_to_target_training'  : 'ready',
+             'previous_hvac_mode'       : '' }
+
+def zone_configs(zones, thermostats):
+    text = ""
+    for index in range(zones):
+        therm = index % thermostats
+        prefix = 'bench_z%04d_%s' % (index, therm_id(therm))
+        text += "[zone:Z%04d]\n" % (index)
+        text += "thermostat = Bench Thermostat %d\n" % (therm)
+        text += "actuator = lan\n"
+        text += "ac_cooling_on_offset = 0\n"
+        text += "ac_cooling_off_offset = 0\n"
+        text += "ac_min = 0\n"
+        text += "ac_max = 1000\n"
+        text += "cool_on = %s_ac_on, 0\n" % (prefix)
+        text += "cool_off = %s_ac_off, 0\n" % (prefix)
+        text += "cooling_on = %s_ac_cool, 0\n" % (prefix)
+        text += "cooling_off = %s_ac_eco, 0\n" % (prefix)
+        text += "cooling_temp = %s_ac_set_%%s, 0\n\n" % (prefix)
+
+    (fd, filename) = tempfile.mkstemp(suffix='.conf')
+    try:
+        os.write(fd, text)
+        os.close(fd)
+        return config.load_zones(filename)
+    finally:
+        os.unlink(filename)
+
+def main():
+    parser = argparse.ArgumentParser(description='Nest and zone pipeline stress benchmark')
+    parser.add_argument('--thermostats', type=int, default=50)
+    parser.add_argument('--zones', type=int, default=100)
+    parser.add_argument('--puts', type=int, default=500, help='puts to send')
+    parser.add_argument('--rate', type=float, default=0, help='puts per minute (0 = as fast as possible)')
+    parser.add_argument('--no-groups', dest='groups', action='store_false',
+                        help='run every zone on its own, rather then grouped by thermostat')
+    parser.add_argument('--settle', type=float, default=2, help='seconds to wait for the zones at the end')
+    args = parser.parse_args()
+
+    nest_obj = nest.Nest('bench')
+    nest_obj.lock = hold = HoldTimer(nest_obj.lock)
+
+    changed = {}
+    recorder = Recorder(changed)
+    actuators = { 'lan' : recorder }
+    gpio_obj = IdleGpio()
+    scheduler_obj = scheduler.Scheduler()
+
+    # Each put takes the thermostat to a target it hasn't had yet, so the
+    # zones always have a new set temperature to send, and each decision
+    # is timed from the put that caused it
+    targets = [ 64 ] * args.thermostats
+    now = time()
+
+    # The first put brings everything up, it isn't measured
+    nest_obj.load({ 'devices' : { 'thermostats' : dict([ (therm_id(index), thermostat(index, targets[index], now))
+                                                         for index in range(args.thermostats) ]) } })
+
+    # Zones sharing a thermostat run as a group, as in hvac.py
+    groups = {}
+    for zone_config in zone_configs(args.zones, args.thermostats):
+        zone_obj = zone.Zone(nest_obj, gpio_obj, None, None, config=zone_config,
+                             scheduler=scheduler_obj, actuators=actuators)
+        groups.setdefault(zone_config.therm_name, []).append(zone_obj)
+        if not args.groups:
+            groups[zone_config.name] = groups.pop(zone_config.therm_name)
+
+    for therm_name in sorted(groups):
+        group = zone.ZoneGroup(groups[therm_name])
+        thread = threading.Thread(target=group.run, name=group.name)
+        thread.daemon = True
+        thread.start()
+
+    sleep(args.settle)
+    del hold.holds[:]
+    del recorder.latency[:]
+    wakeups_start = sum([ metric._total()[0] for (key, metric) in zone.WAKEUPS.children.items() if key[2] == 'nest' ])
+
+    gc.collect()
+    objects_start = len(gc.get_objects())
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    interval = 0
+    if args.rate:
+        interval = 60.0 / args.rate
+
+    load_times = []
+    start = time()
+    for put in range(args.puts):
+        index = put % args.thermostats
+        targets[index] += 1
+
+        now = time()
+        data = { 'devices' : { 'thermostats' : dict([ (therm_id(n), thermostat(n, targets[n], now))
+                                                      for n in range(args.thermostats) ]) } }
+        changed[(therm_id(index), targets[index])] = now
+        nest_obj.load(data)
+        load_times.append(time() - now)
+
+        if interval:
+            delay = start + (put + 1) * interval - time()
+            if delay > 0:
+                sleep(delay)
+    elapsed = time() - start
+
+    sleep(args.settle)
+
+    wakeups = sum([ metric._total()[0] for (key, metric) in zone.WAKEUPS.children.items() if key[2] == 'nest' ]) - wakeups_start
+    gc.collect()
+    objects_end = len(gc.get_objects())
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print("%d thermostats, %d zones, %d puts in %.2fs" % (args.thermostats, args.zones, args.puts, elapsed))
+    print("puts/s        %9.1f" % (args.puts / elapsed))
+    print("load()        mean %7.2fms  p50 %7.2fms  p95 %7.2fms  max %7.2fms" % (
+          sum(load_times) / len(load_times) * 1000, percentile(load_times, 50) * 1000,
+          percentile(load_times, 95) * 1000, max(load_times) * 1000))
+    print("lock held     %d times  p50 %7.2fms  p95 %7.2fms  max %7.2fms  total %.2fs" % (
+          len(hold.holds), percentile(hold.holds, 50) * 1000, percentile(hold.holds, 95) * 1000,
+          max(hold.holds or [0]) * 1000, sum(hold.holds)))
+    print("wakeups/put   %9.2f" % (wakeups / args.puts))
+    print("decisions     %d  p50 %7.2fms  p95 %7.2fms  max %7.2fms" % (
+          len(recorder.latency), percentile(recorder.latency, 50) * 1000,
+          percentile(recorder.latency, 95) * 1000, max(recorder.latency or [0]) * 1000))
+    print("memory        max rss %+d KB, %+d objects" % (rss_end - rss_start, objects_end - objects_start))
+
+    # The zone threads never return, don't let them trip over the interpreter
+    # shutting down
+    sys.stdout.flush()
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()